@@ -1,19 +1,28 @@
-import openai
-import os
+from .llm_cache import LLM_CACHE, LLMCache
+from .openai_client import get_openai_client
 
-openai.api_key = os.getenv('OPENAI_API_KEY')
+# Model families that accept response_format={"type": "json_object"}.
+JSON_MODE_MODELS = ("gpt-4o", "gpt-4-turbo", "gpt-4-1106", "gpt-4-0125", "gpt-4.1", "gpt-3.5-turbo-1106", "gpt-3.5-turbo-0125")
 
 class ChatGPT:
-    def __init__(self):
+    def __init__(self, model="gpt-4"):
+        # self.model = "gpt-3.5-turbo"
+        self.model = model
+        self.json_mode = model.startswith(JSON_MODE_MODELS)
         self.messages = [{"role": "system", "content": "You are an intelligent assistant."}]
 
-    def query_message(self, message):
+    def query_message(self, message, use_cache=True, schema=None):
         if message:
             self.messages.append({"role": "user", "content": message})
-            chat = openai.ChatCompletion.create(
-                # model="gpt-3.5-turbo", messages=self.messages
-                model="gpt-4", messages=self.messages
-            )
-            reply = chat.choices[0].message.content
+            params = {}
+            if schema is not None and self.json_mode:
+                params["response_format"] = {"type": "json_object"}
+            cache_key = LLMCache.make_key("chatgpt", self.model, self.messages, params)
+            reply = LLM_CACHE.get(cache_key) if use_cache else None
+            if reply is None:
+                # All ChatGPT objects share one pooled, rate-limited client.
+                reply = get_openai_client().chat_completion(self.model, self.messages, **params)
+                if use_cache:
+                    LLM_CACHE.put(cache_key, reply)
             self.messages.append({"role": "assistant", "content": reply})
             return reply
@@ -0,0 +1,275 @@
+import re
+
+import torch
+from transformers import LogitsProcessor
+
+WHITESPACE = " \n\t\r"
+DIGITS = "0123456789"
+MAX_INT_DIGITS = 5
+# Braces are kept out of strings: helper.extract_json_content cuts the reply at the first "}".
+STRING_EXCLUDED = '\\"{}'
+
+
+class _Literal:
+    def __init__(self, text):
+        self.text = text
+        self.initial = 0
+
+    def step(self, position, char):
+        if position < len(self.text) and char == self.text[position]:
+            return position + 1
+        return None
+
+    def complete(self, position):
+        return position == len(self.text)
+
+
+class _Whitespace:
+    initial = 0
+
+    def step(self, sub, char):
+        return 0 if char in WHITESPACE else None
+
+    def complete(self, sub):
+        return True
+
+
+class _String:
+    """A JSON string without escape sequences or braces."""
+    initial = "start"
+
+    def step(self, sub, char):
+        if sub == "start":
+            return "in" if char == '"' else None
+        if sub == "in":
+            if char == '"':
+                return "done"
+            if char in STRING_EXCLUDED or not char.isprintable():
+                return None
+            return "in"
+        return None
+
+    def complete(self, sub):
+        return sub == "done"
+
+
+class _StringList:
+    """A JSON array of strings (same characters as _String)."""
+    initial = "open"
+
+    def step(self, sub, char):
+        if sub == "open":
+            return "first" if char == "[" else None
+        if sub in ("first", "item", "next") and char in WHITESPACE:
+            return sub
+        if sub == "first":
+            return {'"': "in", "]": "done"}.get(char)
+        if sub == "in":
+            if char == '"':
+                return "item"
+            if char in STRING_EXCLUDED or not char.isprintable():
+                return None
+            return "in"
+        if sub == "item":
+            return {",": "next", "]": "done"}.get(char)
+        if sub == "next":
+            return "in" if char == '"' else None
+        return None
+
+    def complete(self, sub):
+        return sub == "done"
+
+
+class _IntList:
+    """A JSON array of exactly ``length`` non-negative integers."""
+    initial = ("open", 0, 0)
+
+    def __init__(self, length):
+        self.length = length
+
+    def step(self, sub, char):
+        phase, items, digits = sub
+        if phase == "open":
+            return ("before", 0, 0) if char == "[" else None
+        if phase == "before":
+            if char in WHITESPACE:
+                return sub
+            if char == "0":
+                # JSON numbers have no leading zeros: a 0 is the whole number
+                return ("zero", items, 1)
+            return ("number", items, 1) if char in DIGITS else None
+        if phase == "number":
+            if char in DIGITS:
+                return ("number", items, digits + 1) if digits < MAX_INT_DIGITS else None
+            return self.step(("after", items + 1, 0), char)
+        if phase == "zero":
+            return self.step(("after", items + 1, 0), char)
+        if phase == "after":
+            if char in WHITESPACE:
+                return sub
+            if char == "," and items < self.length:
+                return ("before", items, 0)
+            if char == "]" and items == self.length:
+                return ("done", items, 0)
+        return None
+
+    def complete(self, sub):
+        return sub[0] == "done"
+
+
+def _object(*fields):
+    pieces = [_Whitespace(), _Literal("{")]
+    for i, (name, value) in enumerate(fields):
+        if i > 0:
+            pieces += [_Whitespace(), _Literal(",")]
+        pieces += [_Whitespace(), _Literal(f'"{name}"'), _Whitespace(), _Literal(":"), _Whitespace(), value]
+    pieces += [_Whitespace(), _Literal("}")]
+    return pieces
+
+
+# {"object_of_motion": str, "objects_of_reference": [str, ...]}
+OBJECT_SCHEMA = _object(("object_of_motion", _String()), ("objects_of_reference", _StringList()))
+# {"predicted_bbox": [int, int, int, int]}
+BBOX_SCHEMA = _object(("predicted_bbox", _IntList(4)))
+
+SCHEMAS = {
+    "object": OBJECT_SCHEMA,
+    "bbox": BBOX_SCHEMA,
+}
+
+
+class TokenVocabulary:
+    """
+    Surface text of every token of a tokenizer, grouped by first character.
+    """
+
+    _byte_token = re.compile(r"^<0x([0-9A-Fa-f]{2})>$")
+
+    def __init__(self, tokenizer):
+        self.eos_token_id = tokenizer.eos_token_id
+        special_ids = set(tokenizer.all_special_ids)
+        self.texts = {}
+        self.by_first_char = {}
+        for token_id in range(len(tokenizer)):
+            if token_id in special_ids:
+                continue
+            text = self._token_text(tokenizer.convert_ids_to_tokens(token_id))
+            if not text:
+                continue
+            self.texts[token_id] = text
+            self.by_first_char.setdefault(text[0], []).append((token_id, text))
+
+    def _token_text(self, token):
+        if token is None:
+            return None
+        match = self._byte_token.match(token)
+        if match:
+            byte = int(match.group(1), 16)
+            # partial UTF-8 sequences can never form valid schema text on their own
+            return chr(byte) if byte < 128 else None
+        return token.replace("▁", " ").replace("Ġ", " ").replace("Ċ", "\n")
+
+
+class JSONSchemaConstraint:
+    """
+    Character-level automaton for one schema, lifted to tokens.
+
+    The set of allowed next tokens depends only on the automaton state, so it is computed
+    once per state and cached as a boolean mask.
+    """
+
+    def __init__(self, pieces, vocabulary):
+        self.pieces = pieces
+        self.vocabulary = vocabulary
+        self.initial_state = (0, pieces[0].initial)
+        self._masks = {}
+
+    def step(self, state, char):
+        index, sub = state
+        while index < len(self.pieces):
+            piece = self.pieces[index]
+            next_sub = piece.step(sub, char)
+            if next_sub is not None:
+                return index, next_sub
+            if not piece.complete(sub):
+                return None
+            index += 1
+            if index < len(self.pieces):
+                sub = self.pieces[index].initial
+        return None
+
+    def is_accepting(self, state):
+        index, sub = state
+        if not self.pieces[index].complete(sub):
+            return False
+        return all(isinstance(piece, _Whitespace) for piece in self.pieces[index + 1:])
+
+    def advance(self, state, token_id):
+        """
+        Returns the state after ``token_id``, or None once generation left the schema (e.g. EOS).
+        """
+        if state is None or token_id == self.vocabulary.eos_token_id:
+            return None
+        text = self.vocabulary.texts.get(token_id)
+        if text is None:
+            return None
+        for char in text:
+            state = self.step(state, char)
+            if state is None:
+                return None
+        return state
+
+    def allowed_mask(self, state, vocab_size, device):
+        key = (state, vocab_size, str(device))
+        if key not in self._masks:
+            mask = torch.zeros(vocab_size, dtype=torch.bool)
+            if self.is_accepting(state):
+                # the schema is complete: the only way forward is to end the sequence
+                mask[self.vocabulary.eos_token_id] = True
+            else:
+                for first_char, tokens in self.vocabulary.by_first_char.items():
+                    if self.step(state, first_char) is None:
+                        continue
+                    for token_id, text in tokens:
+                        if token_id < vocab_size and self._accepts(state, text):
+                            mask[token_id] = True
+            self._masks[key] = mask.to(device)
+        return self._masks[key]
+
+    def _accepts(self, state, text):
+        for char in text:
+            state = self.step(state, char)
+            if state is None:
+                return False
+        return True
+
+
+class JSONSchemaLogitsProcessor(LogitsProcessor):
+    """
+    Masks the logits of every row so that its continuation stays a valid prefix of its schema.
+
+    Args:
+    - constraints (list): One JSONSchemaConstraint (or None for unconstrained) per batch row.
+    - input_length (int): Length of the (padded) prompt in ``input_ids``.
+    """
+
+    def __init__(self, constraints, input_length):
+        self.constraints = constraints
+        self.states = [constraint.initial_state if constraint else None for constraint in constraints]
+        self.consumed = input_length
+
+    def __call__(self, input_ids, scores):
+        new_tokens = input_ids[:, self.consumed:].tolist()
+        self.consumed = input_ids.size(1)
+        for row, constraint in enumerate(self.constraints):
+            if constraint is None or self.states[row] is None:
+                continue
+            state = self.states[row]
+            for token_id in new_tokens[row]:
+                state = constraint.advance(state, token_id)
+            self.states[row] = state
+            if state is None:
+                continue
+            mask = constraint.allowed_mask(state, scores.size(-1), scores.device)
+            scores[row] = scores[row].masked_fill(~mask, float("-inf"))
+        return scores
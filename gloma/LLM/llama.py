@@ -1,40 +1,358 @@
+import hashlib
 import torch
 import os
-from transformers import LlamaTokenizer, LlamaForCausalLM
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from transformers import LlamaTokenizer, LlamaForCausalLM, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
 from utils.helper import extract_json_content
-from transformers import AutoModelForCausalLM, AutoTokenizer
-
-from huggingface_hub import login
-login(os.getenv('HF_API'))
+from .llm_cache import LLM_CACHE, LLMCache
+from .llm_input_prompt import PROMPT_PREFIXES
+from .json_constraint import SCHEMAS, JSONSchemaConstraint, JSONSchemaLogitsProcessor, TokenVocabulary
 
 model_id="meta-llama/Llama-2-13b-chat-hf"
 custom_cache_directory = os.getenv('CACHE_DIR')
 peft_model_id = os.getenv('PEFT_MODEL')
+MAX_NEW_TOKENS = 100
+# Put on the request queue by LLAMA.close() to stop the batching thread.
+_STOP = object()
+
+
+def load_llama(model_name=model_id, adapter_name=peft_model_id):
+    """
+    Load the Llama tokenizer and the 8-bit base model with the fine-tuned PEFT adapter.
+    """
+    from huggingface_hub import login
+    login(os.getenv('HF_API'))
+
+    tokenizer = LlamaTokenizer.from_pretrained(model_name, cache_dir=custom_cache_directory)
+    model = LlamaForCausalLM.from_pretrained(
+        model_name,
+        load_in_8bit=True,
+        device_map='auto',
+        torch_dtype=torch.float16,
+        cache_dir=custom_cache_directory
+    )
+    if adapter_name:
+        model.load_adapter(adapter_name)
+    return tokenizer, model
+
+
+def _model_fingerprint(model):
+    """
+    Identify ``model`` for LLM_CACHE keys: its checkpoint name plus a hash of any loaded PEFT
+    adapter weights, so replies cached for one fine-tune are never served for another.
+    """
+    fingerprint = getattr(model, "name_or_path", "") or type(model).__name__
+    adapters = list(getattr(model, "peft_config", None) or {})
+    if adapters:
+        digest = hashlib.sha1()
+        for name, param in model.named_parameters():
+            if any(f".{adapter}." in name for adapter in adapters):
+                digest.update(name.encode())
+                digest.update(param.detach().float().cpu().numpy().tobytes())
+        fingerprint += f"+{'+'.join(adapters)}:{digest.hexdigest()}"
+    return fingerprint
+
+
+class JSONStoppingCriteria(StoppingCriteria):
+    """
+    Stops generation once every sequence in the batch has produced a complete top-level JSON object.
+    """
+
+    def __init__(self, tokenizer, input_length):
+        self.tokenizer = tokenizer
+        self.input_length = input_length
+
+    @staticmethod
+    def is_complete(text):
+        depth = 0
+        in_string = escaped = started = False
+        for char in text:
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"' and started:
+                in_string = True
+            elif char == '{':
+                depth += 1
+                started = True
+            elif char == '}' and started:
+                depth -= 1
+                if depth == 0:
+                    return True
+        return False
+
+    def __call__(self, input_ids, scores, **kwargs):
+        texts = self.tokenizer.batch_decode(input_ids[:, self.input_length:], skip_special_tokens=True)
+        return all(self.is_complete(text) for text in texts)
+
+
+def _expand_past_key_values(past_key_values, batch_size):
+    """
+    Broadcast a batch-1 KV cache to ``batch_size`` rows without copying the prefix tensors.
+    """
+    if hasattr(past_key_values, "layers"):
+        # newer transformers: a Cache of per-layer key/value tensors, without the legacy tuple format
+        expanded = type(past_key_values)()
+        for layer_idx, layer in enumerate(past_key_values.layers):
+            expanded.update(
+                layer.keys.expand(batch_size, *layer.keys.shape[1:]),
+                layer.values.expand(batch_size, *layer.values.shape[1:]),
+                layer_idx
+            )
+        return expanded
+    is_cache_object = hasattr(past_key_values, "to_legacy_cache")
+    legacy = past_key_values.to_legacy_cache() if is_cache_object else past_key_values
+    expanded = tuple(
+        tuple(tensor.expand(batch_size, *tensor.shape[1:]) for tensor in layer)
+        for layer in legacy
+    )
+    if is_cache_object:
+        return type(past_key_values).from_legacy_cache(expanded)
+    return expanded
 
 
 class LLAMA:
-    def __init__(self):
-    
-        self.tokenizer = LlamaTokenizer.from_pretrained(model_id, cache_dir=custom_cache_directory)
-        self.model = LlamaForCausalLM.from_pretrained(
-            model_id, 
-            load_in_8bit=True, 
-            device_map='auto', 
-            torch_dtype=torch.float16, 
-            cache_dir=custom_cache_directory
-        )
-        self.model.load_adapter(peft_model_id)
-        print("🦙🦙🦙 LLAMA Initialized! 🦙🦙🦙")
-        
-    def query_message(self, prompt):
-        model_input = self.tokenizer(prompt, return_tensors="pt").to("cuda")
-        input_length = model_input.input_ids.size(1)  # Get the length of the input sequence
+    """
+    Resident Llama backend.
 
+    The model is loaded once (LLMFactory shares the instance through the model registry) and
+    a background thread collects concurrent ``query_message`` calls into dynamic micro-batches.
+    Each micro-batch is left-padded, grouped by prompt length to limit padding, and stops
+    decoding as soon as every prompt has produced a complete JSON object.
+
+    The KV cache of each fixed few-shot preamble in ``PROMPT_PREFIXES`` is computed once.
+    Prompts starting with a cached preamble only prefill their variable tail; within a batch
+    the tails are padded between the shared preamble and the tail, so the preamble's positions
+    and KV entries are identical for every row.
+
+    Queries that name a ``schema`` (see json_constraint.SCHEMAS) are decoded under that JSON
+    grammar, so the reply always parses and decoding ends as soon as the object is complete.
+
+    ``close()`` stops the batching thread; the model registry calls it when it evicts the backend.
+    """
+
+    def __init__(
+            self,
+            tokenizer=None,
+            model=None,
+            max_batch_size=8,
+            max_batch_tokens=16384,
+            batch_timeout=0.01,
+            max_new_tokens=MAX_NEW_TOKENS,
+            prompt_prefixes=PROMPT_PREFIXES
+    ):
+        """
+        Args:
+        - tokenizer, model: An already loaded tokenizer and causal LM, e.g. a tiny random-weight
+          Llama for CPU tests. The fine-tuned Llama-2-13B is loaded when omitted.
+        - max_batch_size (int): Maximum number of prompts decoded together.
+        - max_batch_tokens (int): Maximum padded prompt tokens (batch size x longest prompt) per micro-batch.
+        - batch_timeout (float): Seconds to wait for more prompts once the first one arrives.
+        - max_new_tokens (int): Upper bound on generated tokens per prompt.
+        - prompt_prefixes (list): Static prompt preambles whose KV cache is precomputed.
+        """
+        if model is None or tokenizer is None:
+            tokenizer, model = load_llama()
+        self.tokenizer = tokenizer
+        self.model = model
         self.model.eval()
-        with torch.no_grad():
-            output = self.model.generate(**model_input, max_new_tokens=100)[0]
-            generated_sequence = output[input_length:]  # Extract only the generated tokens
+        self._model_fingerprint = _model_fingerprint(model)
+        # Decoder-only models need left padding so that generation continues right after each prompt.
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.unk_token or self.tokenizer.eos_token
+
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.batch_timeout = batch_timeout
+        self.max_new_tokens = max_new_tokens
+        vocabulary = TokenVocabulary(self.tokenizer)
+        self._constraints = {name: JSONSchemaConstraint(pieces, vocabulary) for name, pieces in SCHEMAS.items()}
+        self._prefix_cache = {}  # prefix text -> (prefix token ids, past_key_values)
+        for prefix in prompt_prefixes:
+            self._build_prefix_cache(prefix)
+        self._requests = queue.Queue()
+        self._closed = False
+        self._worker = threading.Thread(target=self._batch_loop, name="llama-batcher", daemon=True)
+        self._worker.start()
+        print("🦙🦙🦙 LLAMA Initialized! 🦙🦙🦙")
+
+    def query_message(self, prompt, use_cache=True, schema=None):
+        if self._closed:
+            raise RuntimeError("The LLAMA backend is closed")
+        if schema is not None and schema not in self._constraints:
+            raise ValueError(f"Unknown JSON schema: {schema}")
+        cache_key = LLMCache.make_key(
+            "llama", self._model_fingerprint, prompt, {"max_new_tokens": self.max_new_tokens, "schema": schema}
+        )
+        if use_cache:
+            cached = LLM_CACHE.get(cache_key)
+            if cached is not None:
+                return cached
+
+        future = Future()
+        self._requests.put((prompt, schema, future))
+        json_content = future.result()
+        if use_cache:
+            LLM_CACHE.put(cache_key, json_content)
+        return json_content
+
+    def close(self):
+        """
+        Serve the queued requests, then stop the batching thread so the model can be freed.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._requests.put(_STOP)
+        self._worker.join()
+        # requests that raced with close() are failed instead of waiting forever
+        while not self._requests.empty():
+            request = self._requests.get_nowait()
+            if request is not _STOP:
+                request[2].set_exception(RuntimeError("The LLAMA backend is closed"))
+
+    def _collect_requests(self):
+        requests = [self._requests.get()]
+        deadline = time.monotonic() + self.batch_timeout
+        while len(requests) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                requests.append(self._requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return requests
+
+    def _split_micro_batches(self, requests):
+        # Sort by prompt length so prompts of similar length share a micro-batch and padding stays small.
+        lengths = [len(self.tokenizer(request[0]).input_ids) for request in requests]
+        order = sorted(range(len(requests)), key=lambda i: lengths[i])
+        micro_batches, current, current_max = [], [], 0
+        for i in order:
+            padded_max = max(current_max, lengths[i])
+            if current and padded_max * (len(current) + 1) > self.max_batch_tokens:
+                micro_batches.append(current)
+                current, padded_max = [], lengths[i]
+            current.append(requests[i])
+            current_max = padded_max
+        if current:
+            micro_batches.append(current)
+        return micro_batches
+
+    @torch.no_grad()
+    def _build_prefix_cache(self, prefix):
+        prefix_ids = self.tokenizer(prefix, return_tensors="pt").input_ids
+        # Leave out the last prefix token: it may merge with the start of the variable tail.
+        prefix_ids = prefix_ids[:, :-1].to(self.model.device)
+        past_key_values = self.model(input_ids=prefix_ids, use_cache=True).past_key_values
+        self._prefix_cache[prefix] = (prefix_ids[0], past_key_values)
+
+    def _match_prefix(self, prompt):
+        for prefix in self._prefix_cache:
+            if prompt.startswith(prefix):
+                return prefix
+        return None
+
+    def _batch_loop(self):
+        stop = False
+        while not stop:
+            requests = self._collect_requests()
+            stop = any(request is _STOP for request in requests)
+            requests = [request for request in requests if request is not _STOP]
+            groups = {}
+            for request in requests:
+                groups.setdefault(self._match_prefix(request[0]), []).append(request)
+            for prefix, group in groups.items():
+                try:
+                    micro_batches = self._split_micro_batches(group)
+                except Exception as e:
+                    for _, _, future in group:
+                        future.set_exception(e)
+                    continue
+                for micro_batch in micro_batches:
+                    prompts = [prompt for prompt, _, _ in micro_batch]
+                    schemas = [schema for _, schema, _ in micro_batch]
+                    try:
+                        replies = self.generate(prompts, prefix=prefix, schemas=schemas)
+                    except Exception as e:
+                        for _, _, future in micro_batch:
+                            future.set_exception(e)
+                        continue
+                    for (_, _, future), reply in zip(micro_batch, replies):
+                        future.set_result(reply)
+
+    def _prefix_inputs(self, prompts, prefix):
+        """
+        Build [prefix][padding][tail] inputs and the expanded prefix KV cache, or None if a
+        prompt does not tokenize to the cached prefix followed by a non-empty tail.
+        """
+        prefix_ids, past_key_values = self._prefix_cache[prefix]
+        prefix_ids = prefix_ids.cpu()
+        tails = []
+        for prompt in prompts:
+            ids = self.tokenizer(prompt, return_tensors="pt").input_ids[0]
+            if len(ids) <= len(prefix_ids) or not torch.equal(ids[:len(prefix_ids)], prefix_ids):
+                return None
+            tails.append(ids[len(prefix_ids):])
+
+        tail_length = max(len(tail) for tail in tails)
+        input_ids = torch.full((len(prompts), len(prefix_ids) + tail_length), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        input_ids[:, :len(prefix_ids)] = prefix_ids
+        attention_mask[:, :len(prefix_ids)] = 1
+        for row, tail in enumerate(tails):
+            input_ids[row, input_ids.size(1) - len(tail):] = tail
+            attention_mask[row, input_ids.size(1) - len(tail):] = 1
+
+        model_input = {
+            "input_ids": input_ids.to(self.model.device),
+            "attention_mask": attention_mask.to(self.model.device),
+            "past_key_values": _expand_past_key_values(past_key_values, len(prompts)),
+        }
+        return model_input
+
+    @torch.no_grad()
+    def generate(self, prompts, prefix=None, schemas=None):
+        """
+        Generate replies for a batch of prompts in one ``generate`` call.
+
+        Args:
+        - prompts (list): Prompts to answer.
+        - prefix (str, optional): A cached prompt prefix shared by all prompts.
+        - schemas (list, optional): Name of the JSON schema constraining each reply, or None.
+
+        Returns:
+        - list: The first JSON object found in each reply (or None).
+        """
+        model_input = None
+        if prefix is not None:
+            model_input = self._prefix_inputs(prompts, prefix)
+        if model_input is None:
+            model_input = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.model.device)
+        input_length = model_input["input_ids"].size(1)  # Get the length of the padded input sequence
+
+        logits_processor = LogitsProcessorList()
+        if schemas and any(schemas):
+            constraints = [self._constraints[schema] if schema else None for schema in schemas]
+            logits_processor.append(JSONSchemaLogitsProcessor(constraints, input_length))
+
+        output = self.model.generate(
+            **model_input,
+            max_new_tokens=self.max_new_tokens,
+            pad_token_id=self.tokenizer.pad_token_id,
+            logits_processor=logits_processor,
+            stopping_criteria=StoppingCriteriaList([JSONStoppingCriteria(self.tokenizer, input_length)])
+        )
+        generated_sequences = output[:, input_length:]  # Extract only the generated tokens
 
-            return_message = self.tokenizer.decode(generated_sequence, skip_special_tokens=True)
-            json_content = extract_json_content(return_message)
-            return json_content
\ No newline at end of file
+        return_messages = self.tokenizer.batch_decode(generated_sequences, skip_special_tokens=True)
+        return [extract_json_content(return_message) for return_message in return_messages]
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+
+class LLMCache:
+    """
+    Content-addressed cache of LLM replies.
+
+    Replies are keyed on (backend, model name, rendered prompt, decoding params). Lookups go
+    through an in-memory LRU tier first, then an optional on-disk SQLite tier whose entries
+    expire after ``ttl`` seconds.
+    """
+
+    def __init__(
+            self,
+            max_entries: int = 1024,
+            db_path: Optional[str] = None,
+            ttl: Optional[float] = None,
+            bypass: bool = False
+    ):
+        """
+        Args:
+        - max_entries (int): Capacity of the in-memory LRU tier.
+        - db_path (str, optional): SQLite file for the on-disk tier. Disabled when None.
+        - ttl (float, optional): Lifetime of on-disk entries in seconds. Entries never expire when None.
+        - bypass (bool): Skip the cache entirely, both for lookups and stores.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, reply TEXT, created REAL)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def make_key(backend: str, model: str, prompt: Any, params: Optional[Dict] = None) -> str:
+        """
+        Hash the request into a cache key. ``prompt`` may be a string or a list of chat messages.
+        """
+        payload = json.dumps(
+            {"backend": backend, "model": model, "prompt": prompt, "params": params or {}},
+            sort_keys=True
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        if self.bypass:
+            return None
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+
+            reply = self._get_from_disk(key)
+            if reply is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._put_in_memory(key, reply)
+            return reply
+
+    def put(self, key: str, reply: str):
+        if self.bypass or reply is None:
+            return
+        with self._lock:
+            self._put_in_memory(key, reply)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, reply, created) VALUES (?, ?, ?)",
+                    (key, reply, time.time())
+                )
+                self._db.commit()
+
+    def _get_from_disk(self, key: str) -> Optional[str]:
+        if self._db is None:
+            return None
+        row = self._db.execute("SELECT reply, created FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        reply, created = row
+        if self.ttl is not None and time.time() - created > self.ttl:
+            self._db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            self._db.commit()
+            return None
+        return reply
+
+    def _put_in_memory(self, key: str, reply: str):
+        self._memory[key] = reply
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM llm_cache")
+                self._db.commit()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._memory)}
+
+
+def _cache_from_env() -> LLMCache:
+    ttl = os.getenv("GLOMA_LLM_CACHE_TTL")
+    return LLMCache(
+        max_entries=int(os.getenv("GLOMA_LLM_CACHE_SIZE", "1024")),
+        db_path=os.getenv("GLOMA_LLM_CACHE_DB") or None,
+        ttl=float(ttl) if ttl else None,
+        bypass=os.getenv("GLOMA_LLM_CACHE_BYPASS", "False").lower() in ("1", "true")
+    )
+
+
+# Shared by the ChatGPT and LLAMA backends.
+LLM_CACHE = _cache_from_env()
@@ -1,4 +1,6 @@
-from .llama import LLAMA
+from model_registry import MODEL_REGISTRY
+
+from .llama import LLAMA, model_id, peft_model_id
 from .chat_gpt import ChatGPT
 
 
@@ -6,8 +8,10 @@ class LLMFactory:
     @staticmethod
     def create_chat_object(chat_type):
         if chat_type.lower() == 'chatgpt':
+            # ChatGPT keeps its conversation history, so every caller gets a fresh one.
             return ChatGPT()
         elif chat_type.lower() == 'llama':
-            return LLAMA()
+            # LLAMA is stateless between queries; share the loaded weights across callers.
+            return MODEL_REGISTRY.get(("llama", model_id, peft_model_id), LLAMA)
         else:
             raise ValueError(f"Unknown chat type: {chat_type}")
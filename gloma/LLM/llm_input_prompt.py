@@ -84,4 +84,11 @@ Action Prompt: {action_prompt}
 Object of motion: {obj_of_motion_box}
 Objects of reference: {objs_of_reference_boxes}
 A:
-"""
\ No newline at end of file
+"""
+
+# Fixed few-shot preambles of the prompts above, i.e. everything before the first variable field.
+# Local backends precompute the KV cache of these once and only prefill the variable tail.
+PROMPT_PREFIXES = [
+    OBJECT_PROMPT.split("{action_prompt}")[0].format(),
+    BOUNDING_BOX_PROMPT.split("{action_prompt}")[0].format(),
+]
@@ -0,0 +1,172 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class OpenAIError(RuntimeError):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class TokenBucket:
+    """
+    Async token-bucket rate limiter: allows ``rate`` acquisitions per second with bursts of up to ``capacity``.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncOpenAIClient:
+    """
+    Async client for the OpenAI chat completions endpoint.
+
+    One instance holds one keep-alive HTTP connection pool and must be used from a single
+    event loop. Requests are bounded by a semaphore (``max_in_flight``) and a token bucket
+    (``requests_per_minute``), time out after ``timeout`` seconds, and are retried with
+    exponential backoff on timeouts, 429 and 5xx responses, honouring ``Retry-After``.
+    """
+
+    def __init__(
+            self,
+            api_key: Optional[str] = None,
+            base_url: str = OPENAI_BASE_URL,
+            max_in_flight: int = 8,
+            requests_per_minute: Optional[float] = None,
+            timeout: float = 60.0,
+            max_retries: int = 5,
+            backoff_base: float = 0.5,
+            backoff_max: float = 30.0
+    ):
+        self.api_key = api_key if api_key is not None else os.getenv('OPENAI_API_KEY')
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._rate_limiter = TokenBucket(requests_per_minute / 60.0) if requests_per_minute else None
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight),
+            headers={"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+        )
+
+    def _backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return delay * (0.5 + random.random() / 2)
+
+    async def chat_completion(self, model: str, messages: List[Dict], **params) -> str:
+        """
+        Send a chat completion request and return the reply content.
+
+        Raises:
+        - OpenAIError: If the request keeps failing after ``max_retries`` retries, or fails with a non-retryable status.
+        """
+        payload = dict(model=model, messages=messages, **params)
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                if self._rate_limiter is not None:
+                    await self._rate_limiter.acquire()
+                try:
+                    response = await self._client.post("/chat/completions", json=payload)
+                except (httpx.TimeoutException, httpx.TransportError) as e:
+                    if attempt == self.max_retries:
+                        raise OpenAIError(f"OpenAI request failed: {e!r}") from e
+                    await asyncio.sleep(self._backoff(attempt))
+                    continue
+
+                if response.status_code == 200:
+                    return response.json()["choices"][0]["message"]["content"]
+                if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                    raise OpenAIError(
+                        f"OpenAI request failed with status {response.status_code}: {response.text}",
+                        status_code=response.status_code
+                    )
+                await asyncio.sleep(self._backoff(attempt, response.headers.get("retry-after")))
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+class OpenAIClient:
+    """
+    Blocking facade over AsyncOpenAIClient for synchronous callers.
+
+    The async client lives on a private event loop in a daemon thread, so concurrent
+    callers from many threads share one connection pool and one set of limits.
+    """
+
+    def __init__(self, **client_kwargs):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="openai-client", daemon=True)
+        self._thread.start()
+        self.async_client = self._run(self._make_client(client_kwargs))
+
+    @staticmethod
+    async def _make_client(client_kwargs):
+        return AsyncOpenAIClient(**client_kwargs)
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def chat_completion(self, model: str, messages: List[Dict], **params) -> str:
+        return self._run(self.async_client.chat_completion(model, messages, **params))
+
+    def close(self):
+        self._run(self.async_client.aclose())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_openai_client() -> OpenAIClient:
+    """
+    Returns the process-wide OpenAI client, configured from the environment on first use.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                rpm = os.getenv('OPENAI_REQUESTS_PER_MINUTE')
+                _client = OpenAIClient(
+                    base_url=os.getenv('OPENAI_BASE_URL', OPENAI_BASE_URL),
+                    max_in_flight=int(os.getenv('OPENAI_MAX_IN_FLIGHT', '8')),
+                    requests_per_minute=float(rpm) if rpm else None,
+                    timeout=float(os.getenv('OPENAI_TIMEOUT', '60')),
+                    max_retries=int(os.getenv('OPENAI_MAX_RETRIES', '5'))
+                )
+    return _client
@@ -1,39 +1,109 @@
 import os
+import threading
+from typing import List, Optional
 
 import cv2
 import numpy as np
 import supervision as sv
 import torch
-import torchvision
-from groundingdino.util.inference import Model
+from groundingdino.util.inference import Model, preprocess_caption
+from groundingdino.util.misc import nested_tensor_from_tensor_list
+from groundingdino.util.utils import get_phrases_from_posmap
 from segment_anything import SamPredictor, sam_model_registry
 
+from compact_mask import CompactMask
+from detection_cache import DETECTION_CACHE, CachedBackbone
+from detection_postprocess import DetectionSet, postprocess_detections
+from sam_embedding_cache import SAM_EMBEDDING_CACHE
+
 DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 # GroundingDINO config and checkpoint
 GROUNDING_DINO_CONFIG_PATH = "../submodules/Grounded-Segment-Anything/GroundingDINO/groundingdino/config/GroundingDINO_SwinT_OGC.py"
 GROUNDING_DINO_CHECKPOINT_PATH = "../checkpoints/groundingdino_swint_ogc.pth"
 
-# Segment-Anything checkpoint
-SAM_ENCODER_VERSION = "vit_h"
-SAM_CHECKPOINT_PATH = "../checkpoints/sam_vit_h_4b8939.pth"
+# Segment-Anything checkpoints, one per encoder variant
+SAM_ENCODER_VERSION = os.getenv("SAM_ENCODER_VERSION", "vit_h")
+SAM_CHECKPOINT_PATHS = {
+    "vit_b": "../checkpoints/sam_vit_b_01ec64.pth",
+    "vit_l": "../checkpoints/sam_vit_l_0b3195.pth",
+    "vit_h": "../checkpoints/sam_vit_h_4b8939.pth",
+}
+
+# Rough peak accelerator memory per image of one batched forward, used to size batches
+GROUNDING_DINO_BYTES_PER_IMAGE = 1 << 30
+SAM_ENCODER_BYTES_PER_IMAGE = {
+    "vit_b": 1 << 30,
+    "vit_l": 2 << 30,
+    "vit_h": 3 << 30,
+}
+MAX_BATCH_SIZE = 16
+
+# Models are built on first use instead of at import time.
+_grounding_dino_model = None
+_sam_predictors = {}
+_model_lock = threading.Lock()
+# SamPredictor keeps the current image embedding as state, so set_image/predict must not interleave.
+_sam_predict_lock = threading.Lock()
+
+
+def _check_paths(paths_to_check):
+    for path in paths_to_check:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"File '{path}' does not exist.")
+
+
+def get_grounding_dino_model() -> Model:
+    """
+    Returns the shared GroundingDINO inference model, building it on first call.
+    """
+    global _grounding_dino_model
+    if _grounding_dino_model is None:
+        with _model_lock:
+            if _grounding_dino_model is None:
+                _check_paths([GROUNDING_DINO_CONFIG_PATH, GROUNDING_DINO_CHECKPOINT_PATH])
+                model = Model(
+                    model_config_path=GROUNDING_DINO_CONFIG_PATH,
+                    model_checkpoint_path=GROUNDING_DINO_CHECKPOINT_PATH
+                )
+                model.dtype = torch.float16
+                # Reuse image backbone features when the same image is queried with new phrases
+                model.model.backbone = CachedBackbone(
+                    model.model.backbone,
+                    max_entries=int(os.getenv("GLOMA_DINO_FEATURE_CACHE_SIZE", "4"))
+                )
+                _grounding_dino_model = model
+    return _grounding_dino_model
+
+
+def get_sam_predictor(encoder_version: Optional[str] = None) -> SamPredictor:
+    """
+    Returns the shared SAM predictor for the given encoder variant, building it on first call.
 
-paths_to_check = [GROUNDING_DINO_CONFIG_PATH, GROUNDING_DINO_CHECKPOINT_PATH, SAM_CHECKPOINT_PATH]
-for path in paths_to_check:
-    if not os.path.exists(path):
-        raise FileNotFoundError(f"File '{path}' does not exist.")
+    Args:
+    - encoder_version (str, optional): One of "vit_b", "vit_l" or "vit_h". Defaults to SAM_ENCODER_VERSION.
+    """
+    encoder_version = encoder_version or SAM_ENCODER_VERSION
+    if encoder_version not in SAM_CHECKPOINT_PATHS:
+        raise ValueError(f"Unknown SAM encoder version: {encoder_version}")
+    if encoder_version not in _sam_predictors:
+        with _model_lock:
+            if encoder_version not in _sam_predictors:
+                checkpoint_path = SAM_CHECKPOINT_PATHS[encoder_version]
+                _check_paths([checkpoint_path])
+                sam = sam_model_registry[encoder_version](checkpoint=checkpoint_path)
+                sam.to(device=DEVICE)
+                _sam_predictors[encoder_version] = SamPredictor(sam)
+    return _sam_predictors[encoder_version]
 
-# Building GroundingDINO inference model
-grounding_dino_model = Model(
-    model_config_path=GROUNDING_DINO_CONFIG_PATH,
-    model_checkpoint_path=GROUNDING_DINO_CHECKPOINT_PATH
-)
-grounding_dino_model.dtype = torch.float16
 
-# Building SAM Model and SAM Predictor
-sam = sam_model_registry[SAM_ENCODER_VERSION](checkpoint=SAM_CHECKPOINT_PATH)
-sam.to(device=DEVICE)
-SAM_PREDICTOR = SamPredictor(sam)
+def warm_up(encoder_version: Optional[str] = None):
+    """
+    Builds GroundingDINO and the SAM predictor ahead of the first request.
+    Long-running servers should call this once at startup.
+    """
+    get_grounding_dino_model()
+    get_sam_predictor(encoder_version)
 
 
 class GroundedSAM:
@@ -43,17 +113,20 @@ class GroundedSAM:
             class_prompt,
             box_threshold=0.25,
             text_threshold=0.25,
-            nms_threshold=0.8
+            nms_threshold=0.8,
+            sam_encoder_version=None
     ):
         self.image = source_image
         self.class_prompt = class_prompt
         self.box_threshold = box_threshold
         self.text_threshold = text_threshold
         self.nms_threshold = nms_threshold
+        self.sam_encoder_version = sam_encoder_version
 
         # Detect objects
         print("SAM is searching for ", self.class_prompt)
-        self.detections = grounding_dino_model.predict_with_classes(
+        self.detections = DETECTION_CACHE.predict_with_classes(
+            get_grounding_dino_model(),
             image=self.image,
             classes=self.class_prompt,
             box_threshold=self.box_threshold,
@@ -64,28 +137,221 @@ class GroundedSAM:
 
     def _NMS_post_process(self):
         print(f"Before NMS: {len(self.detections.xyxy)} boxes")
-        nms_idx = torchvision.ops.nms(
-            torch.from_numpy(self.detections.xyxy), 
-            torch.from_numpy(self.detections.confidence), 
-            self.nms_threshold
-        ).numpy().tolist()
-        self.detections.xyxy = self.detections.xyxy[nms_idx]
-        self.detections.confidence = self.detections.confidence[nms_idx]
-        self.detections.class_id = self.detections.class_id[nms_idx]
+        self.detections = postprocess_detections(self.detections, self.class_prompt, self.nms_threshold)
         print(f"After NMS: {len(self.detections.xyxy)} boxes")
 
 
+    @torch.no_grad()
     def get_detections(self):
-        # convert detections to masks
-        self.detections.mask = []
-        SAM_PREDICTOR.set_image(cv2.cvtColor(self.image, cv2.COLOR_BGR2RGB))
-        for box in self.detections.xyxy:
-            masks, scores, logits = SAM_PREDICTOR.predict(
-                box=box,
-                multimask_output=True
-            )
-            index = np.argmax(scores)
-            self.detections.mask.append(masks[index])
-        self.detections.mask = np.array(self.detections.mask)
-
-        return self.detections, self.class_prompt
\ No newline at end of file
+        # convert detections to masks, decoding all boxes in one batched SAM call
+        height, width = self.image.shape[:2]
+        if len(self.detections.xyxy) == 0:
+            self.detections.mask = []
+            return self.detections, self.class_prompt
+
+        encoder_version = self.sam_encoder_version or SAM_ENCODER_VERSION
+        sam_predictor = get_sam_predictor(encoder_version)
+        with _sam_predict_lock:
+            SAM_EMBEDDING_CACHE.set_image(sam_predictor, cv2.cvtColor(self.image, cv2.COLOR_BGR2RGB), encoder_version)
+            self.detections.mask = _decode_masks(sam_predictor, self.detections.xyxy, (height, width))
+
+        return self.detections, self.class_prompt
+
+
+def _decode_masks(predictor: SamPredictor, xyxy: np.ndarray, image_size) -> List[CompactMask]:
+    """
+    Decode one mask per box with the image currently set on ``predictor``.
+
+    Returns:
+    - list: The best-scoring of SAM's three proposals per box, as CompactMask. Only the occupied
+      box of each mask is copied off the device.
+    """
+    boxes = torch.as_tensor(xyxy, dtype=torch.float, device=predictor.device)
+    boxes = predictor.transform.apply_boxes_torch(boxes, image_size)
+    masks, scores, logits = predictor.predict_torch(
+        point_coords=None,
+        point_labels=None,
+        boxes=boxes,
+        multimask_output=True
+    )
+    # masks: (N, 3, H, W), scores: (N, 3) -> keep the best-scoring mask of each box on the device
+    best = scores.argmax(dim=1)
+    best_masks = masks[torch.arange(len(xyxy), device=masks.device), best]
+    # occupied bounds of every mask, found on the device: first and last True of each projection
+    rows_occupied = best_masks.any(dim=2).byte()
+    cols_occupied = best_masks.any(dim=1).byte()
+    bounds = torch.stack([
+        rows_occupied.argmax(dim=1), rows_occupied.shape[1] - rows_occupied.flip(1).argmax(dim=1),
+        cols_occupied.argmax(dim=1), cols_occupied.shape[1] - cols_occupied.flip(1).argmax(dim=1),
+        rows_occupied.amax(dim=1).long()
+    ], dim=1)
+    bounds = bounds.cpu().numpy()
+    # crop on the device and bring every crop over in one flat buffer, not the full-frame masks
+    crops = [mask[y1:y2, x1:x2].reshape(-1) for mask, (y1, y2, x1, x2, occupied) in zip(best_masks, bounds) if occupied]
+    flat = torch.cat(crops).cpu().numpy() if crops else None
+    compact_masks, start = [], 0
+    for y1, y2, x1, x2, occupied in bounds:
+        if not occupied:
+            compact_masks.append(CompactMask.empty(image_size))
+            continue
+        box_shape = (y2 - y1, x2 - x1)
+        box = flat[start:start + box_shape[0] * box_shape[1]].reshape(box_shape)
+        start += box.size
+        compact_masks.append(CompactMask.from_dense(box, offset=(y1, x1), shape=image_size))
+    return compact_masks
+
+
+def _auto_batch_size(bytes_per_image: int) -> int:
+    """
+    Number of images that fit in the free accelerator memory, capped at MAX_BATCH_SIZE.
+    """
+    if DEVICE.type != "cuda":
+        return 4
+    free_bytes, _ = torch.cuda.mem_get_info(DEVICE)
+    return max(1, min(MAX_BATCH_SIZE, free_bytes // bytes_per_image))
+
+
+def _map_in_batches(fn, items, batch_size):
+    """
+    Apply ``fn`` to consecutive slices of ``items`` and concatenate the results.
+    A slice that runs out of accelerator memory is retried with half the batch size.
+    """
+    results = []
+    start = 0
+    while start < len(items):
+        batch = items[start:start + batch_size]
+        try:
+            results.extend(fn(batch))
+        except torch.cuda.OutOfMemoryError:
+            if batch_size == 1:
+                raise
+            torch.cuda.empty_cache()
+            batch_size = max(1, batch_size // 2)
+            print(f"Out of memory, retrying with batch size {batch_size}")
+            continue
+        start += len(batch)
+    return results
+
+
+@torch.no_grad()
+def _detect_batch(model: Model, images, class_prompts, box_threshold, text_threshold) -> List[sv.Detections]:
+    # GroundingDINO takes a padded NestedTensor and one caption per image
+    samples = nested_tensor_from_tensor_list(
+        [Model.preprocess_image(image_bgr=image).to(model.device) for image in images]
+    )
+    captions = [preprocess_caption(". ".join(classes)) for classes in class_prompts]
+    outputs = model.model(samples, captions=captions)
+    batch_logits = outputs["pred_logits"].sigmoid().cpu()
+    batch_boxes = outputs["pred_boxes"].cpu()
+
+    tokenizer = model.model.tokenizer
+    results = []
+    for image, classes, caption, logits, boxes in zip(images, class_prompts, captions, batch_logits, batch_boxes):
+        keep = logits.max(dim=1)[0] > box_threshold
+        logits, boxes = logits[keep], boxes[keep]
+        tokenized = tokenizer(caption)
+        phrases = [
+            get_phrases_from_posmap(logit > text_threshold, tokenized, tokenizer).replace('.', '')
+            for logit in logits
+        ]
+        height, width = image.shape[:2]
+        detections = Model.post_process_result(source_h=height, source_w=width, boxes=boxes, logits=logits.max(dim=1)[0])
+        class_id = Model.phrases2classes(phrases=phrases, classes=classes)
+        known = np.array([c is not None for c in class_id], dtype=bool)
+        detections = detections[known] if len(detections) else detections
+        detections.class_id = class_id[known].astype(int) if len(class_id) else np.zeros(0, dtype=int)
+        results.append(detections)
+    return results
+
+
+@torch.no_grad()
+def _segment_batch(predictor: SamPredictor, encoder_version: str, rgb_images, detections) -> List[DetectionSet]:
+    features = [SAM_EMBEDDING_CACHE.get(image, encoder_version, predictor.device) for image in rgb_images]
+    pending = [i for i, image_features in enumerate(features) if image_features is None]
+    if pending:
+        # SAM resizes and pads every image to the same square input, so the batch stacks directly
+        model = predictor.model
+        inputs = []
+        for i in pending:
+            resized = predictor.transform.apply_image(rgb_images[i])
+            resized = torch.as_tensor(resized, device=predictor.device).permute(2, 0, 1).contiguous()
+            inputs.append(model.preprocess(resized[None]))
+        encoded = model.image_encoder(torch.cat(inputs))
+        for i, image_features in zip(pending, encoded):
+            features[i] = image_features[None]
+            SAM_EMBEDDING_CACHE.put(rgb_images[i], encoder_version, features[i])
+
+    for image, image_features, image_detections in zip(rgb_images, features, detections):
+        SAM_EMBEDDING_CACHE.prime(predictor, image.shape[:2], image_features)
+        image_detections.mask = _decode_masks(predictor, image_detections.xyxy, image.shape[:2])
+    return detections
+
+
+def batch_grounded_sam(
+        images: List[np.ndarray],
+        class_prompts: List[List[str]],
+        box_threshold=0.25,
+        text_threshold=0.25,
+        nms_threshold=0.8,
+        batch_size=None,
+        sam_encoder_version=None
+) -> List[sv.Detections]:
+    """
+    Detect and segment objects in many images at once.
+
+    GroundingDINO and the SAM image encoder run over padded mini-batches; images are grouped
+    by size to keep padding small. The image embeddings are stored in SAM_EMBEDDING_CACHE, so
+    later GroundedSAM calls on the same images skip the encoder as well.
+
+    Args:
+    - images (list): BGR images (HWC uint8), as read by cv2.
+    - class_prompts (list): One list of class phrases per image.
+    - box_threshold, text_threshold, nms_threshold (float): As in GroundedSAM.
+    - batch_size (int, optional): Images per forward pass. Sized from free accelerator memory when omitted;
+      halved automatically when a batch runs out of memory.
+    - sam_encoder_version (str, optional): SAM encoder variant. Defaults to SAM_ENCODER_VERSION.
+
+    Returns:
+    - list: One sv.Detections (with dense masks) per input image, in input order.
+    """
+    if len(images) != len(class_prompts):
+        raise ValueError("images and class_prompts must have the same length")
+    encoder_version = sam_encoder_version or SAM_ENCODER_VERSION
+    dino_model = get_grounding_dino_model()
+    sam_predictor = get_sam_predictor(encoder_version)
+
+    # Group similarly sized images so the padded GroundingDINO batches waste little compute
+    order = sorted(range(len(images)), key=lambda i: (images[i].shape[0] * images[i].shape[1], images[i].shape[:2]))
+    sorted_images = [images[i] for i in order]
+    sorted_prompts = [class_prompts[i] for i in order]
+
+    detections = _map_in_batches(
+        lambda batch: _detect_batch(dino_model, [sorted_images[i] for i in batch], [sorted_prompts[i] for i in batch], box_threshold, text_threshold),
+        list(range(len(images))),
+        batch_size or _auto_batch_size(GROUNDING_DINO_BYTES_PER_IMAGE)
+    )
+    detections = [
+        postprocess_detections(d, prompts, nms_threshold)
+        for d, prompts in zip(detections, sorted_prompts)
+    ]
+
+    # Only images with at least one box need a SAM embedding
+    to_segment = [i for i, d in enumerate(detections) if len(d)]
+    with _sam_predict_lock:
+        _map_in_batches(
+            lambda batch: _segment_batch(
+                sam_predictor,
+                encoder_version,
+                [cv2.cvtColor(sorted_images[i], cv2.COLOR_BGR2RGB) for i in batch],
+                [detections[i] for i in batch]
+            ),
+            to_segment,
+            batch_size or _auto_batch_size(SAM_ENCODER_BYTES_PER_IMAGE[encoder_version])
+        )
+
+    results = [None] * len(images)
+    for sorted_index, image_index in enumerate(order):
+        d = detections[sorted_index]
+        height, width = images[image_index].shape[:2]
+        results[image_index] = d.to_detections((height, width))
+    return results
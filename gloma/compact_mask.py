@@ -0,0 +1,139 @@
+from typing import Iterable, Optional, Tuple
+
+import cv2
+import numpy as np
+
+# number of set bits of every byte value
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+
+
+class CompactMask:
+    """
+    Binary mask stored as its tight bounding box plus the bit-packed pixels inside it.
+
+    Segmentation masks are mostly zeros, so keeping only the occupied box, eight pixels per
+    byte, makes them a small fraction of a dense (H, W) bool array. Area, bounding box,
+    cropping, union and dilation all work on the packed box; ``to_dense`` expands to a full
+    frame and is only needed where a model consumes the mask (LaMa).
+
+    Attributes:
+    - shape (tuple): (H, W) of the full frame.
+    - offset (tuple): (y, x) of the top-left corner of the stored box.
+    - box_shape (tuple): (h, w) of the stored box; (0, 0) for an empty mask.
+    """
+
+    def __init__(self, packed: np.ndarray, box_shape: Tuple[int, int], offset: Tuple[int, int], shape: Tuple[int, int]):
+        self.packed = packed
+        self.box_shape = tuple(box_shape)
+        self.offset = tuple(offset)
+        self.shape = tuple(shape)
+
+    @classmethod
+    def from_dense(cls, mask: np.ndarray, offset: Tuple[int, int] = (0, 0), shape: Optional[Tuple[int, int]] = None) -> "CompactMask":
+        """
+        Args:
+        - mask (np.ndarray): 2D array, non-zero inside the mask.
+        - offset (tuple): (y, x) position of ``mask`` in the full frame, when ``mask`` is a crop.
+        - shape (tuple, optional): (H, W) of the full frame. Defaults to the shape of ``mask``.
+        """
+        mask = np.asarray(mask).astype(bool, copy=False)
+        shape = shape or mask.shape
+        rows = np.flatnonzero(mask.any(axis=1))
+        if len(rows) == 0:
+            return cls.empty(shape)
+        cols = np.flatnonzero(mask.any(axis=0))
+        y1, y2, x1, x2 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+        box = mask[y1:y2, x1:x2]
+        return cls(np.packbits(box, axis=1), box.shape, (offset[0] + y1, offset[1] + x1), shape)
+
+    @classmethod
+    def empty(cls, shape: Tuple[int, int]) -> "CompactMask":
+        return cls(np.zeros((0, 0), dtype=np.uint8), (0, 0), (0, 0), shape)
+
+    @classmethod
+    def union_all(cls, masks: Iterable["CompactMask"], shape: Optional[Tuple[int, int]] = None) -> "CompactMask":
+        """
+        Union of several masks of the same frame, computed on their combined bounding box.
+        """
+        masks = list(masks)
+        shape = shape or (masks[0].shape if masks else None)
+        masks = [m for m in masks if m.box_shape[0]]
+        if not masks:
+            return cls.empty(shape)
+        y1 = min(m.offset[0] for m in masks)
+        x1 = min(m.offset[1] for m in masks)
+        y2 = max(m.offset[0] + m.box_shape[0] for m in masks)
+        x2 = max(m.offset[1] + m.box_shape[1] for m in masks)
+        canvas = np.zeros((y2 - y1, x2 - x1), dtype=bool)
+        for m in masks:
+            top, left = m.offset[0] - y1, m.offset[1] - x1
+            canvas[top:top + m.box_shape[0], left:left + m.box_shape[1]] |= m.box()
+        return cls.from_dense(canvas, offset=(y1, x1), shape=shape)
+
+    def __or__(self, other: "CompactMask") -> "CompactMask":
+        return CompactMask.union_all([self, other], shape=self.shape)
+
+    @property
+    def nbytes(self) -> int:
+        return self.packed.nbytes
+
+    @property
+    def area(self) -> int:
+        return int(_POPCOUNT[self.packed].sum())
+
+    @property
+    def bbox(self) -> Optional[Tuple[int, int, int, int]]:
+        """
+        Tight (x1, y1, x2, y2) box of the mask with exclusive x2/y2, or None when empty.
+        """
+        if self.box_shape[0] == 0:
+            return None
+        y, x = self.offset
+        h, w = self.box_shape
+        return x, y, x + w, y + h
+
+    def box(self) -> np.ndarray:
+        """
+        Returns the bool pixels of the stored box, shape ``box_shape``.
+        """
+        return np.unpackbits(self.packed, axis=1, count=self.box_shape[1]).astype(bool)
+
+    def crop(self, x1: int, y1: int, x2: int, y2: int) -> np.ndarray:
+        """
+        Dense bool pixels of the frame region [y1:y2, x1:x2], decoding only the overlapping rows.
+        """
+        out = np.zeros((max(0, y2 - y1), max(0, x2 - x1)), dtype=bool)
+        if self.box_shape[0] == 0:
+            return out
+        oy, ox = self.offset
+        h, w = self.box_shape
+        top, bottom = max(y1, oy), min(y2, oy + h)
+        left, right = max(x1, ox), min(x2, ox + w)
+        if top >= bottom or left >= right:
+            return out
+        rows = np.unpackbits(self.packed[top - oy:bottom - oy], axis=1, count=w).astype(bool)
+        out[top - y1:bottom - y1, left - x1:right - x1] = rows[:, left - ox:right - ox]
+        return out
+
+    def dilate(self, kernel: np.ndarray) -> "CompactMask":
+        """
+        Same result as ``cv2.dilate`` (centred anchor) on the full frame, computed on the box
+        padded by the kernel radius.
+        """
+        if self.box_shape[0] == 0:
+            return self
+        height, width = self.shape
+        # with the anchor at k // 2 a pixel spreads at most k // 2 in every direction
+        pad_y, pad_x = kernel.shape[0] // 2, kernel.shape[1] // 2
+        x1, y1, x2, y2 = self.bbox
+        x1, y1 = max(0, x1 - pad_x), max(0, y1 - pad_y)
+        x2, y2 = min(width, x2 + pad_x), min(height, y2 + pad_y)
+        region = cv2.dilate(self.crop(x1, y1, x2, y2).astype(np.uint8), kernel, iterations=1)
+        return CompactMask.from_dense(region, offset=(y1, x1), shape=self.shape)
+
+    def to_dense(self, dtype=np.uint8) -> np.ndarray:
+        """
+        Expands to a full (H, W) frame. Only needed at model boundaries.
+        """
+        height, width = self.shape
+        return self.crop(0, 0, width, height).astype(dtype)
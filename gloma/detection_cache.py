@@ -0,0 +1,171 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import List
+
+import numpy as np
+import supervision as sv
+import torch
+
+from utils import helper
+
+
+class CachedBackbone(torch.nn.Module):
+    """
+    Wraps the GroundingDINO image backbone and memoises its output per image.
+
+    GroundingDINO runs the image backbone before the text-conditioned transformer, so
+    querying a known image with a new phrase only pays for the text encoder and the head.
+    The caller names the current image through ``image_key``; with no key the backbone runs as usual.
+    The key is thread-local, so batched forwards on other threads never see it. The backbone
+    itself runs outside the lock guarding the stored outputs.
+    """
+
+    def __init__(self, backbone: torch.nn.Module, max_entries: int = 4):
+        super().__init__()
+        self.backbone = backbone
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._outputs = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def image_key(self):
+        return getattr(self._local, "image_key", None)
+
+    @image_key.setter
+    def image_key(self, key):
+        self._local.image_key = key
+
+    def __getitem__(self, index):
+        # GroundingDINO indexes the backbone Joiner for its position embedding
+        return self.backbone[index]
+
+    def forward(self, samples):
+        if self.image_key is None:
+            return self.backbone(samples)
+        key = self.image_key
+        with self._lock:
+            outputs = self._outputs.get(key)
+            if outputs is not None:
+                self._outputs.move_to_end(key)
+        if outputs is None:
+            outputs = self.backbone(samples)
+            with self._lock:
+                self._outputs[key] = outputs
+                while len(self._outputs) > self.max_entries:
+                    self._outputs.popitem(last=False)
+        features, poss = outputs
+        # GroundingDINO appends extra levels to these lists, so hand out copies
+        return list(features), list(poss)
+
+    def clear(self):
+        with self._lock:
+            self._outputs.clear()
+
+
+class DetectionCache:
+    """
+    Phrase-level cache of GroundingDINO detections.
+
+    Detections are cached per (image hash, phrase, box threshold, text threshold). A class
+    list is answered by merging the per-phrase detections, so follow-up queries on a scene
+    only run detection for phrases not seen before, and that run reuses the cached image
+    backbone features. All missing phrases go through one ``predict_with_classes`` call, and
+    its boxes are split by class_id into per-phrase entries; boxes GroundingDINO could not
+    attribute to any phrase are dropped. The forward runs outside the cache lock, so two
+    threads missing the same phrase may both detect it, and the later result is kept.
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._detections = OrderedDict()  # key -> (xyxy, confidence)
+        self._lock = threading.Lock()
+
+    def predict_with_classes(
+            self,
+            model,
+            image: np.ndarray,
+            classes: List[str],
+            box_threshold: float,
+            text_threshold: float
+    ) -> sv.Detections:
+        """
+        Drop-in replacement for ``model.predict_with_classes`` backed by the cache.
+
+        Returns:
+        - sv.Detections: Detections of all classes, with class_id indexing ``classes``.
+        """
+        image_hash = helper.hash_image(image)
+        found = {}
+        with self._lock:
+            for phrase in classes:
+                key = (image_hash, phrase, box_threshold, text_threshold)
+                if key in self._detections:
+                    self._detections.move_to_end(key)
+                    found[phrase] = self._detections[key]
+                    self.hits += 1
+            missing = [phrase for phrase in dict.fromkeys(classes) if phrase not in found]
+            self.misses += len(missing)
+
+        if missing:
+            detected = self._detect_phrases(model, image, image_hash, missing, box_threshold, text_threshold)
+            found.update(detected)
+            with self._lock:
+                for phrase, detections in detected.items():
+                    self._detections[(image_hash, phrase, box_threshold, text_threshold)] = detections
+                while len(self._detections) > self.max_entries:
+                    self._detections.popitem(last=False)
+
+        xyxy, confidence, class_id = [], [], []
+        for index, phrase in enumerate(classes):
+            phrase_xyxy, phrase_confidence = found[phrase]
+            xyxy.append(phrase_xyxy)
+            confidence.append(phrase_confidence)
+            class_id.append(np.full(len(phrase_xyxy), index, dtype=int))
+
+        return sv.Detections(
+            xyxy=np.concatenate(xyxy).reshape(-1, 4) if xyxy else np.zeros((0, 4), dtype=np.float32),
+            confidence=np.concatenate(confidence) if confidence else np.zeros(0, dtype=np.float32),
+            class_id=np.concatenate(class_id) if class_id else np.zeros(0, dtype=int)
+        )
+
+    @staticmethod
+    def _detect_phrases(model, image, image_hash, phrases, box_threshold, text_threshold):
+        """
+        Detect ``phrases`` in one forward pass.
+
+        Returns:
+        - dict: phrase -> (xyxy, confidence) of the boxes assigned to that phrase.
+        """
+        backbone = model.model.backbone
+        if isinstance(backbone, CachedBackbone):
+            backbone.image_key = image_hash
+        try:
+            detections = model.predict_with_classes(
+                image=image,
+                classes=phrases,
+                box_threshold=box_threshold,
+                text_threshold=text_threshold
+            )
+        finally:
+            if isinstance(backbone, CachedBackbone):
+                backbone.image_key = None
+        xyxy = detections.xyxy.astype(np.float32)
+        confidence = detections.confidence.astype(np.float32)
+        # class_id is None for boxes whose predicted phrase matches none of the classes
+        class_id = np.array([-1 if index is None else index for index in detections.class_id], dtype=int)
+        return {
+            phrase: (xyxy[class_id == index], confidence[class_id == index])
+            for index, phrase in enumerate(phrases)
+        }
+
+    def clear(self):
+        with self._lock:
+            self._detections.clear()
+
+
+# Shared by every GroundedSAM.
+DETECTION_CACHE = DetectionCache(max_entries=int(os.getenv("GLOMA_DETECTION_CACHE_SIZE", "256")))
@@ -0,0 +1,132 @@
+from typing import List, Optional
+
+import numpy as np
+import supervision as sv
+import torch
+import torchvision
+
+from compact_mask import CompactMask
+
+
+class DetectionSet:
+    """
+    Struct-of-arrays view of the detections of one image.
+
+    Every field is a single array indexed by detection; ``class_index[c]`` is the row of the
+    most confident detection of class ``c`` (or -1 when the class was not found), so callers
+    look up one object per class without scanning the detections.
+
+    Attributes:
+    - xyxy (np.ndarray): (N, 4) float32 boxes.
+    - confidence (np.ndarray): (N,) float32 scores.
+    - class_id (np.ndarray): (N,) int indices into ``class_names``.
+    - mask (list or None): N CompactMask, filled in once SAM has run.
+    - class_names (list): The class prompt.
+    - class_index (np.ndarray): (len(class_names),) int row of the best detection per class, or -1.
+    """
+
+    def __init__(self, xyxy, confidence, class_id, class_names, mask=None):
+        self.xyxy = xyxy
+        self.confidence = confidence
+        self.class_id = class_id
+        self.class_names = list(class_names)
+        self.mask = mask
+        self.class_index = self._build_class_index()
+
+    def _build_class_index(self) -> np.ndarray:
+        class_index = np.full(len(self.class_names), -1, dtype=int)
+        # the first row of each class in decreasing-confidence order is its best detection
+        order = np.argsort(-self.confidence, kind="stable")
+        classes, first = np.unique(self.class_id[order], return_index=True)
+        class_index[classes] = order[first]
+        return class_index
+
+    @classmethod
+    def from_detections(cls, detections: sv.Detections, class_names: List[str]) -> "DetectionSet":
+        mask = detections.mask
+        if mask is not None:
+            mask = [CompactMask.from_dense(m) for m in mask]
+        return cls(
+            xyxy=np.asarray(detections.xyxy, dtype=np.float32).reshape(-1, 4),
+            confidence=np.asarray(detections.confidence, dtype=np.float32).reshape(-1),
+            class_id=np.asarray(detections.class_id, dtype=int).reshape(-1),
+            class_names=class_names,
+            mask=mask
+        )
+
+    def to_detections(self, image_size=None) -> sv.Detections:
+        """
+        Converts to sv.Detections, expanding the masks to dense (N, H, W) bool arrays.
+
+        Args:
+        - image_size (tuple, optional): (H, W) of the frame, needed to shape an empty mask array.
+        """
+        mask = None
+        if self.mask:
+            mask = np.stack([m.to_dense(dtype=bool) for m in self.mask])
+        elif len(self) == 0 and image_size is not None:
+            mask = np.zeros((0, *image_size), dtype=bool)
+        return sv.Detections(xyxy=self.xyxy, confidence=self.confidence, class_id=self.class_id, mask=mask)
+
+    def __len__(self):
+        return len(self.xyxy)
+
+    def best(self, class_id: int) -> Optional[int]:
+        """
+        Returns the row of the most confident detection of ``class_id``, or None.
+        """
+        row = self.class_index[class_id]
+        return None if row < 0 else int(row)
+
+
+def postprocess_detections(
+        detections: sv.Detections,
+        class_names: List[str],
+        nms_threshold: float,
+        dedup_threshold: float = 0.9,
+        top_k: Optional[int] = None
+) -> DetectionSet:
+    """
+    Per-class NMS, cross-class deduplication and per-class top-k in one tensor pass.
+
+    Args:
+    - detections (sv.Detections): Raw GroundingDINO detections with class ids indexing ``class_names``.
+    - class_names (list): The class prompt.
+    - nms_threshold (float): IoU above which boxes of the same class suppress each other.
+    - dedup_threshold (float): IoU above which boxes of different classes are taken to be the same
+      object; only the more confident label is kept.
+    - top_k (int, optional): Maximum detections kept per class. All survivors are kept when None.
+
+    Returns:
+    - DetectionSet: The surviving detections, most confident first, gathered with a single index.
+    """
+    boxes = torch.from_numpy(np.asarray(detections.xyxy, dtype=np.float32).reshape(-1, 4))
+    scores = torch.from_numpy(np.asarray(detections.confidence, dtype=np.float32).reshape(-1))
+    class_ids = torch.from_numpy(np.asarray(detections.class_id, dtype=np.int64).reshape(-1))
+
+    # 1. NMS within each class; indices come back sorted by decreasing score
+    keep = torchvision.ops.batched_nms(boxes, scores, class_ids, nms_threshold)
+
+    # 2. the same object matched by two phrases: keep the more confident label
+    if len(keep) > 1:
+        keep = keep[torchvision.ops.nms(boxes[keep], scores[keep], dedup_threshold)]
+
+    # 3. top-k per class: a stable sort by class keeps each class group in score order,
+    #    so a detection's rank is its offset from the start of its group
+    if top_k is not None and len(keep):
+        kept_classes = class_ids[keep]
+        by_class = torch.sort(kept_classes, stable=True).indices
+        sorted_classes = kept_classes[by_class]
+        rank = torch.arange(len(keep)) - torch.searchsorted(sorted_classes, sorted_classes)
+        in_top_k = torch.zeros(len(keep), dtype=torch.bool)
+        in_top_k[by_class] = rank < top_k
+        keep = keep[in_top_k]
+
+    keep = keep.numpy()
+    return DetectionSet(
+        xyxy=boxes.numpy()[keep],
+        confidence=scores.numpy()[keep],
+        class_id=class_ids.numpy()[keep].astype(int),
+        class_names=class_names,
+        mask=[CompactMask.from_dense(detections.mask[i]) for i in keep] if detections.mask is not None else None
+    )
@@ -4,6 +4,7 @@ from pathlib import Path
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "submodules/GLIGEN"))
 
 import argparse
+import threading
 from PIL import Image, ImageDraw
 from omegaconf import OmegaConf
 from ldm.models.diffusion.ddim import DDIMSampler
@@ -23,8 +24,11 @@ import torchvision.transforms.functional as F
 import torchvision.transforms.functional as TF
 import torchvision.transforms as transforms
 import cv2
+from model_registry import MODEL_REGISTRY
 
 device = "cuda"
+CLIP_VERSION = "openai/clip-vit-large-patch14"
+PROJECTION_MATRIX_PATH = '../submodules/GLIGEN/projection_matrix'
 
 
 def set_alpha_scale(model, alpha_scale):
@@ -112,9 +116,39 @@ def load_ckpt(ckpt_path):
     text_encoder.load_state_dict(filtered_state_dict)
     diffusion.load_state_dict(saved_ckpt["diffusion"])
 
+    # UNetModel.forward asks it for the null grounding input of the unconditional guidance pass
+    model.grounding_tokenizer_input = instantiate_from_config(config['grounding_tokenizer_input'])
+    # set_alpha_scale mutates the model on every step, so jobs sharing it sample one at a time
+    model.sampling_lock = threading.Lock()
+
     return model, autoencoder, text_encoder, diffusion, config
 
 
+def get_gligen_models(ckpt_path):
+    """
+    Returns the shared (model, autoencoder, text_encoder, diffusion, config) for a GLIGEN checkpoint.
+    """
+    key = ("gligen", os.path.abspath(ckpt_path), device)
+    return MODEL_REGISTRY.get(key, lambda: load_ckpt(ckpt_path))
+
+
+def get_clip_model(version=CLIP_VERSION):
+    """
+    Returns the shared (CLIPModel, CLIPProcessor) pair used to embed grounding phrases and images.
+    """
+    def _load():
+        model = CLIPModel.from_pretrained(version).to(device).eval()
+        processor = CLIPProcessor.from_pretrained(version)
+        return model, processor
+
+    return MODEL_REGISTRY.get(("clip", version, device), _load)
+
+
+def get_projection_matrix(path=PROJECTION_MATRIX_PATH):
+    key = ("clip_projection", os.path.abspath(path), device)
+    return MODEL_REGISTRY.get(key, lambda: torch.load(path).to(device))
+
+
 
 
 def project(x, projection_matrix):
@@ -154,7 +188,7 @@ def get_clip_feature(model, processor, input, is_image=False):
         feature = outputs.image_embeds 
         if which_layer_image == 'after_reproject':
             # print("Your current path is: ", os.getcwd())
-            feature = project(feature, torch.load('../submodules/GLIGEN/projection_matrix').cuda().T).squeeze(0)
+            feature = project(feature, get_projection_matrix().T).squeeze(0)
             feature = (feature / feature.norm()) * 28.7 
             feature = feature.unsqueeze(0)
 
@@ -192,9 +226,7 @@ def prepare_batch(meta, batch=1, max_objs=30):
     images = [None]*len(phrases) if images==None else images 
     phrases = [None]*len(images) if phrases==None else phrases 
 
-    version = "openai/clip-vit-large-patch14"
-    model = CLIPModel.from_pretrained(version).cuda()
-    processor = CLIPProcessor.from_pretrained(version)
+    model, processor = get_clip_model()
 
     boxes = torch.zeros(max_objs, 4)
     masks = torch.zeros(max_objs)
@@ -396,10 +428,9 @@ def run(
     debug_mode
 ):
     # - - - - - prepare models - - - - - # 
-    model, autoencoder, text_encoder, diffusion, config = load_ckpt(meta["ckpt"])
+    model, autoencoder, text_encoder, diffusion, config = get_gligen_models(meta["ckpt"])
 
-    grounding_tokenizer_input = instantiate_from_config(config['grounding_tokenizer_input'])
-    model.grounding_tokenizer_input = grounding_tokenizer_input
+    grounding_tokenizer_input = model.grounding_tokenizer_input
     
     grounding_downsampler_input = None
     if "grounding_downsampler_input" in config:
@@ -495,7 +526,8 @@ def run(
     # - - - - - start sampling - - - - - #
     shape = (batch_size, model.in_channels, model.image_size, model.image_size)
 
-    samples_fake = sampler.sample(S=steps, shape=shape, input=input,  uc=uc, guidance_scale=guidance_scale, mask=inpainting_mask, x0=z0)
+    with model.sampling_lock:
+        samples_fake = sampler.sample(S=steps, shape=shape, input=input,  uc=uc, guidance_scale=guidance_scale, mask=inpainting_mask, x0=z0)
     samples_fake = autoencoder.decode(samples_fake)
 
     # - - - - - save images - - - - - #
@@ -1,7 +1,8 @@
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Tuple
 
 import numpy as np
-import supervision as sv
+from detection_postprocess import DetectionSet
 from gligen_inference import generate_new_img
 from LLM.llm_factory import LLMFactory
 from LLM.llm_input_prompt import BOUNDING_BOX_PROMPT, OBJECT_PROMPT
@@ -23,7 +24,14 @@ class GLOMA:
             debug_mode=False,
             dilution_factor=30,
             starting_noise=None,
-            guidance_scale=7.5
+            guidance_scale=7.5,
+            sam_encoder_version=None,
+            speculative_bbox=False,
+            lama_roi=False,
+            lama_max_tile_size=None,
+            lama_precision="fp32",
+            lama_channels_last=False,
+            lama_device=None
     ):
         self.action_prompt = action_prompt
         self.box_threshold = box_threshold
@@ -35,7 +43,18 @@ class GLOMA:
         self.dilution_factor = dilution_factor
         self.starting_noise = starting_noise
         self.guidance_scale = guidance_scale
-    
+        self.sam_encoder_version = sam_encoder_version
+        # Query the new bbox right after detection, concurrently with LaMa inpainting.
+        self.speculative_bbox = speculative_bbox
+        # Inpaint only a context window around the object of motion instead of the full frame.
+        self.lama_roi = lama_roi
+        # Inpaint images larger than this in overlapping tiles to bound LaMa's memory.
+        self.lama_max_tile_size = lama_max_tile_size
+        # LaMa precision mode (fp32, bf16 or fp16) and NHWC memory format.
+        self.lama_precision = lama_precision
+        self.lama_channels_last = lama_channels_last
+        # Device for LaMa; None picks CUDA when available and the CPU otherwise.
+        self.lama_device = lama_device
 
     def get_object_names(self) -> Tuple[str, List[str]]:
         """
@@ -44,26 +63,43 @@ class GLOMA:
         - obj_of_reference: [object of references]
         """
         llm_object = LLMFactory.create_chat_object(self.llm_choice)
-        obj_separation = llm_object.query_message(OBJECT_PROMPT.format(action_prompt=self.action_prompt))
+        obj_separation = llm_object.query_message(OBJECT_PROMPT.format(action_prompt=self.action_prompt), schema="object")
         obj_of_motion, obj_of_reference = helper.parse_input(obj_separation)
         return obj_of_motion, obj_of_reference
 
-    def grounded_sam_detections(self, class_prompt: List[str]) -> sv.Detections:
+    def grounded_sam_detections(self, class_prompt: List[str]) -> DetectionSet:
         """
         Get bbox, masks from SAM
 
         Returns:
-        - detections: Detection object
+        - detections: DetectionSet
         """
-        grounded_sam = GroundedSAM(self.rgb_image, class_prompt, self.box_threshold, self.text_threshold, self.nms_threshold)
+        grounded_sam = GroundedSAM(
+            self.rgb_image,
+            class_prompt,
+            self.box_threshold,
+            self.text_threshold,
+            self.nms_threshold,
+            sam_encoder_version=self.sam_encoder_version
+        )
         detections, class_prompt = grounded_sam.get_detections()
         return detections, class_prompt
     
+    def build_remover(self, rgb_image: np.ndarray, detections: DetectionSet, class_prompt: List[str]) -> ObjectRemoval:
+        """
+        Returns an ObjectRemoval for the detections, with this job's dilation and LaMa settings.
+        """
+        return ObjectRemoval(rgb_image, detections, class_prompt, self.dilution_factor,
+                             lama_roi=self.lama_roi, lama_max_tile_size=self.lama_max_tile_size,
+                             lama_precision=self.lama_precision, lama_channels_last=self.lama_channels_last,
+                             lama_device=self.lama_device)
+
     def remove_object(
         self,
         rgb_image: np.ndarray,
-        detections: sv.Detections,
-        class_prompt: List[str]
+        detections: DetectionSet,
+        class_prompt: List[str],
+        remover: ObjectRemoval = None
     ) -> Tuple[np.ndarray, np.ndarray, Dict, Dict]:
 
         """
@@ -78,8 +114,9 @@ class GLOMA:
 
         Parameters:
         - rgb_image (np.ndarray): The input RGB image.
-        - detections (sv.Detections): The detection data for objects in the image.
+        - detections (DetectionSet): The detection data for objects in the image.
         - class_prompt (List[str]): Class prompt information guiding the detections.
+        - remover (ObjectRemoval, optional): An ObjectRemoval already built from the detections.
 
         Returns:
         - tuple: 
@@ -103,7 +140,8 @@ class GLOMA:
         """
 
         # 1. create ObjectRemoval object
-        remover = ObjectRemoval(rgb_image, detections, class_prompt, self.dilution_factor)
+        if remover is None:
+            remover = self.build_remover(rgb_image, detections, class_prompt)
         if self.debug_mode:
             # DEBUG: visualize objs_of_reference
             helper.draw_masks(rgb_image, list(remover.masks["objs_of_reference"].values()))
@@ -141,7 +179,7 @@ class GLOMA:
             action_prompt=self.action_prompt,
             obj_of_motion_box=obj_of_motion_bbox,
             objs_of_reference_boxes=objs_of_reference_bbox
-        ))
+        ), schema="bbox")
         return helper.parse_bbox(predicted_bbox)
         
     def run_gloma(self):
@@ -159,12 +197,25 @@ class GLOMA:
             helper.draw_bounding_boxes(self.rgb_image, detections, name="detected_bounding_boxes.jpg")
 
         # 3. Object Removal
-        inpainted_image, obj_of_motion_image, obj_of_motion_bbox, objs_of_reference_bbox = self.remove_object(self.rgb_image, detections, class_prompt)
-        print("object of motion BBOX: ", obj_of_motion_bbox)
-        print("object of reference BBOX: ", objs_of_reference_bbox)
-
-        # 4. Predict new bbox
-        predicted_bbox = self.predict_new_bbox(obj_of_motion_bbox, objs_of_reference_bbox)
+        # 4. Predict new bbox (overlapped with 3. in speculative mode)
+        if self.speculative_bbox:
+            # The bboxes only depend on the detections, so the LLM query can run while LaMa inpaints.
+            remover = self.build_remover(self.rgb_image, detections, class_prompt)
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                bbox_future = executor.submit(
+                    self.predict_new_bbox,
+                    remover.get_obj_of_motion_bbox(),
+                    remover.get_objs_of_reference_bboxes()
+                )
+                inpainted_image, obj_of_motion_image, obj_of_motion_bbox, objs_of_reference_bbox = self.remove_object(self.rgb_image, detections, class_prompt, remover=remover)
+                print("object of motion BBOX: ", obj_of_motion_bbox)
+                print("object of reference BBOX: ", objs_of_reference_bbox)
+                predicted_bbox = bbox_future.result()
+        else:
+            inpainted_image, obj_of_motion_image, obj_of_motion_bbox, objs_of_reference_bbox = self.remove_object(self.rgb_image, detections, class_prompt)
+            print("object of motion BBOX: ", obj_of_motion_bbox)
+            print("object of reference BBOX: ", objs_of_reference_bbox)
+            predicted_bbox = self.predict_new_bbox(obj_of_motion_bbox, objs_of_reference_bbox)
         print("predicted bbox: ", predicted_bbox)
         if self.debug_mode:
             # DEBUG: visualize predicted bbox
@@ -172,6 +223,15 @@ class GLOMA:
 
 
         # 5. Generate new image (GLIGEN)
+        return self.generate_image(inpainted_image, obj_of_motion_image, predicted_bbox)
+
+    def generate_image(self, inpainted_image: np.ndarray, obj_of_motion_image: np.ndarray, predicted_bbox: List[float]) -> List[np.ndarray]:
+        """
+        Place the object of motion at the predicted bounding box with GLIGEN.
+
+        Returns:
+        - list: batch_size generated images in OpenCV format.
+        """
         # convert bbox to relative coordinates
         predicted_bbox = helper.convert_bbox_to_relative_coordinates(predicted_bbox, inpainted_image.shape)
         return generate_new_img(
@@ -183,6 +243,3 @@ class GLOMA:
             guidance_scale=self.guidance_scale,
             debug_mode=self.debug_mode
         )
-
-
-
@@ -0,0 +1,191 @@
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+from gloma import GLOMA
+from utils import helper
+
+# Stage names in execution order.
+STAGES = ("llm_parse", "detection", "removal", "llm_bbox", "generation")
+
+# The LLM stages wait on the network and can run many requests at once; the model
+# stages share one accelerator and run one job at a time by default. Extra generation
+# workers only overlap GLIGEN's text encoding and decoding: jobs on the same GLIGEN
+# model take turns for the sampling loop (see gligen_inference.run).
+DEFAULT_CONCURRENCY = {
+    "llm_parse": 4,
+    "detection": 1,
+    "removal": 1,
+    "llm_bbox": 4,
+    "generation": 1,
+}
+
+_STOP = object()
+
+
+class _PipelineJob:
+    def __init__(self, gloma: GLOMA, bbox_executor: ThreadPoolExecutor):
+        self.gloma = gloma
+        self.bbox_executor = bbox_executor
+        self.future = Future()
+        self.obj_of_motion = None
+        self.objs_of_reference = None
+        self.detections = None
+        self.class_prompt = None
+        self.inpainted_image = None
+        self.obj_of_motion_image = None
+        self.obj_of_motion_bbox = None
+        self.objs_of_reference_bbox = None
+        self.predicted_bbox = None
+        self.bbox_future = None
+
+
+def _llm_parse(job: _PipelineJob):
+    job.obj_of_motion, job.objs_of_reference = job.gloma.get_object_names()
+
+
+def _detection(job: _PipelineJob):
+    job.detections, job.class_prompt = job.gloma.grounded_sam_detections(
+        class_prompt=[job.obj_of_motion] + job.objs_of_reference
+    )
+    if job.gloma.debug_mode:
+        helper.draw_bounding_boxes(job.gloma.rgb_image, job.detections, name="detected_bounding_boxes.jpg")
+
+
+def _removal(job: _PipelineJob):
+    gloma = job.gloma
+    remover = gloma.build_remover(gloma.rgb_image, job.detections, job.class_prompt)
+    if gloma.speculative_bbox:
+        # the boxes only depend on the detections, so the bbox query runs while LaMa inpaints
+        job.bbox_future = job.bbox_executor.submit(
+            gloma.predict_new_bbox, remover.get_obj_of_motion_bbox(), remover.get_objs_of_reference_bboxes()
+        )
+    (
+        job.inpainted_image,
+        job.obj_of_motion_image,
+        job.obj_of_motion_bbox,
+        job.objs_of_reference_bbox
+    ) = gloma.remove_object(gloma.rgb_image, job.detections, job.class_prompt, remover=remover)
+
+
+def _llm_bbox(job: _PipelineJob):
+    if job.bbox_future is not None:
+        job.predicted_bbox = job.bbox_future.result()
+    else:
+        job.predicted_bbox = job.gloma.predict_new_bbox(job.obj_of_motion_bbox, job.objs_of_reference_bbox)
+    if job.gloma.debug_mode:
+        helper.draw_predicted_bbox(job.inpainted_image, job.predicted_bbox, "predicted_bbox.jpg")
+
+
+def _generation(job: _PipelineJob):
+    result_images = job.gloma.generate_image(job.inpainted_image, job.obj_of_motion_image, job.predicted_bbox)
+    job.future.set_result(result_images)
+
+
+_STAGE_FUNCTIONS = {
+    "llm_parse": _llm_parse,
+    "detection": _detection,
+    "removal": _removal,
+    "llm_bbox": _llm_bbox,
+    "generation": _generation,
+}
+
+
+class GLOMAPipeline:
+    """
+    Runs many GLOMA jobs with their stages overlapped.
+
+    Every stage has its own bounded queue and its own pool of worker threads, so job N+1's
+    LLM call runs while job N is in detection, inpainting or diffusion. A full queue blocks
+    the stage feeding it, which bounds the number of jobs (and intermediate images) in flight.
+    Jobs with ``speculative_bbox`` start their bounding box query when removal starts, on up
+    to ``concurrency["llm_bbox"]`` extra threads, and the llm_bbox stage only collects it.
+
+    Example:
+        pipeline = GLOMAPipeline(concurrency={"llm_parse": 8})
+        futures = [pipeline.submit(gloma) for gloma in glomas]
+        results = [future.result() for future in futures]
+        pipeline.shutdown()
+    """
+
+    def __init__(self, concurrency: Optional[Dict[str, int]] = None, queue_size: int = 2):
+        """
+        Args:
+        - concurrency (dict, optional): Number of workers per stage, overriding DEFAULT_CONCURRENCY.
+        - queue_size (int): Capacity of each stage's input queue.
+        """
+        self.concurrency = dict(DEFAULT_CONCURRENCY)
+        if concurrency:
+            unknown = set(concurrency) - set(STAGES)
+            if unknown:
+                raise ValueError(f"Unknown pipeline stages: {sorted(unknown)}")
+            self.concurrency.update(concurrency)
+
+        self.queues = {stage: queue.Queue(maxsize=queue_size) for stage in STAGES}
+        self._bbox_executor = ThreadPoolExecutor(
+            max_workers=self.concurrency["llm_bbox"], thread_name_prefix="gloma-speculative-bbox"
+        )
+        self.workers = {stage: [] for stage in STAGES}
+        for i, stage in enumerate(STAGES):
+            next_stage = STAGES[i + 1] if i + 1 < len(STAGES) else None
+            for n in range(self.concurrency[stage]):
+                worker = threading.Thread(
+                    target=self._work,
+                    args=(stage, next_stage),
+                    name=f"gloma-{stage}-{n}",
+                    daemon=True
+                )
+                worker.start()
+                self.workers[stage].append(worker)
+
+    def _work(self, stage: str, next_stage: Optional[str]):
+        stage_function = _STAGE_FUNCTIONS[stage]
+        in_queue = self.queues[stage]
+        while True:
+            job = in_queue.get()
+            if job is _STOP:
+                break
+            try:
+                stage_function(job)
+            except Exception as e:
+                job.future.set_exception(e)
+                continue
+            if next_stage is not None:
+                self.queues[next_stage].put(job)
+
+    def submit(self, gloma: GLOMA) -> Future:
+        """
+        Queue a GLOMA job. Blocks while the first stage's queue is full.
+
+        Returns:
+        - Future: Resolves to the generated images, as returned by GLOMA.run_gloma.
+        """
+        job = _PipelineJob(gloma, self._bbox_executor)
+        job.future.set_running_or_notify_cancel()
+        self.queues[STAGES[0]].put(job)
+        return job.future
+
+    def map(self, glomas: Iterable[GLOMA]) -> List:
+        """
+        Run all jobs through the pipeline and return their results in submission order.
+        """
+        futures = [self.submit(gloma) for gloma in glomas]
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        """
+        Let queued jobs finish, then stop every worker.
+        """
+        for stage in STAGES:
+            for _ in self.workers[stage]:
+                self.queues[stage].put(_STOP)
+            for worker in self.workers[stage]:
+                worker.join()
+        self._bbox_executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
@@ -13,11 +13,6 @@ import traceback
 
 from saicinpainting.evaluation.utils import move_to_device
 from saicinpainting.evaluation.refinement import refine_predict
-os.environ['OMP_NUM_THREADS'] = '1'
-os.environ['OPENBLAS_NUM_THREADS'] = '1'
-os.environ['MKL_NUM_THREADS'] = '1'
-os.environ['VECLIB_MAXIMUM_THREADS'] = '1'
-os.environ['NUMEXPR_NUM_THREADS'] = '1'
 
 import cv2
 import hydra
@@ -30,7 +25,7 @@ from torch.utils.data._utils.collate import default_collate
 
 from saicinpainting.training.data.datasets import make_default_val_dataset
 from saicinpainting.training.trainers import load_checkpoint
-from saicinpainting.utils import register_debug_signal_handlers
+from saicinpainting.utils import register_debug_signal_handlers, setup_inference_device
 
 LOGGER = logging.getLogger(__name__)
 
@@ -40,7 +35,9 @@ def main(predict_config: OmegaConf):
     try:
         register_debug_signal_handlers()  # kill -10 <pid> will result in traceback dumped into log
 
-        device = torch.device(predict_config.device)
+        device = setup_inference_device(predict_config.device,
+                                        intra_op_threads=predict_config.get('intra_op_threads'),
+                                        inter_op_threads=predict_config.get('inter_op_threads'))
 
         train_config_path = os.path.join(predict_config.model.path, 'config.yaml')
         with open(train_config_path, 'r') as f:
@@ -75,7 +72,10 @@ def main(predict_config: OmegaConf):
                 assert 'unpad_to_size' in batch, "Unpadded size is required for the refinement"
                 # image unpadding is taken care of in the refiner, so that output image
                 # is same size as the input image
-                cur_res = refine_predict(batch, model, **predict_config.refiner)
+                refiner_config = dict(predict_config.refiner)
+                if device.type == 'cpu':
+                    refiner_config['gpu_ids'] = 'cpu'
+                cur_res = refine_predict(batch, model, **refiner_config)
                 cur_res = cur_res[0].permute(1,2,0).detach().cpu().numpy()
             else:
                 with torch.no_grad():
@@ -13,12 +13,6 @@ import traceback
 
 from saicinpainting.evaluation.utils import move_to_device
 
-os.environ['OMP_NUM_THREADS'] = '1'
-os.environ['OPENBLAS_NUM_THREADS'] = '1'
-os.environ['MKL_NUM_THREADS'] = '1'
-os.environ['VECLIB_MAXIMUM_THREADS'] = '1'
-os.environ['NUMEXPR_NUM_THREADS'] = '1'
-
 import cv2
 import hydra
 import numpy as np
@@ -30,7 +24,7 @@ from torch.utils.data._utils.collate import default_collate
 
 from saicinpainting.training.data.datasets import make_default_val_dataset
 from saicinpainting.training.trainers import load_checkpoint, DefaultInpaintingTrainingModule
-from saicinpainting.utils import register_debug_signal_handlers, get_shape
+from saicinpainting.utils import register_debug_signal_handlers, get_shape, setup_inference_device
 
 LOGGER = logging.getLogger(__name__)
 
@@ -40,14 +34,16 @@ def main(predict_config: OmegaConf):
     try:
         register_debug_signal_handlers()  # kill -10 <pid> will result in traceback dumped into log
 
-        device = torch.device(predict_config.device)
+        device = setup_inference_device(predict_config.device,
+                                        intra_op_threads=predict_config.get('intra_op_threads'),
+                                        inter_op_threads=predict_config.get('inter_op_threads'))
 
         train_config_path = os.path.join(predict_config.model.path, 'config.yaml')
         with open(train_config_path, 'r') as f:
             train_config = OmegaConf.create(yaml.safe_load(f))
 
         checkpoint_path = os.path.join(predict_config.model.path, 'models', predict_config.model.checkpoint)
-        model = load_checkpoint(train_config, checkpoint_path, strict=False)
+        model = load_checkpoint(train_config, checkpoint_path, strict=False, map_location='cpu')
         model.freeze()
         model.to(device)
 
@@ -1,7 +1,9 @@
+from functools import lru_cache
+
 import torch
 import torch.nn as nn
 from torch.optim import Adam, SGD 
-from kornia.filters import gaussian_blur2d
+from kornia.filters import get_gaussian_kernel1d
 from kornia.geometry.transform import resize
 from kornia.morphology import erosion
 from torch.nn import functional as F
@@ -16,12 +18,32 @@ from saicinpainting.training.modules.pix2pixhd import ResnetBlock
 from tqdm import tqdm
 
 
+@lru_cache(maxsize=None)
+def _gaussian_kernel(channels : int, device : torch.device, dtype : torch.dtype, kernel_size : int=5, sigma : float=1.0):
+    """depthwise (channels,1,k,k) gaussian kernel of the pyramid downsamplers, built once per device"""
+    kernel1d = get_gaussian_kernel1d(kernel_size, sigma).reshape(-1)
+    kernel2d = torch.outer(kernel1d, kernel1d)
+    return kernel2d.expand(channels, 1, kernel_size, kernel_size).to(device=device, dtype=dtype).contiguous()
+
+def _gaussian_blur(im : torch.Tensor, kernel_size : int=5, sigma : float=1.0):
+    """same as kornia's gaussian_blur2d with reflect borders, with a cached kernel"""
+    kernel = _gaussian_kernel(im.shape[1], im.device, im.dtype, kernel_size, sigma)
+    pad = kernel_size // 2
+    im = F.pad(im, (pad, pad, pad, pad), mode='reflect')
+    return F.conv2d(im, kernel, groups=im.shape[1])
+
+@lru_cache(maxsize=None)
+def _erosion_kernel(device : torch.device, size : int=15):
+    """elliptic structuring element used to erode the downscaled masks, built once per device"""
+    ekernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size)).astype(bool)
+    return torch.from_numpy(ekernel).float().to(device)
+
 def _pyrdown(im : torch.Tensor, downsize : tuple=None):
     """downscale the image"""
     if downsize is None:
         downsize = (im.shape[2]//2, im.shape[3]//2)
     assert im.shape[1] == 3, "Expected shape for the input to be (n,3,height,width)"
-    im = gaussian_blur2d(im, kernel_size=(5,5), sigma=(1.0,1.0))
+    im = _gaussian_blur(im)
     im = F.interpolate(im, size=downsize, mode='bilinear', align_corners=False)
     return im
 
@@ -51,51 +73,52 @@ def _pyrdown_mask(mask : torch.Tensor, downsize : tuple=None, eps : float=1e-8,
         downsize = (mask.shape[2]//2, mask.shape[3]//2)
     assert mask.shape[1] == 1, "Expected shape for the input to be (n,1,height,width)"
     if blur_mask == True:
-        mask = gaussian_blur2d(mask, kernel_size=(5,5), sigma=(1.0,1.0))
+        mask = _gaussian_blur(mask)
         mask = F.interpolate(mask, size=downsize,  mode='bilinear', align_corners=False)
     else:
         mask = F.interpolate(mask, size=downsize,  mode='bilinear', align_corners=False)
-    if round_up:
-        mask[mask>=eps] = 1
-        mask[mask<eps] = 0
-    else:
-        mask[mask>=1.0-eps] = 1
-        mask[mask<1.0-eps] = 0
-    return mask
+    # binarize without boolean indexing, which would synchronize with the device
+    threshold = eps if round_up else 1.0 - eps
+    return (mask >= threshold).to(mask.dtype)
 
 def _erode_mask(mask : torch.Tensor, ekernel : torch.Tensor=None, eps : float=1e-8):
     """erode the mask, and set gray pixels to 0"""
     if ekernel is not None:
         mask = erosion(mask, ekernel)
-        mask[mask>=1.0-eps] = 1
-        mask[mask<1.0-eps] = 0
+        mask = (mask >= 1.0 - eps).to(mask.dtype)
     return mask
 
 
+def _masked_mean(values : torch.Tensor, weights : torch.Tensor):
+    """per-sample mean of values over the pixels where weights is 1"""
+    dims = tuple(range(1, values.dim()))
+    return (values * weights).sum(dim=dims) / weights.sum(dim=dims).clamp_min(1)
+
 def _l1_loss(
     pred : torch.Tensor, pred_downscaled : torch.Tensor, ref : torch.Tensor, 
     mask : torch.Tensor, mask_downscaled : torch.Tensor, 
     image : torch.Tensor, on_pred : bool=True
     ):
-    """l1 loss on src pixels, and downscaled predictions if on_pred=True"""
-    loss = torch.mean(torch.abs(pred[mask<1e-8] - image[mask<1e-8]))
+    """per-sample l1 loss on src pixels, and downscaled predictions if on_pred=True"""
+    loss = _masked_mean(torch.abs(pred - image), (mask < 1e-8).to(pred.dtype))
     if on_pred: 
-        loss += torch.mean(torch.abs(pred_downscaled[mask_downscaled>=1e-8] - ref[mask_downscaled>=1e-8]))                
+        loss = loss + _masked_mean(torch.abs(pred_downscaled - ref), (mask_downscaled >= 1e-8).to(pred.dtype))
     return loss
 
 def _infer(
     image : torch.Tensor, mask : torch.Tensor, 
     forward_front : nn.Module, forward_rears : nn.Module, 
     ref_lower_res : torch.Tensor, orig_shape : tuple, devices : list, 
-    scale_ind : int, n_iters : int=15, lr : float=0.002):
+    scale_ind : int, n_iters : int=15, lr : float=0.002,
+    early_stop_patience : int=None, early_stop_tol : float=1e-3):
     """Performs inference with refinement at a given scale.
 
     Parameters
     ----------
     image : torch.Tensor
-        input image to be inpainted, of size (1,3,H,W)
+        input image to be inpainted, of size (B,3,H,W)
     mask : torch.Tensor
-        input inpainting mask, of size (1,1,H,W) 
+        input inpainting mask, of size (B,1,H,W) 
     forward_front : nn.Module
         the front part of the inpainting network
     forward_rears : nn.Module
@@ -112,6 +135,11 @@ def _infer(
         number of iterations of refinement, by default 15
     lr : float, optional
         learning rate, by default 0.002
+    early_stop_patience : int, optional
+        a sample stops refining once its loss has not improved by early_stop_tol (relative)
+        for this many iterations; all iterations are run if None, by default None
+    early_stop_tol : float, optional
+        minimum relative improvement of the loss, by default 1e-3
 
     Returns
     -------
@@ -128,14 +156,27 @@ def _infer(
         z1,z2 = forward_front(masked_image)
     # Inference
     mask = mask.to(devices[-1])
-    ekernel = torch.from_numpy(cv2.getStructuringElement(cv2.MORPH_ELLIPSE,(15,15)).astype(bool)).float()
-    ekernel = ekernel.to(devices[-1])
     image = image.to(devices[-1])
     z1, z2 = z1.detach().to(devices[0]), z2.detach().to(devices[0])
     z1.requires_grad, z2.requires_grad = True, True
 
     optimizer = Adam([z1,z2], lr=lr)
 
+    if ref_lower_res is not None:
+        # the mask does not change between iterations, so its downscaled version is built once
+        mask_downscaled = _pyrdown_mask(mask[:,:1,:orig_shape[0],:orig_shape[1]], blur_mask=False, round_up=False)
+        mask_downscaled = _erode_mask(mask_downscaled, ekernel=_erosion_kernel(mask.device))
+        mask_downscaled = mask_downscaled.repeat(1,3,1,1)
+
+    # Per-sample early stopping. The state stays on the device; the host only looks at it
+    # (one sync) every check_every iterations, to end the loop once every sample has stopped.
+    n_samples = image.shape[0]
+    best_loss = torch.full((n_samples,), float('inf'), device=devices[-1])
+    n_stalled = torch.zeros(n_samples, dtype=torch.long, device=devices[-1])
+    active = torch.ones(n_samples, dtype=torch.bool, device=devices[-1])
+    stopped_pred = None
+    check_every = early_stop_patience or n_iters
+
     pbar = tqdm(range(n_iters), leave=False)
     for idi in pbar:
         optimizer.zero_grad()
@@ -155,20 +196,34 @@ def _infer(
         ######################### multi-scale #############################
         # scaled loss with downsampler
         pred_downscaled = _pyrdown(pred[:,:,:orig_shape[0],:orig_shape[1]])
-        mask_downscaled = _pyrdown_mask(mask[:,:1,:orig_shape[0],:orig_shape[1]], blur_mask=False, round_up=False)
-        mask_downscaled = _erode_mask(mask_downscaled, ekernel=ekernel)
-        mask_downscaled = mask_downscaled.repeat(1,3,1,1)
         losses["ms_l1"] = _l1_loss(pred, pred_downscaled, ref_lower_res, mask, mask_downscaled, image, on_pred=True)
 
-        loss = sum(losses.values())
-        pbar.set_description("Refining scale {} using scale {} ...current loss: {:.4f}".format(scale_ind+1, scale_ind, loss.item()))
+        loss = sum(losses.values())  # (B,)
+        if early_stop_patience:
+            n_stalled = torch.where(loss < best_loss * (1 - early_stop_tol), torch.zeros_like(n_stalled), n_stalled + 1)
+            best_loss = torch.minimum(best_loss, loss.detach())
+            stopping = active & (n_stalled >= early_stop_patience)
+            if stopped_pred is None:
+                stopped_pred = pred.detach().clone()
+            # keep the prediction of every sample at the iteration it stopped
+            stopped_pred = torch.where(stopping[:,None,None,None], pred.detach(), stopped_pred)
+            active = active & ~stopping
+        if (idi + 1) % check_every == 0 or idi == n_iters - 1:
+            mean_loss, n_active = torch.stack([loss.detach().mean(), active.sum().float()]).tolist()
+            pbar.set_description("Refining scale {} using scale {} ...current loss: {:.4f}".format(scale_ind+1, scale_ind, mean_loss))
+            if n_active == 0:
+                break
         if idi < n_iters - 1:
-            loss.backward()
+            # the samples are independent (frozen network), so summing their losses
+            # gives each sample its own gradient
+            loss.sum().backward()
             optimizer.step()
             del pred_downscaled
             del loss
             del pred
     # "pred" is the prediction after Plug-n-Play module
+    if stopped_pred is not None:
+        pred = torch.where(active[:,None,None,None], pred, stopped_pred)
     inpainted = mask * pred + (1 - mask) * image
     inpainted = inpainted.detach().cpu()
     return inpainted
@@ -193,9 +248,11 @@ def _get_image_mask_pyramid(batch : dict, min_side : int, max_scales : int, px_b
         image-mask pyramid in the form of list of images and list of masks
     """
 
-    assert batch['image'].shape[0] == 1, "refiner works on only batches of size 1!"
-
     h, w = batch['unpad_to_size']
+    h, w = torch.as_tensor(h), torch.as_tensor(w)
+    if not ((h == h[0]).all() and (w == w[0]).all()):
+        raise ValueError("refiner needs all images of a batch to have the same unpadded size, "
+                         f"got heights {h.tolist()} and widths {w.tolist()}")
     h, w = h[0].item(), w[0].item()
 
     image = batch['image'][...,:h,:w]
@@ -225,21 +282,33 @@ def _get_image_mask_pyramid(batch : dict, min_side : int, max_scales : int, px_b
     # reverse the lists because we want the lowest resolution image as index 0
     return ls_images[::-1], ls_masks[::-1]
 
+def _get_devices(gpu_ids : str):
+    """devices to split the network over: the listed GPUs, or the CPU when none is given or CUDA is not available"""
+    gpu_ids = [f'cuda:{gpuid}' for gpuid in str(gpu_ids).replace(" ","").split(",") if gpuid.isdigit()]
+    if gpu_ids and not torch.cuda.is_available():
+        print(f"CUDA is not available, refining on CPU instead of {gpu_ids}")
+        gpu_ids = []
+    if not gpu_ids:
+        return [torch.device('cpu')]
+    return [torch.device(gpu_id) for gpu_id in gpu_ids]
+
 def refine_predict(
     batch : dict, inpainter : nn.Module, gpu_ids : str, 
     modulo : int, n_iters : int, lr : float, min_side : int, 
-    max_scales : int, px_budget : int
+    max_scales : int, px_budget : int, early_stop_patience : int=3,
+    early_stop_tol : float=1e-3
     ):
     """Refines the inpainting of the network
 
     Parameters
     ----------
     batch : dict
-        image-mask batch, currently we assume the batchsize to be 1
+        image-mask batch; all images must have the same unpadded size (batch images by size)
     inpainter : nn.Module
         the inpainting neural network
     gpu_ids : str
-        the GPU ids of the machine to use. If only single GPU, use: "0,"
+        the GPU ids of the machine to use. If only single GPU, use: "0,". Use "cpu" (or no ids) to
+        refine on the CPU, which is also the fallback when CUDA is not available
     modulo : int
         pad the image to ensure dimension % modulo == 0
     n_iters : int
@@ -252,18 +321,23 @@ def refine_predict(
         max number of downscaling scales for the image-mask pyramid
     px_budget : int
         pixels budget. Any image will be resized to satisfy height*width <= px_budget
+    early_stop_patience : int
+        each sample stops refining at a scale once its loss has not improved by early_stop_tol
+        (relative) for this many iterations. Use None to always run n_iters iterations
+    early_stop_tol : float
+        minimum relative improvement of the loss that resets the patience
 
     Returns
     -------
     torch.Tensor
-        inpainted image of size (1,3,H,W)
+        inpainted images of size (B,3,H,W)
     """
 
     assert not inpainter.training
     assert not inpainter.add_noise_kwargs
     assert inpainter.concat_mask
 
-    gpu_ids = [f'cuda:{gpuid}' for gpuid in gpu_ids.replace(" ","").split(",") if gpuid.isdigit()]
+    devices = _get_devices(gpu_ids)
     n_resnet_blocks = 0
     first_resblock_ind = 0
     found_first_resblock = False
@@ -273,16 +347,14 @@ def refine_predict(
             found_first_resblock = True
         elif not found_first_resblock:
             first_resblock_ind += 1
-    resblocks_per_gpu = n_resnet_blocks // len(gpu_ids)
-
-    devices = [torch.device(gpu_id) for gpu_id in gpu_ids]
+    resblocks_per_gpu = n_resnet_blocks // len(devices)
     
     # split the model into front, and rear parts    
     forward_front = inpainter.generator.model[0:first_resblock_ind]
     forward_front.to(devices[0])
     forward_rears = []
-    for idd in range(len(gpu_ids)):
-        if idd < len(gpu_ids) - 1:
+    for idd in range(len(devices)):
+        if idd < len(devices) - 1:
             forward_rears.append(inpainter.generator.model[first_resblock_ind + resblocks_per_gpu*(idd):first_resblock_ind+resblocks_per_gpu*(idd+1)]) 
         else:
             forward_rears.append(inpainter.generator.model[first_resblock_ind + resblocks_per_gpu*(idd):]) 
@@ -305,7 +377,8 @@ def refine_predict(
         image, mask = move_to_device(image, devices[0]), move_to_device(mask, devices[0])
         if image_inpainted is not None:
             image_inpainted = move_to_device(image_inpainted, devices[-1])
-        image_inpainted = _infer(image, mask, forward_front, forward_rears, image_inpainted, orig_shape, devices, ids, n_iters, lr)
+        image_inpainted = _infer(image, mask, forward_front, forward_rears, image_inpainted, orig_shape, devices, ids, n_iters, lr,
+                                 early_stop_patience, early_stop_tol)
         image_inpainted = image_inpainted[:,:,:orig_shape[0], :orig_shape[1]]
         # detach everything to save resources
         image = image.detach().cpu()
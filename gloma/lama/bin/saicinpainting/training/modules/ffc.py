@@ -2,6 +2,8 @@
 # original implementation https://github.com/pkumivision/FFC/blob/main/model_zoo/ffc.py
 # paper https://proceedings.neurips.cc/paper/2020/file/2fd5d41ec6cfab47e32164d5624269b1-Paper.pdf
 
+from functools import lru_cache
+
 import numpy as np
 import torch
 import torch.nn as nn
@@ -46,6 +48,26 @@ class FFCSE_block(nn.Module):
         return x_l, x_g
 
 
+@lru_cache(maxsize=32)
+def _cached_spectral_coords(height, width, device, dtype):
+    coords_vert = torch.linspace(0, 1, height)[None, None, :, None].expand(1, 1, height, width)
+    coords_hor = torch.linspace(0, 1, width)[None, None, None, :].expand(1, 1, height, width)
+    return torch.cat((coords_vert, coords_hor), dim=1).to(device=device, dtype=dtype)
+
+
+def spectral_coords(batch, height, width, device, dtype):
+    """
+    (batch, 2, height, width) vertical and horizontal [0, 1] coordinate grids for spectral positional
+    encoding. Grids are built once per shape, device and dtype and expanded (not copied) to the batch.
+    """
+    if torch.jit.is_tracing():
+        # a cached tensor would be baked into the trace as a constant of the tracing resolution
+        coords_vert = torch.linspace(0, 1, height, device=device, dtype=dtype)[None, None, :, None].expand(batch, 1, height, width)
+        coords_hor = torch.linspace(0, 1, width, device=device, dtype=dtype)[None, None, None, :].expand(batch, 1, height, width)
+        return torch.cat((coords_vert, coords_hor), dim=1)
+    return _cached_spectral_coords(height, width, device, dtype).expand(batch, -1, -1, -1)
+
+
 class FourierUnit(nn.Module):
 
     def __init__(self, in_channels, out_channels, groups=1, spatial_scale_factor=None, spatial_scale_mode='bilinear',
@@ -74,6 +96,12 @@ class FourierUnit(nn.Module):
         self.fft_norm = fft_norm
 
     def forward(self, x):
+        # rFFT in half precision is numerically fragile (and unsupported for most sizes), so the
+        # spectral path always runs in fp32, also inside a bf16/fp16 autocast region
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            return self._spectral_forward(x.float())
+
+    def _spectral_forward(self, x):
         batch = x.shape[0]
 
         if self.spatial_scale_factor is not None:
@@ -90,9 +118,8 @@ class FourierUnit(nn.Module):
 
         if self.spectral_pos_encoding:
             height, width = ffted.shape[-2:]
-            coords_vert = torch.linspace(0, 1, height)[None, None, :, None].expand(batch, 1, height, width).to(ffted)
-            coords_hor = torch.linspace(0, 1, width)[None, None, None, :].expand(batch, 1, height, width).to(ffted)
-            ffted = torch.cat((coords_vert, coords_hor, ffted), dim=1)
+            coords = spectral_coords(batch, height, width, ffted.device, ffted.dtype)
+            ffted = torch.cat((coords, ffted), dim=1)
 
         if self.use_se:
             ffted = self.se(ffted)
@@ -145,22 +172,32 @@ class SpectralTransform(nn.Module):
         x = self.conv1(x)
         output = self.fu(x)
 
-        if self.enable_lfu:
-            n, c, h, w = x.shape
-            split_no = 2
-            split_s = h // split_no
+        if not self.enable_lfu:
+            return self.conv2(x + output)
+
+        n, c, h, w = x.shape
+        split_no = 2
+        split_s = h // split_no
+        if h != w or h % split_no:
+            # the quadrant split below is only defined for square inputs with even sides
             xs = torch.cat(torch.split(
                 x[:, :c // 4], split_s, dim=-2), dim=1).contiguous()
             xs = torch.cat(torch.split(xs, split_s, dim=-1),
                            dim=1).contiguous()
             xs = self.lfu(xs)
             xs = xs.repeat(1, 1, split_no, split_no).contiguous()
-        else:
-            xs = 0
-
-        output = self.conv2(x + output + xs)
-
-        return output
+            return self.conv2(x + output + xs)
+
+        # Stack the four quadrants of the first c // 4 channels along the channel axis, ordered
+        # (column half, row half, channel), with one strided copy instead of two split/cat passes.
+        xs = x[:, :c // 4].reshape(n, c // 4, split_no, split_s, split_no, split_s)
+        xs = xs.permute(0, 4, 2, 1, 3, 5).reshape(n, c * split_no * split_no // 4, split_s, split_s)
+        xs = self.lfu(xs)
+
+        # Add the LFU output to every quadrant by broadcasting instead of materialising a repeat.
+        summed = x + output
+        summed.view(n, c, split_no, split_s, split_no, split_s).add_(xs[:, :, None, :, None, :])
+        return self.conv2(summed)
 
 
 class FFC(nn.Module):
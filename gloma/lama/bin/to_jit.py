@@ -1,3 +1,4 @@
+import copy
 import os
 from pathlib import Path
 
@@ -7,6 +8,7 @@ import yaml
 from omegaconf import OmegaConf
 from torch import nn
 
+from saicinpainting.training.modules.ffc_inference import prepare_generator_for_inference
 from saicinpainting.training.trainers import load_checkpoint
 from saicinpainting.utils import register_debug_signal_handlers
 
@@ -43,20 +45,25 @@ def main(predict_config: OmegaConf):
         train_config, checkpoint_path, strict=False, map_location="cpu"
     )
     model.eval()
-    jit_model_wrapper = JITWrapper(model)
-
-    image = torch.rand(1, 3, 120, 120)
-    mask = torch.rand(1, 1, 120, 120)
-    output = jit_model_wrapper(image, mask)
-
     if torch.cuda.is_available():
         device = torch.device("cuda")
     else:
         device = torch.device("cpu")
-
-    image = image.to(device)
-    mask = mask.to(device)
-    traced_model = torch.jit.trace(jit_model_wrapper, (image, mask), strict=False).to(device)
+    model.to(device)
+
+    # optimize=True (default): fold BatchNorms into convs and plan the FourierUnits before tracing
+    optimize = predict_config.get("optimize", True)
+    export_model = copy.deepcopy(model) if optimize else model
+    if optimize:
+        prepare_generator_for_inference(export_model.generator)
+    jit_model_wrapper = JITWrapper(export_model)
+
+    image = torch.rand(1, 3, 120, 120, device=device)
+    mask = torch.rand(1, 1, 120, 120, device=device)
+    with torch.no_grad():
+        traced_model = torch.jit.trace(jit_model_wrapper, (image, mask), strict=False).to(device)
+    if optimize:
+        traced_model = torch.jit.freeze(traced_model.eval())
 
     save_path = Path(predict_config.save_path)
     save_path.parent.mkdir(parents=True, exist_ok=True)
@@ -64,11 +71,19 @@ def main(predict_config: OmegaConf):
     print(f"Saving big-lama.pt model to {save_path}")
     traced_model.save(save_path)
 
-    print(f"Checking jit model output...")
-    jit_model = torch.jit.load(str(save_path))
-    jit_output = jit_model(image, mask)
-    diff = (output - jit_output).abs().sum()
-    print(f"diff: {diff}")
+    print(f"Checking jit model output against the eager model...")
+    jit_model = torch.jit.load(str(save_path), map_location=device)
+    eager_model = JITWrapper(model)
+    atol = predict_config.get("check_atol", 1e-4)
+    # the second size checks that the traced graph is not specialised to the tracing resolution
+    for height, width in [(120, 120), (256, 328)]:
+        image = torch.rand(1, 3, height, width, device=device)
+        mask = (torch.rand(1, 1, height, width, device=device) > 0.5).float()
+        with torch.no_grad():
+            diff = (eager_model(image, mask) - jit_model(image, mask)).abs().max().item()
+        print(f"{height}x{width} max abs diff: {diff}")
+        if diff > atol:
+            raise RuntimeError(f"Exported model differs from the eager model by {diff} > {atol} at {height}x{width}")
 
 
 if __name__ == "__main__":
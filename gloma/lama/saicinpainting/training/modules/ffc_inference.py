@@ -0,0 +1,188 @@
+"""
+Inference-only rewrites of the FFC generator, used for export.
+
+prepare_generator_for_inference() folds every BatchNorm that follows a convolution into that
+convolution, and swaps eligible FourierUnits for PlannedFourierUnit, whose 1x1 spectral conv
+has its channels reordered so that the rFFT output is fed as [real | imag] halves instead of
+interleaved pairs. That removes the stack/permute/contiguous copies around the FFT.
+The rewritten model only matches the original in eval mode (BatchNorm running statistics).
+"""
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from saicinpainting.training.modules.ffc import FFC_BN_ACT, FourierUnit, SpectralTransform, spectral_coords
+
+
+def _bn_scale_shift(bn):
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    if bn.weight is not None:
+        scale = scale * bn.weight
+    shift = -bn.running_mean * scale
+    if bn.bias is not None:
+        shift = shift + bn.bias
+    return scale, shift
+
+
+def _scale_output_channels(conv, scale):
+    if isinstance(conv, nn.ConvTranspose2d):
+        conv.weight.mul_(scale.view(1, -1, 1, 1))
+    else:
+        conv.weight.mul_(scale.view(-1, 1, 1, 1))
+    if conv.bias is not None:
+        conv.bias.mul_(scale)
+
+
+def _add_bias(conv, shift):
+    if conv.bias is None:
+        conv.bias = nn.Parameter(shift.detach().clone())
+    else:
+        conv.bias.add_(shift)
+
+
+def fuse_conv_bn(conv, bn):
+    """
+    Fold ``bn`` (eval mode) into the preceding ``conv`` in place.
+    """
+    scale, shift = _bn_scale_shift(bn)
+    _scale_output_channels(conv, scale)
+    _add_bias(conv, shift)
+
+
+def _can_fuse_sequential_pair(conv, bn):
+    if not isinstance(bn, nn.BatchNorm2d) or not bn.track_running_stats:
+        return False
+    if isinstance(conv, nn.ConvTranspose2d):
+        return conv.groups == 1
+    return isinstance(conv, nn.Conv2d)
+
+
+def _fold_sequential(sequential):
+    children = list(sequential._modules.items())
+    for (_, conv), (bn_name, bn) in zip(children, children[1:]):
+        if _can_fuse_sequential_pair(conv, bn):
+            fuse_conv_bn(conv, bn)
+            sequential._modules[bn_name] = nn.Identity()
+
+
+def _fold_ffc_bn_act(block):
+    ffc = block.ffc
+    no_global_input = ffc.global_in_num == 0
+
+    # out_xl = convl2l(x_l) + convg2l(x_g) * gate: scale both branches, put the shift on convl2l
+    if isinstance(block.bn_l, nn.BatchNorm2d) and isinstance(ffc.convl2l, nn.Conv2d) \
+            and (isinstance(ffc.convg2l, nn.Conv2d) or no_global_input):
+        scale, shift = _bn_scale_shift(block.bn_l)
+        _scale_output_channels(ffc.convl2l, scale)
+        if isinstance(ffc.convg2l, nn.Conv2d):
+            _scale_output_channels(ffc.convg2l, scale)
+        _add_bias(ffc.convl2l, shift)
+        block.bn_l = nn.Identity()
+
+    # out_xg = convl2g(x_l) * gate + convg2g(x_g), where convg2g ends with the linear conv2.
+    # When gated, the sigmoid gate would multiply a shift on convl2g, so it has to go on conv2
+    has_spectral = isinstance(ffc.convg2g, SpectralTransform)
+    if isinstance(block.bn_g, nn.BatchNorm2d) and isinstance(ffc.convl2g, nn.Conv2d) \
+            and (has_spectral or (no_global_input and not ffc.gated)):
+        scale, shift = _bn_scale_shift(block.bn_g)
+        _scale_output_channels(ffc.convl2g, scale)
+        if has_spectral:
+            _scale_output_channels(ffc.convg2g.conv2, scale)
+        _add_bias(ffc.convg2g.conv2 if ffc.gated else ffc.convl2g, shift)
+        block.bn_g = nn.Identity()
+
+
+class PlannedFourierUnit(nn.Module):
+    """
+    Inference equivalent of a FourierUnit (groups=1, no SE, 2D FFT) with its BatchNorm folded.
+
+    The spectral conv consumes the rFFT as [real | imag] channel halves and produces its output
+    in the same layout, so the spectrum goes in with a single cat and comes out through two
+    channel views, instead of stack + permute + contiguous on the way in and view + permute +
+    contiguous on the way out.
+    """
+
+    def __init__(self, fu: FourierUnit):
+        super().__init__()
+        conv = fu.conv_layer
+        channels_in = (conv.in_channels - (2 if fu.spectral_pos_encoding else 0)) // 2
+        channels_out = conv.out_channels // 2
+        offset = 2 if fu.spectral_pos_encoding else 0
+
+        weight = conv.weight.detach()
+        bias = conv.bias.detach() if conv.bias is not None else torch.zeros(conv.out_channels, device=weight.device)
+        scale, shift = _bn_scale_shift(fu.bn)
+        weight = weight * scale.view(-1, 1, 1, 1)
+        bias = bias * scale + shift
+
+        # interleaved (re_0, im_0, re_1, im_1, ...) -> (re_0 .. re_c, im_0 .. im_c)
+        in_order = list(range(offset)) \
+            + [offset + 2 * k for k in range(channels_in)] \
+            + [offset + 2 * k + 1 for k in range(channels_in)]
+        out_order = [2 * k for k in range(channels_out)] + [2 * k + 1 for k in range(channels_out)]
+        weight = weight[out_order][:, in_order]
+        bias = bias[out_order]
+
+        self.conv_layer = nn.Conv2d(conv.in_channels, conv.out_channels, kernel_size=1, bias=True)
+        self.conv_layer.weight = nn.Parameter(weight.contiguous())
+        self.conv_layer.bias = nn.Parameter(bias.contiguous())
+        self.relu = nn.ReLU(inplace=True)
+        self.spatial_scale_factor = fu.spatial_scale_factor
+        self.spatial_scale_mode = fu.spatial_scale_mode
+        self.spectral_pos_encoding = fu.spectral_pos_encoding
+        self.fft_norm = fu.fft_norm
+
+    @staticmethod
+    def supports(fu: FourierUnit):
+        return fu.groups == 1 and not fu.use_se and not fu.ffc3d and fu.bn.track_running_stats
+
+    def forward(self, x):
+        # same as FourierUnit: the spectral path stays in fp32 under autocast
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            return self._spectral_forward(x.float())
+
+    def _spectral_forward(self, x):
+        if self.spatial_scale_factor is not None:
+            orig_size = x.shape[-2:]
+            x = F.interpolate(x, scale_factor=self.spatial_scale_factor, mode=self.spatial_scale_mode, align_corners=False)
+
+        ffted = torch.fft.rfftn(x, dim=(-2, -1), norm=self.fft_norm)
+        parts = [ffted.real, ffted.imag]
+        if self.spectral_pos_encoding:
+            batch, _, height, width = ffted.shape
+            parts = [spectral_coords(batch, height, width, x.device, x.dtype)] + parts
+        ffted = torch.cat(parts, dim=1)
+
+        ffted = self.relu(self.conv_layer(ffted))
+        real, imag = ffted.chunk(2, dim=1)
+        ffted = torch.complex(real, imag)
+
+        output = torch.fft.irfftn(ffted, s=x.shape[-2:], dim=(-2, -1), norm=self.fft_norm)
+
+        if self.spatial_scale_factor is not None:
+            output = F.interpolate(output, size=orig_size, mode=self.spatial_scale_mode, align_corners=False)
+
+        return output
+
+
+@torch.no_grad()
+def prepare_generator_for_inference(generator: nn.Module) -> nn.Module:
+    """
+    Rewrite ``generator`` in place for inference: fold BatchNorms and plan the FourierUnits.
+
+    The module is switched to eval mode and must not be trained afterwards.
+    """
+    generator.eval()
+    for module in list(generator.modules()):
+        if isinstance(module, FFC_BN_ACT):
+            _fold_ffc_bn_act(module)
+        elif isinstance(module, nn.Sequential):
+            _fold_sequential(module)
+    for module in list(generator.modules()):
+        if isinstance(module, SpectralTransform):
+            for name in ('fu', 'lfu'):
+                fu = getattr(module, name, None)
+                if isinstance(fu, FourierUnit) and PlannedFourierUnit.supports(fu):
+                    setattr(module, name, PlannedFourierUnit(fu).to(fu.conv_layer.weight.device).eval())
+    return generator
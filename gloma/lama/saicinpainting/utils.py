@@ -109,6 +109,47 @@ def register_debug_signal_handlers(sig=signal.SIGUSR1, handler=print_traceback_h
     signal.signal(sig, handler)
 
 
+def get_available_cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS and Windows
+        return os.cpu_count() or 1
+
+
+def configure_torch_threads(intra_op_threads=None, inter_op_threads=None):
+    """
+    Sizes torch's CPU thread pools: intra-op threads default to every core available to the process,
+    inter-op threads to 1, since the inpainting generators run their layers one after another.
+    Returns the (intra_op_threads, inter_op_threads) in effect.
+    """
+    intra_op_threads = intra_op_threads or get_available_cpu_count()
+    inter_op_threads = inter_op_threads or 1
+    torch.set_num_threads(intra_op_threads)
+    if torch.get_num_interop_threads() != inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # the inter-op pool can only be sized once, before any inter-op work has started
+            LOGGER.warning(f'Could not set inter-op threads to {inter_op_threads}, '
+                           f'keeping {torch.get_num_interop_threads()}')
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+
+def setup_inference_device(device, intra_op_threads=None, inter_op_threads=None):
+    """
+    Returns torch.device(device), falling back to CPU when CUDA is requested but not available.
+    On CPU the thread pools are sized with configure_torch_threads.
+    """
+    device = torch.device(device)
+    if device.type == 'cuda' and not torch.cuda.is_available():
+        LOGGER.warning(f'CUDA is not available, running on CPU instead of {device}')
+        device = torch.device('cpu')
+    if device.type == 'cpu':
+        intra_op_threads, inter_op_threads = configure_torch_threads(intra_op_threads, inter_op_threads)
+        LOGGER.info(f'Running on CPU with {intra_op_threads} intra-op and {inter_op_threads} inter-op threads')
+    return device
+
+
 def handle_deterministic_config(config):
     seed = dict(config).get('seed', None)
     if seed is None:
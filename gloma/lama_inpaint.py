@@ -5,42 +5,98 @@ import torch
 import yaml
 import glob
 import argparse
+import contextlib
 from PIL import Image
 from omegaconf import OmegaConf
 from pathlib import Path
-
-os.environ['OMP_NUM_THREADS'] = '1'
-os.environ['OPENBLAS_NUM_THREADS'] = '1'
-os.environ['MKL_NUM_THREADS'] = '1'
-os.environ['VECLIB_MAXIMUM_THREADS'] = '1'
-os.environ['NUMEXPR_NUM_THREADS'] = '1'
+from typing import List
 
 sys.path.insert(0, str(Path(__file__).resolve().parent / "lama"))
 from saicinpainting.evaluation.utils import move_to_device
 from saicinpainting.training.trainers import load_checkpoint
-from saicinpainting.evaluation.data import pad_tensor_to_modulo
+from saicinpainting.evaluation.data import ceil_modulo, pad_tensor_to_modulo
+from saicinpainting.utils import configure_torch_threads
 
 from utils import helper
+from model_registry import MODEL_REGISTRY
 
+# fp32: full precision; bf16: autocast, meant for CPUs; fp16: autocast, meant for accelerators.
+# In every mode the FFT inside the FourierUnits runs in fp32 and the weights stay fp32.
+LAMA_PRECISIONS = ("fp32", "bf16", "fp16")
 
-@torch.no_grad()
-def inpaint_img_with_lama(
-        img: np.ndarray,
-        mask: np.ndarray,
-        config_p: str,
-        ckpt_p: str,
-        mod=8,
-        device="cuda"
-):
-    assert len(mask.shape) == 2
-    if np.max(mask) == 1:
-        mask = mask * 255
-    img = torch.from_numpy(img).float().div(255.)
-    mask = torch.from_numpy(mask).float()
+# Device used when none is given: CUDA when available, the CPU otherwise
+LAMA_DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+_cpu_threads_configured = False
+
+
+def _int_from_env(name: str):
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+def configure_cpu_threads(intra_op_threads=None, inter_op_threads=None):
+    """
+    Sizes torch's CPU thread pools for LaMa inference.
+
+    Parameters:
+    - intra_op_threads (int, optional): Threads per operator. Default: $GLOMA_INTRA_OP_THREADS,
+      or every core available to the process.
+    - inter_op_threads (int, optional): Operators run concurrently. Default: $GLOMA_INTER_OP_THREADS, or 1.
+
+    Returns:
+    - tuple: The (intra_op_threads, inter_op_threads) in effect.
+    """
+    global _cpu_threads_configured
+    threads = configure_torch_threads(
+        intra_op_threads or _int_from_env("GLOMA_INTRA_OP_THREADS"),
+        inter_op_threads or _int_from_env("GLOMA_INTER_OP_THREADS")
+    )
+    _cpu_threads_configured = True
+    print(f"LaMa CPU threads: {threads[0]} intra-op, {threads[1]} inter-op")
+    return threads
+
+
+def resolve_lama_device(device=None) -> torch.device:
+    """
+    The device LaMa runs on: ``device``, or LAMA_DEVICE when None. CUDA falls back to the CPU
+    when it is not available, and the CPU thread pools are sized on first CPU use unless
+    configure_cpu_threads was called before.
+    """
+    device = torch.device(device or LAMA_DEVICE)
+    if device.type == "cuda" and not torch.cuda.is_available():
+        print(f"CUDA is not available, running LaMa on CPU instead of {device}")
+        device = torch.device("cpu")
+    if device.type == "cpu" and not _cpu_threads_configured:
+        configure_cpu_threads()
+    return device
+
+
+def _prepare_lama_model(model, device, channels_last=False):
+    model.to(device)
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    return model
+
+
+def _lama_autocast(device, precision="fp32"):
+    """
+    Autocast context for a LaMa forward pass in ``precision`` (one of LAMA_PRECISIONS).
+    """
+    if precision not in LAMA_PRECISIONS:
+        raise ValueError(f"Unknown LaMa precision {precision!r}, expected one of {LAMA_PRECISIONS}")
+    device = torch.device(device)
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    if precision == "fp16" and device.type == "cpu":
+        raise ValueError("fp16 LaMa inference is only supported on accelerators, use bf16 on CPU")
+    dtype = torch.bfloat16 if precision == "bf16" else torch.float16
+    return torch.autocast(device_type=device.type, dtype=dtype)
+
+
+def _load_lama_model(config_p: str, ckpt_p: str, device, channels_last=False):
     predict_config = OmegaConf.load(config_p)
     predict_config.model.path = ckpt_p
-    # device = torch.device(predict_config.device)
-    device = torch.device(device)
 
     train_config_path = os.path.join(
         predict_config.model.path, 'config.yaml')
@@ -57,40 +113,354 @@ def inpaint_img_with_lama(
     )
     model = load_checkpoint(
         train_config, checkpoint_path, strict=False, map_location='cpu')
-    # model.to(dtype=torch.float16)
     model.freeze()
     if not predict_config.get('refine', False):
-        model.to(device)
+        _prepare_lama_model(model, device, channels_last)
+    return model, predict_config
+
+
+def get_lama_model(config_p: str, ckpt_p: str, device=None, channels_last=False):
+    """
+    Returns the shared (model, predict_config) pair for a LaMa checkpoint,
+    loading it into the model registry on first use.
+    """
+    device = resolve_lama_device(device)
+    key = ("lama", os.path.abspath(config_p), os.path.abspath(ckpt_p), str(device), channels_last)
+    return MODEL_REGISTRY.get(key, lambda: _load_lama_model(config_p, ckpt_p, device, channels_last))
+
+
+def _to_lama_inputs(img: np.ndarray, mask: np.ndarray, mod: int):
+    assert len(mask.shape) == 2
+    if np.max(mask) == 1:
+        mask = mask * 255
+    img = torch.from_numpy(img).float().div(255.)
+    mask = torch.from_numpy(mask).float()
+    image = pad_tensor_to_modulo(img.permute(2, 0, 1).unsqueeze(0), mod)
+    mask = pad_tensor_to_modulo(mask[None, None], mod)
+    return image, mask
+
+
+@torch.no_grad()
+def _run_lama_batch(model, out_key, imgs, masks, mod, device, precision="fp32", channels_last=False):
+    """
+    One forward pass over images whose sizes pad to the same multiple of ``mod``.
+    """
+    inputs = [_to_lama_inputs(img, mask, mod) for img, mask in zip(imgs, masks)]
 
     batch = {}
-    batch['image'] = img.permute(2, 0, 1).unsqueeze(0)
-    batch['mask'] = mask[None, None]
-    unpad_to_size = [batch['image'].shape[2], batch['image'].shape[3]]
-    batch['image'] = pad_tensor_to_modulo(batch['image'], mod)
-    batch['mask'] = pad_tensor_to_modulo(batch['mask'], mod)
+    batch['image'] = torch.cat([image for image, _ in inputs])
+    batch['mask'] = torch.cat([mask for _, mask in inputs])
     batch = move_to_device(batch, device)
     batch['mask'] = (batch['mask'] > 0) * 1
+    if channels_last:
+        batch = {k: v.contiguous(memory_format=torch.channels_last) for k, v in batch.items()}
 
-    batch = model(batch)
-    cur_res = batch[predict_config.out_key][0].permute(1, 2, 0)
-    cur_res = cur_res.detach().cpu().numpy()
+    with _lama_autocast(device, precision):
+        batch = model(batch)
+    results = batch[out_key].float().permute(0, 2, 3, 1)
+    results = results.detach().cpu().numpy()
 
-    if unpad_to_size is not None:
-        orig_height, orig_width = unpad_to_size
+    cur_results = []
+    for img, cur_res in zip(imgs, results):
+        orig_height, orig_width = img.shape[:2]
         cur_res = cur_res[:orig_height, :orig_width]
+        cur_results.append(np.clip(cur_res * 255, 0, 255).astype('uint8'))
+    return cur_results
 
-    cur_res = np.clip(cur_res * 255, 0, 255).astype('uint8')
-    return cur_res
+
+def _run_lama(model, out_key, img: np.ndarray, mask: np.ndarray, mod, device,
+              precision="fp32", channels_last=False) -> np.ndarray:
+    return _run_lama_batch(model, out_key, [img], [mask], mod=mod, device=device,
+                           precision=precision, channels_last=channels_last)[0]
+
+
+@torch.no_grad()
+def inpaint_img_with_lama(
+        img: np.ndarray,
+        mask: np.ndarray,
+        config_p: str,
+        ckpt_p: str,
+        mod=8,
+        device=None,
+        precision="fp32",
+        channels_last=False
+):
+    """
+    Inpaints one image.
+
+    Parameters:
+    - device (str, optional): "cuda" or "cpu". Default: LAMA_DEVICE; CUDA falls back to the CPU when absent.
+    - precision (str): One of LAMA_PRECISIONS; "bf16" on CPU, "fp16" on accelerators.
+    - channels_last (bool): Runs the generator on NHWC tensors.
+    """
+    device = resolve_lama_device(device)
+    model, predict_config = get_lama_model(config_p, ckpt_p, device, channels_last)
+    return _run_lama(model, predict_config.out_key, img, mask, mod=mod, device=device,
+                     precision=precision, channels_last=channels_last)
+
+
+@torch.no_grad()
+def inpaint_imgs_with_lama(
+        imgs: List[np.ndarray],
+        masks: List[np.ndarray],
+        config_p: str,
+        ckpt_p: str,
+        mod=8,
+        device=None,
+        batch_size=8,
+        precision="fp32",
+        channels_last=False
+) -> List[np.ndarray]:
+    """
+    Inpaints many (image, mask) pairs with as few forward passes as possible.
+
+    Pairs are bucketed by padded size (ceil_modulo(h, mod) x ceil_modulo(w, mod)); each bucket
+    runs in chunks of ``batch_size`` and every result is cropped back to its own size.
+
+    Parameters:
+    - imgs (list): RGB images (HWC uint8).
+    - masks (list): 2D masks, one per image, non-zero where the image is inpainted.
+    - batch_size (int): Maximum pairs per forward pass.
+    - device (str, optional): "cuda" or "cpu". Default: LAMA_DEVICE; CUDA falls back to the CPU when absent.
+    - precision (str): One of LAMA_PRECISIONS; "bf16" on CPU, "fp16" on accelerators.
+    - channels_last (bool): Runs the generator on NHWC tensors.
+
+    Returns:
+    - list: The inpainted images, in input order.
+    """
+    if len(imgs) != len(masks):
+        raise ValueError("imgs and masks must have the same length")
+    device = resolve_lama_device(device)
+    model, predict_config = get_lama_model(config_p, ckpt_p, device, channels_last)
+
+    buckets = {}
+    for index, img in enumerate(imgs):
+        height, width = img.shape[:2]
+        buckets.setdefault((ceil_modulo(height, mod), ceil_modulo(width, mod)), []).append(index)
+
+    results = [None] * len(imgs)
+    for indices in buckets.values():
+        for start in range(0, len(indices), batch_size):
+            chunk = indices[start:start + batch_size]
+            chunk_results = _run_lama_batch(
+                model, predict_config.out_key,
+                [imgs[i] for i in chunk], [masks[i] for i in chunk],
+                mod=mod, device=device, precision=precision, channels_last=channels_last
+            )
+            for index, result in zip(chunk, chunk_results):
+                results[index] = result
+    return results
+
+
+def _roi_window(bbox, image_size, context_scale, min_roi_size, mod):
+    """
+    Context window (x1, y1, x2, y2) around ``bbox``: ``context_scale`` times its size, at least
+    ``min_roi_size``, rounded up to ``mod`` and shifted to lie inside the image.
+    """
+    height, width = image_size
+    x1, y1, x2, y2 = bbox
+    roi_w = min(width, ceil_modulo(max(min_roi_size, int(np.ceil((x2 - x1) * context_scale))), mod))
+    roi_h = min(height, ceil_modulo(max(min_roi_size, int(np.ceil((y2 - y1) * context_scale))), mod))
+    left = min(max(0, int(round((x1 + x2 - roi_w) / 2))), width - roi_w)
+    top = min(max(0, int(round((y1 + y2 - roi_h) / 2))), height - roi_h)
+    return left, top, left + roi_w, top + roi_h
+
+
+def _feather_weights(window, image_size, feather):
+    """
+    Blend weights of a pasted window: 1 inside, ramping to 0 over ``feather`` pixels towards
+    every window edge that lies inside the image (edges on the image border need no seam).
+    """
+    height, width = image_size
+    x1, y1, x2, y2 = window
+
+    def ramp(length, open_start, open_end):
+        weights = np.ones(length, dtype=np.float32)
+        if feather > 0:
+            position = np.arange(length, dtype=np.float32)
+            if open_start:
+                weights = np.minimum(weights, (position + 1) / feather)
+            if open_end:
+                weights = np.minimum(weights, (length - position) / feather)
+        return weights
+
+    return np.outer(ramp(y2 - y1, y1 > 0, y2 < height), ramp(x2 - x1, x1 > 0, x2 < width))
+
+
+@torch.no_grad()
+def inpaint_img_with_lama_roi(
+        img: np.ndarray,
+        mask: np.ndarray,
+        config_p: str,
+        ckpt_p: str,
+        context_scale=2.0,
+        min_roi_size=256,
+        max_roi_fraction=0.5,
+        feather=16,
+        max_tile_size=None,
+        mod=8,
+        device=None,
+        precision="fp32",
+        channels_last=False
+):
+    """
+    Inpaints only a context window around the mask and pastes it back with a feathered seam.
+
+    LaMa's cost grows with the pixel count, so removing a small object from a large photo only
+    pays for the window. Falls back to full-frame inference when the window would cover more
+    than ``max_roi_fraction`` of the image. With ``max_tile_size``, that fallback, and any
+    window with a side above ``max_tile_size``, goes through inpaint_img_with_lama_tiled.
+
+    Parameters:
+    - img (np.ndarray): RGB image (HWC uint8).
+    - mask (np.ndarray): 2D mask, non-zero where the image is inpainted.
+    - context_scale (float): Window size as a multiple of the mask's bounding box.
+    - min_roi_size (int): Minimum window side, so small masks still get enough context.
+    - max_roi_fraction (float): Window area, as a fraction of the image, above which the full frame is used.
+    - feather (int): Width in pixels of the blend ramp at the window seams.
+    - max_tile_size (int, optional): Maximum side inpainted in one piece. Default: no limit.
+    - device (str, optional): "cuda" or "cpu". Default: LAMA_DEVICE; CUDA falls back to the CPU when absent.
+    - precision (str): One of LAMA_PRECISIONS; "bf16" on CPU, "fp16" on accelerators.
+    - channels_last (bool): Runs the generator on NHWC tensors.
+
+    Returns:
+    - np.ndarray: The inpainted image, same size as ``img``.
+    """
+    assert len(mask.shape) == 2
+    device = resolve_lama_device(device)
+    height, width = mask.shape
+    rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        return img.copy()
+    bbox = (cols[0], rows[0], cols[-1] + 1, rows[-1] + 1)
+    x1, y1, x2, y2 = window = _roi_window(bbox, (height, width), context_scale, min_roi_size, mod)
+    full_frame = (x2 - x1) * (y2 - y1) > max_roi_fraction * height * width
+    if max_tile_size and (full_frame or max(x2 - x1, y2 - y1) > max_tile_size):
+        # only the tiles containing mask pixels are inpainted
+        return inpaint_img_with_lama_tiled(img, mask, config_p, ckpt_p, max_tile_size=max_tile_size, mod=mod,
+                                           device=device, precision=precision, channels_last=channels_last)
+    if full_frame:
+        return inpaint_img_with_lama(img, mask, config_p, ckpt_p, mod=mod, device=device,
+                                     precision=precision, channels_last=channels_last)
+
+    model, predict_config = get_lama_model(config_p, ckpt_p, device, channels_last)
+    img_crop, mask_crop = img[y1:y2, x1:x2], mask[y1:y2, x1:x2]
+    inpainted_crop = _run_lama(
+        model, predict_config.out_key, np.ascontiguousarray(img_crop), np.ascontiguousarray(mask_crop), mod=mod, device=device,
+        precision=precision, channels_last=channels_last
+    )
+
+    # masked pixels always take the inpainted value; around them, fade into the original at the seams
+    weights = np.maximum(_feather_weights(window, (height, width), feather), mask_crop > 0)[..., None]
+    blended = weights * inpainted_crop + (1 - weights) * img_crop
+    result = img.copy()
+    result[y1:y2, x1:x2] = np.clip(np.rint(blended), 0, 255).astype('uint8')
+    return result
+
+
+# Rough peak memory of a Big-LaMa forward pass per input pixel (fp32), used to size tile batches
+LAMA_BYTES_PER_PIXEL = 4096
+
+
+def _tile_starts(length, tile_size, overlap):
+    if length <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    starts = list(range(0, length - tile_size, stride))
+    return starts + [length - tile_size]
+
+
+@torch.no_grad()
+def inpaint_img_with_lama_tiled(
+        img: np.ndarray,
+        mask: np.ndarray,
+        config_p: str,
+        ckpt_p: str,
+        max_tile_size=1024,
+        overlap=128,
+        memory_budget_gb=4.0,
+        mod=8,
+        device=None,
+        precision="fp32",
+        channels_last=False
+):
+    """
+    Inpaints a large image tile by tile, so peak memory depends on the tile size, not the image.
+
+    The image is covered by overlapping tiles of at most ``max_tile_size`` pixels a side; only
+    tiles containing mask pixels are inpainted, in batches that fit ``memory_budget_gb``.
+    Overlapping predictions are averaged with weights that ramp down over ``overlap`` pixels
+    towards inner tile edges, and only masked pixels are written back.
+
+    Parameters:
+    - img (np.ndarray): RGB image (HWC uint8).
+    - mask (np.ndarray): 2D mask, non-zero where the image is inpainted.
+    - max_tile_size (int): Maximum tile side; rounded down to ``mod``.
+    - overlap (int): Overlap between neighbouring tiles, also the width of the blend ramp.
+    - memory_budget_gb (float): Approximate memory available to one forward pass.
+    - device (str, optional): "cuda" or "cpu". Default: LAMA_DEVICE; CUDA falls back to the CPU when absent.
+    - precision (str): One of LAMA_PRECISIONS; "bf16" on CPU, "fp16" on accelerators.
+    - channels_last (bool): Runs the generator on NHWC tensors.
+
+    Returns:
+    - np.ndarray: The inpainted image, same size as ``img``.
+    """
+    assert len(mask.shape) == 2
+    device = resolve_lama_device(device)
+    height, width = mask.shape
+    max_tile_size = max(mod, max_tile_size // mod * mod)
+    if height <= max_tile_size and width <= max_tile_size:
+        return inpaint_img_with_lama(img, mask, config_p, ckpt_p, mod=mod, device=device,
+                                     precision=precision, channels_last=channels_last)
+    overlap = min(overlap, max_tile_size // 2)
+
+    tile_h, tile_w = min(height, max_tile_size), min(width, max_tile_size)
+    tiles = [
+        (x, y, x + tile_w, y + tile_h)
+        for y in _tile_starts(height, tile_h, overlap)
+        for x in _tile_starts(width, tile_w, overlap)
+        if mask[y:y + tile_h, x:x + tile_w].any()
+    ]
+    if not tiles:
+        return img.copy()
+
+    model, predict_config = get_lama_model(config_p, ckpt_p, device, channels_last)
+    tiles_per_batch = max(1, int(memory_budget_gb * (1 << 30)) // (LAMA_BYTES_PER_PIXEL * tile_h * tile_w))
+
+    # accumulate only over the region the inpainted tiles cover
+    x0, y0 = min(t[0] for t in tiles), min(t[1] for t in tiles)
+    x1, y1 = max(t[2] for t in tiles), max(t[3] for t in tiles)
+    accumulated = np.zeros((y1 - y0, x1 - x0, 3), dtype=np.float32)
+    total_weight = np.zeros((y1 - y0, x1 - x0, 1), dtype=np.float32)
+    for start in range(0, len(tiles), tiles_per_batch):
+        batch_tiles = tiles[start:start + tiles_per_batch]
+        outputs = _run_lama_batch(
+            model, predict_config.out_key,
+            [np.ascontiguousarray(img[ty1:ty2, tx1:tx2]) for tx1, ty1, tx2, ty2 in batch_tiles],
+            [np.ascontiguousarray(mask[ty1:ty2, tx1:tx2]) for tx1, ty1, tx2, ty2 in batch_tiles],
+            mod=mod, device=device, precision=precision, channels_last=channels_last
+        )
+        for (tx1, ty1, tx2, ty2), output in zip(batch_tiles, outputs):
+            weights = _feather_weights((tx1, ty1, tx2, ty2), (height, width), overlap)[..., None]
+            accumulated[ty1 - y0:ty2 - y0, tx1 - x0:tx2 - x0] += weights * output
+            total_weight[ty1 - y0:ty2 - y0, tx1 - x0:tx2 - x0] += weights
+
+    blended = accumulated / np.maximum(total_weight, 1e-6)
+    region_mask = mask[y0:y1, x0:x1] > 0
+    result = img.copy()
+    result[y0:y1, x0:x1][region_mask] = np.clip(np.rint(blended[region_mask]), 0, 255).astype('uint8')
+    return result
 
 
 def build_lama_model(        
         config_p: str,
         ckpt_p: str,
-        device="cuda"
+        device=None,
+        channels_last=False
 ):
     predict_config = OmegaConf.load(config_p)
     predict_config.model.path = ckpt_p
-    device = torch.device(device)
+    device = resolve_lama_device(device)
 
     train_config_path = os.path.join(
         predict_config.model.path, 'config.yaml')
@@ -105,9 +475,8 @@ def build_lama_model(
         predict_config.model.path, 'models',
         predict_config.model.checkpoint
     )
-    model = load_checkpoint(train_config, checkpoint_path, strict=False)
-    # model.to(dtype=torch.float16)
-    model.to(device)
+    model = load_checkpoint(train_config, checkpoint_path, strict=False, map_location='cpu')
+    _prepare_lama_model(model, device, channels_last)
     model.freeze()
     return model
 
@@ -119,9 +488,12 @@ def inpaint_img_with_builded_lama(
         mask: np.ndarray,
         config_p=None,
         mod=8,
-        device="cuda"
+        device=None,
+        precision="fp32",
+        channels_last=False
 ):
     assert len(mask.shape) == 2
+    device = resolve_lama_device(device)
     if np.max(mask) == 1:
         mask = mask * 255
     img = torch.from_numpy(img).float().div(255.)
@@ -135,9 +507,12 @@ def inpaint_img_with_builded_lama(
     batch['mask'] = pad_tensor_to_modulo(batch['mask'], mod)
     batch = move_to_device(batch, device)
     batch['mask'] = (batch['mask'] > 0) * 1
+    if channels_last:
+        batch = {k: v.contiguous(memory_format=torch.channels_last) for k, v in batch.items()}
 
-    batch = model(batch)
-    cur_res = batch["inpainted"][0].permute(1, 2, 0)
+    with _lama_autocast(device, precision):
+        batch = model(batch)
+    cur_res = batch["inpainted"][0].float().permute(1, 2, 0)
     cur_res = cur_res.detach().cpu().numpy()
 
     if unpad_to_size is not None:
@@ -172,6 +547,27 @@ def setup_args(parser):
         "--lama_ckpt", type=str, required=True,
         help="The path to the lama checkpoint.",
     )
+    parser.add_argument(
+        "--precision", type=str, choices=LAMA_PRECISIONS, default="fp32",
+        help="bf16 autocast on CPU, fp16 autocast on GPU. Default: fp32",
+    )
+    parser.add_argument(
+        "--channels_last", action="store_true",
+        help="Run the generator on channels_last (NHWC) tensors.",
+    )
+    parser.add_argument(
+        "--device", type=str, default=None,
+        help="cuda or cpu. Default: cuda when available, cpu otherwise",
+    )
+    parser.add_argument(
+        "--intra_op_threads", type=int, default=None,
+        help="CPU threads per operator. Default: every available core",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None,
+        help="Inpaint on CPU with this many single-threaded worker processes, "
+             "each holding a model copy (see lama_process_pool.LamaProcessPool).",
+    )
 
 
 if __name__ == "__main__":
@@ -186,7 +582,6 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     setup_args(parser)
     args = parser.parse_args(sys.argv[1:])
-    device = "cuda" if torch.cuda.is_available() else "cpu"
 
     img_stem = Path(args.input_img).stem
     mask_ps = sorted(glob.glob(args.input_mask_glob))
@@ -194,9 +589,19 @@ if __name__ == "__main__":
     out_dir.mkdir(parents=True, exist_ok=True)
 
     img = helper.load_img_to_array(args.input_img)
-    for mask_p in mask_ps:
-        mask = helper.load_img_to_array(mask_p)
+    masks = [helper.load_img_to_array(mask_p) for mask_p in mask_ps]
+    if args.workers:
+        from lama_process_pool import LamaProcessPool
+        with LamaProcessPool(args.lama_config, args.lama_ckpt, workers=args.workers,
+                             threads_per_worker=args.intra_op_threads or 1,
+                             precision=args.precision, channels_last=args.channels_last) as pool:
+            imgs_inpainted = pool.map([img] * len(masks), masks)
+    else:
+        if args.intra_op_threads:
+            configure_cpu_threads(intra_op_threads=args.intra_op_threads)
+        imgs_inpainted = inpaint_imgs_with_lama(
+            [img] * len(masks), masks, args.lama_config, args.lama_ckpt, device=args.device,
+            precision=args.precision, channels_last=args.channels_last)
+    for mask_p, img_inpainted in zip(mask_ps, imgs_inpainted):
         img_inpainted_p = out_dir / f"inpainted_with_{Path(mask_p).name}"
-        img_inpainted = inpaint_img_with_lama(
-            img, mask, args.lama_config, args.lama_ckpt, device=device)
         helper.save_array_to_img(img_inpainted, img_inpainted_p)
\ No newline at end of file
@@ -0,0 +1,132 @@
+import sys
+import glob
+import time
+import argparse
+import numpy as np
+import torch
+
+from lama_inpaint import LAMA_PRECISIONS, inpaint_img_with_lama
+from saicinpainting.evaluation.losses.lpips import PerceptualLoss
+from utils import helper
+
+
+def fixed_mask(shape, fraction=0.25):
+    """
+    Deterministic mask: a centred rectangle covering ``fraction`` of each side.
+    """
+    height, width = shape[:2]
+    mask = np.zeros((height, width), dtype=np.uint8)
+    mask_h, mask_w = int(height * fraction), int(width * fraction)
+    top, left = (height - mask_h) // 2, (width - mask_w) // 2
+    mask[top:top + mask_h, left:left + mask_w] = 255
+    return mask
+
+
+def masked_psnr(reference: np.ndarray, candidate: np.ndarray, mask: np.ndarray, peak=255.) -> float:
+    """
+    PSNR over the inpainted pixels only; LaMa copies the rest of the image unchanged.
+    """
+    region = mask > 0
+    mse = np.mean((reference[region].astype(np.float64) - candidate[region].astype(np.float64)) ** 2)
+    return float("inf") if mse == 0 else 10 * np.log10(peak ** 2 / mse)
+
+
+def _to_lpips_input(img: np.ndarray, device):
+    return torch.from_numpy(img).float().div(255.).permute(2, 0, 1)[None].to(device)
+
+
+def _timed_inpaint(img, mask, args, precision, channels_last):
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    result = inpaint_img_with_lama(
+        img, mask, args.lama_config, args.lama_ckpt, device=args.device,
+        precision=precision, channels_last=channels_last
+    )
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return result, time.perf_counter() - start
+
+
+@torch.no_grad()
+def check_precision(img_paths, args):
+    """
+    Inpaints every image in fp32 and in the requested mode and reports the drift between them.
+
+    Returns:
+    - list: One (path, psnr, lpips, fp32 seconds, candidate seconds) tuple per image.
+    """
+    lpips = PerceptualLoss(model='net-lin', net=args.lpips_net, use_gpu=args.device.startswith("cuda")).to(args.device).eval()
+    rows = []
+    for img_path in img_paths:
+        img = helper.load_img_to_array(img_path)
+        mask = fixed_mask(img.shape, args.mask_fraction)
+
+        # warm-up runs, so model loading and first-call allocations are not timed
+        for precision, channels_last in (("fp32", False), (args.precision, args.channels_last)):
+            _timed_inpaint(img, mask, args, precision, channels_last)
+
+        reference, reference_time = _timed_inpaint(img, mask, args, "fp32", False)
+        candidate, candidate_time = _timed_inpaint(img, mask, args, args.precision, args.channels_last)
+        lpips_value = lpips(_to_lpips_input(candidate, args.device), _to_lpips_input(reference, args.device)).item()
+        rows.append((img_path, masked_psnr(reference, candidate, mask), lpips_value, reference_time, candidate_time))
+    return rows
+
+
+def setup_args(parser):
+    parser.add_argument(
+        "--input_img_glob", type=str, default="./assets/*.jpg",
+        help="Glob to the fixed image set. Default: the repository assets",
+    )
+    parser.add_argument(
+        "--lama_config", type=str,
+        default="./lama/configs/prediction/default.yaml",
+        help="The path to the config file of lama model. "
+             "Default: the config of big-lama",
+    )
+    parser.add_argument(
+        "--lama_ckpt", type=str, required=True,
+        help="The path to the lama checkpoint.",
+    )
+    parser.add_argument(
+        "--precision", type=str, choices=[p for p in LAMA_PRECISIONS if p != "fp32"], default="bf16",
+        help="Precision mode compared against fp32.",
+    )
+    parser.add_argument(
+        "--channels_last", action="store_true",
+        help="Also run the compared mode on channels_last tensors.",
+    )
+    parser.add_argument(
+        "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu",
+    )
+    parser.add_argument(
+        "--mask_fraction", type=float, default=0.25,
+        help="Side of the centred mask as a fraction of the image side.",
+    )
+    parser.add_argument(
+        "--lpips_net", type=str, choices=["alex", "vgg", "squeeze"], default="vgg",
+    )
+
+
+if __name__ == "__main__":
+    """Example usage:
+    python lama_precision_check.py \
+        --lama_ckpt ../checkpoints/big-lama \
+        --precision bf16 --channels_last --device cpu
+    """
+    parser = argparse.ArgumentParser(description="PSNR/LPIPS drift of a reduced-precision LaMa mode against fp32")
+    setup_args(parser)
+    args = parser.parse_args(sys.argv[1:])
+
+    img_paths = sorted(glob.glob(args.input_img_glob))
+    if not img_paths:
+        raise RuntimeError(f"Error: no images match '{args.input_img_glob}'.")
+
+    mode = args.precision + (" + channels_last" if args.channels_last else "")
+    rows = check_precision(img_paths, args)
+    print(f"{mode} vs fp32 on {args.device}")
+    print(f"{'image':40s} {'PSNR (dB)':>10s} {'LPIPS':>8s} {'fp32 (s)':>9s} {'mode (s)':>9s}")
+    for img_path, psnr_value, lpips_value, reference_time, candidate_time in rows:
+        print(f"{img_path:40s} {psnr_value:10.2f} {lpips_value:8.4f} {reference_time:9.3f} {candidate_time:9.3f}")
+    print(f"{'worst PSNR / LPIPS, total time':40s} {min(row[1] for row in rows):10.2f} {max(row[2] for row in rows):8.4f} "
+          f"{sum(row[3] for row in rows):9.3f} {sum(row[4] for row in rows):9.3f}")
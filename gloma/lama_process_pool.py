@@ -0,0 +1,96 @@
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterable, List, Optional
+
+import numpy as np
+
+from lama_inpaint import configure_cpu_threads, get_lama_model, inpaint_img_with_lama
+from saicinpainting.utils import get_available_cpu_count
+
+# Settings of the LaMa model held by the current worker process.
+_worker_settings = None
+
+
+def _init_worker(config_p, ckpt_p, threads_per_worker, mod, precision, channels_last):
+    global _worker_settings
+    configure_cpu_threads(intra_op_threads=threads_per_worker, inter_op_threads=1)
+    # load now, so the first job does not pay for it
+    get_lama_model(config_p, ckpt_p, "cpu", channels_last)
+    _worker_settings = dict(config_p=config_p, ckpt_p=ckpt_p, mod=mod, device="cpu",
+                            precision=precision, channels_last=channels_last)
+
+
+def _inpaint(img: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    return inpaint_img_with_lama(img, mask, **_worker_settings)
+
+
+class LamaProcessPool:
+    """
+    Throughput-oriented CPU LaMa inference: N worker processes, each holding its own model copy
+    and running with ``threads_per_worker`` threads.
+
+    One multi-threaded forward pass stops scaling well before it fills a large CPU, while
+    independent single-threaded workers do not contend with each other. Use it for batch
+    jobs with many (image, mask) pairs; single requests have lower latency with one process
+    using every core (see lama_inpaint.configure_cpu_threads).
+
+    Example:
+        with LamaProcessPool(config_p, ckpt_p, workers=16) as pool:
+            results = pool.map(images, masks)
+    """
+
+    def __init__(
+            self,
+            config_p: str,
+            ckpt_p: str,
+            workers: Optional[int] = None,
+            threads_per_worker: int = 1,
+            mod=8,
+            precision="fp32",
+            channels_last=False
+    ):
+        """
+        Args:
+        - config_p (str): LaMa prediction config.
+        - ckpt_p (str): LaMa checkpoint directory.
+        - workers (int, optional): Number of worker processes. Default: available cores // threads_per_worker.
+        - threads_per_worker (int): Intra-op threads of each worker.
+        - precision (str): One of lama_inpaint.LAMA_PRECISIONS other than "fp16" (CPU only).
+        - channels_last (bool): Runs the generators on NHWC tensors.
+        """
+        self.workers = workers or max(1, get_available_cpu_count() // threads_per_worker)
+        # spawn, not fork: a forked child inherits the parent's OpenMP state and can deadlock in it
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(config_p, ckpt_p, threads_per_worker, mod, precision, channels_last)
+        )
+
+    def submit(self, img: np.ndarray, mask: np.ndarray) -> Future:
+        """
+        Queue one (image, mask) pair.
+
+        Returns:
+        - Future: Resolves to the inpainted image.
+        """
+        return self._executor.submit(_inpaint, img, mask)
+
+    def map(self, imgs: Iterable[np.ndarray], masks: Iterable[np.ndarray]) -> List[np.ndarray]:
+        """
+        Inpaint every (image, mask) pair and return the results in input order.
+        """
+        futures = [self.submit(img, mask) for img, mask in zip(imgs, masks)]
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        """
+        Let queued jobs finish, then stop every worker.
+        """
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
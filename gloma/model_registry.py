@@ -0,0 +1,171 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+import torch
+
+
+def _estimate_nbytes(obj: Any) -> int:
+    """
+    Estimate the memory held by a model handle.
+
+    Parameters and buffers of every ``torch.nn.Module`` reachable from ``obj``
+    (directly, through a tuple/list/dict, or one attribute deep) are counted.
+
+    Args:
+    - obj (Any): The loaded model handle.
+
+    Returns:
+    - int: Approximate number of bytes held by the handle.
+    """
+    seen = set()
+
+    def _module_nbytes(module: torch.nn.Module) -> int:
+        total = 0
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            if id(tensor) in seen:
+                continue
+            seen.add(id(tensor))
+            total += tensor.numel() * tensor.element_size()
+        return total
+
+    def _walk(value: Any, depth: int) -> int:
+        if isinstance(value, torch.nn.Module):
+            return _module_nbytes(value)
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (list, tuple)):
+            return sum(_walk(v, depth) for v in value)
+        if isinstance(value, dict):
+            return sum(_walk(v, depth) for v in value.values())
+        if depth > 0 and hasattr(value, "__dict__"):
+            return sum(_walk(v, depth - 1) for v in vars(value).values())
+        return 0
+
+    return _walk(obj, depth=1)
+
+
+def _release(handles: list):
+    """
+    Close the evicted handles that can be closed, outside the registry lock: closing may wait
+    for in-flight work.
+    """
+    for handle in handles:
+        close = getattr(handle, "close", None)
+        if callable(close):
+            close()
+    if handles and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of loaded models.
+
+    Each model is loaded once through its loader, kept on its device and handed out
+    as a shared handle to every caller asking for the same key. When the total size
+    of the cached models exceeds ``max_bytes``, the least recently used models are
+    evicted. Evicted handles with a ``close()`` method (e.g. LLAMA, whose batching thread
+    would otherwise keep the weights alive) are closed.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes
+        self._models = OrderedDict()  # key -> (handle, nbytes)
+        self._lock = threading.RLock()
+        self._load_locks = {}
+
+    def get(self, key: Hashable, loader: Callable[[], Any], nbytes: Optional[int] = None) -> Any:
+        """
+        Return the model registered under ``key``, loading it with ``loader`` on a miss.
+
+        Args:
+        - key (Hashable): Identifies the model, e.g. ("lama", config_path, ckpt_path, device).
+        - loader (Callable): Zero-argument function building the model.
+        - nbytes (int, optional): Size of the model. Estimated from its tensors if omitted.
+
+        Returns:
+        - Any: The shared model handle.
+        """
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key][0]
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        # Load outside the registry lock so that other models stay available meanwhile,
+        # but never load the same model twice concurrently.
+        with load_lock:
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    return self._models[key][0]
+
+            print(f"Loading model {key} into the registry")
+            try:
+                handle = loader()
+                if nbytes is None:
+                    nbytes = _estimate_nbytes(handle)
+
+                with self._lock:
+                    self._models[key] = (handle, nbytes)
+                    evicted = self._evict(keep=key)
+                _release(evicted)
+            finally:
+                # also when the loader raises, so failed keys do not pile up
+                with self._lock:
+                    self._load_locks.pop(key, None)
+            return handle
+
+    def _evict(self, keep: Hashable) -> list:
+        evicted = []
+        if self.max_bytes is None:
+            return evicted
+        while self.total_bytes() > self.max_bytes:
+            lru_key = next(iter(self._models))
+            if lru_key == keep:
+                break
+            evicted.append(self._models.pop(lru_key)[0])
+            print(f"Evicted model {lru_key} from the registry")
+        return evicted
+
+    def evict(self, key: Hashable):
+        """
+        Drop the model registered under ``key``, if any.
+        """
+        with self._lock:
+            entry = self._models.pop(key, None)
+        _release([entry[0]] if entry is not None else [])
+
+    def clear(self):
+        """
+        Drop every registered model.
+        """
+        with self._lock:
+            handles = [handle for handle, _ in self._models.values()]
+            self._models.clear()
+        _release(handles)
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return sum(nbytes for _, nbytes in self._models.values())
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._models
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._models)
+
+
+def _max_bytes_from_env() -> Optional[int]:
+    max_gb = os.getenv("GLOMA_MODEL_CACHE_GB")
+    if not max_gb:
+        return None
+    return int(float(max_gb) * 1024 ** 3)
+
+
+# Shared by GLOMA, ObjectRemoval and the GLIGEN / LLM loaders.
+MODEL_REGISTRY = ModelRegistry(max_bytes=_max_bytes_from_env())
@@ -1,24 +1,63 @@
+from functools import lru_cache, partial
 from typing import Dict
 
 import cv2
 import numpy as np
-from lama_inpaint import inpaint_img_with_lama
+from compact_mask import CompactMask
+from detection_postprocess import DetectionSet
+from lama_inpaint import inpaint_img_with_lama, inpaint_img_with_lama_roi, inpaint_img_with_lama_tiled
+
+# "rect" reproduces the square kernel (OpenCV dilates it as separate row and column passes),
+# "ellipse" gives rounder margins around the object
+DILATE_SHAPES = {
+    "rect": cv2.MORPH_RECT,
+    "ellipse": cv2.MORPH_ELLIPSE,
+}
+
+
+@lru_cache(maxsize=None)
+def _structuring_element(size, shape):
+    return cv2.getStructuringElement(DILATE_SHAPES[shape], (size, size))
 
 
 class ObjectRemoval:
 
-    def __init__(self, image, detections, class_prompt, dilate_factor=30):
+    def __init__(self, image, detections, class_prompt, dilate_factor=30, dilate_shape="rect", lama_roi=False,
+                 lama_max_tile_size=None, lama_precision="fp32", lama_channels_last=False, lama_device=None):
         self.image = image
+        if not isinstance(detections, DetectionSet):
+            detections = DetectionSet.from_detections(detections, class_prompt)
         self.detections = detections
         self.dilate_factor = dilate_factor
+        if dilate_shape not in DILATE_SHAPES:
+            raise ValueError(f"Unknown dilate shape: {dilate_shape}")
+        self.dilate_shape = dilate_shape
+        self.lama_roi = lama_roi
+        self.lama_max_tile_size = lama_max_tile_size
+        self.lama_precision = lama_precision
+        self.lama_channels_last = lama_channels_last
+        self.lama_device = lama_device
         self.class_ids = detections.class_id  # array([2, 0, 1])
         self.class_prompt = class_prompt  # ['green cube', 'yellow cube', 'blue cube']
-        self.masks = self._create_masks()
+        # Masks are dilated on first use only: usually just the object of motion is inpainted.
+        self._dilated_masks = {}  # (row, dilate_factor) -> CompactMask
         self.bboxes = self._create_bboxes()
 
+    @property
+    def masks(self) -> Dict:
+        return self._create_masks()
+
+    def _best_rows(self):
+        """
+        Yields (class_id, row) for the most confident detection of every detected class.
+        """
+        for class_id, row in enumerate(self.detections.class_index):
+            if row >= 0:
+                yield class_id, row
+
     def _create_bboxes(self) -> Dict:
         """
-        Create bounding boxes for all objects in the image.
+        Create bounding boxes for all objects in the image, one per class (the most confident).
         
         Format:
         {
@@ -37,27 +76,28 @@ class ObjectRemoval:
             "obj_of_motion": {},
             "objs_of_reference": {}
         }
-        for i, bbox in enumerate(self.detections.xyxy):
-            if self.detections.class_id[i] == 0:
-                self.obj_of_motion = self.class_prompt[self.detections.class_id[i]]
-                bboxes["obj_of_motion"][self.class_prompt[self.detections.class_id[i]]] = bbox
+        for class_id, row in self._best_rows():
+            bbox = self.detections.xyxy[row]
+            if class_id == 0:
+                self.obj_of_motion = self.class_prompt[class_id]
+                bboxes["obj_of_motion"][self.class_prompt[class_id]] = bbox
             else:
-                bboxes["objs_of_reference"][self.class_prompt[self.detections.class_id[i]]] = bbox
+                bboxes["objs_of_reference"][self.class_prompt[class_id]] = bbox
         return bboxes
 
     def _create_masks(self) -> Dict:
         """
-        Create masks for all objects in the image.
+        Create (dilated) masks for all objects in the image, one per class (the most confident).
         
         Format:
         {
             "obj_of_motion": {
-                object_name: mask
+                object_name: CompactMask
             },
             "objs_of_reference": 
             {
-                object_name: mask,
-                object_name: mask,
+                object_name: CompactMask,
+                object_name: CompactMask,
                 ...
             }
         }
@@ -66,29 +106,42 @@ class ObjectRemoval:
             "obj_of_motion": {},
             "objs_of_reference": {}
         }
-        for i, mask in enumerate(self.detections.mask):
-            if self.detections.class_id[i] == 0:
-                masks["obj_of_motion"][self.class_prompt[self.detections.class_id[i]]] = self._dilate_mask(mask, dilate_factor=self.dilate_factor)
+        for class_id, row in self._best_rows():
+            mask = self.get_mask(class_id)
+            if class_id == 0:
+                masks["obj_of_motion"][self.class_prompt[class_id]] = mask
             else:
-                masks["objs_of_reference"][self.class_prompt[self.detections.class_id[i]]] = self._dilate_mask(mask, dilate_factor=self.dilate_factor)
+                masks["objs_of_reference"][self.class_prompt[class_id]] = mask
         return masks
     
-    def _dilate_mask(self, mask, dilate_factor=30):
+    def _dilate_mask(self, mask: CompactMask, dilate_factor=30) -> CompactMask:
         print("Dilating mask with FACTOR: {}".format(dilate_factor))
-        mask = mask.astype(np.uint8)
-        mask = cv2.dilate(
-            mask,
-            np.ones((dilate_factor, dilate_factor), np.uint8),
-            iterations=1
-        )
-        return mask
+        # runs on the mask's bounding box padded by the kernel radius, not the full frame
+        return mask.dilate(_structuring_element(dilate_factor, self.dilate_shape))
+
+    def get_mask(self, class_id: int, dilate_factor=None) -> CompactMask:
+        """
+        Dilated mask of the most confident detection of ``class_id``, computed once per (mask, factor).
+
+        Args:
+        - class_id (int): Index into the class prompt.
+        - dilate_factor (int, optional): Kernel size. Defaults to the remover's dilate_factor.
+        """
+        row = self.detections.best(class_id)
+        if row is None:
+            raise KeyError(f"No detection for class {self.class_prompt[class_id]}")
+        dilate_factor = dilate_factor or self.dilate_factor
+        key = (row, dilate_factor)
+        if key not in self._dilated_masks:
+            self._dilated_masks[key] = self._dilate_mask(self.detections.mask[row], dilate_factor=dilate_factor)
+        return self._dilated_masks[key]
 
     def get_obj_of_motion_mask(self) -> np.ndarray:
         """
         Returns
-        - numpy.ndarray: Binary mask of the object of motion.
+        - numpy.ndarray: Binary (uint8) full-frame mask of the object of motion, as LaMa consumes it.
         """
-        return self.masks["obj_of_motion"][self.obj_of_motion]
+        return self.get_mask(0).to_dense()
     
     def get_obj_of_motion_bbox(self) -> Dict:
         """
@@ -103,8 +156,8 @@ class ObjectRemoval:
         """
         Returns
         -   {
-                object_name: mask,
-                object_name: mask,
+                object_name: CompactMask,
+                object_name: CompactMask,
                 ...
             }
         """
@@ -163,17 +216,32 @@ class ObjectRemoval:
 
         Note:
         - Ensure the provided configurations and checkpoint paths are accessible.
-        - This function assumes that the device to use is a CUDA-enabled GPU.
+        - LaMa runs on ``lama_device``: by default CUDA when available, the CPU otherwise.
+        - With ``lama_roi`` only a context window around the mask is inpainted and pasted back
+          (see lama_inpaint.inpaint_img_with_lama_roi); large masks still use the full frame.
+        - With ``lama_max_tile_size`` larger images are inpainted in overlapping tiles
+          (see lama_inpaint.inpaint_img_with_lama_tiled); combined with ``lama_roi`` it bounds the
+          window and the full-frame fallback.
+        - ``lama_precision`` and ``lama_channels_last`` select a reduced-precision / NHWC
+          forward pass (see lama_inpaint.LAMA_PRECISIONS).
 
         Examples:
         inpainted_image = obj.inpaint_image(image, mask)
 
         """
 
-        return inpaint_img_with_lama(
+        if self.lama_roi:
+            inpaint = partial(inpaint_img_with_lama_roi, max_tile_size=self.lama_max_tile_size)
+        elif self.lama_max_tile_size:
+            inpaint = partial(inpaint_img_with_lama_tiled, max_tile_size=self.lama_max_tile_size)
+        else:
+            inpaint = inpaint_img_with_lama
+        return inpaint(
             img=image,
             mask=mask,
             config_p="./lama/configs/prediction/default.yaml",
             ckpt_p="../checkpoints/big-lama",
-            device="cuda",
+            device=self.lama_device,
+            precision=self.lama_precision,
+            channels_last=self.lama_channels_last,
         )
\ No newline at end of file
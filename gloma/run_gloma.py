@@ -4,6 +4,7 @@ import os
 import cv2
 
 from gloma import GLOMA
+from lama_inpaint import configure_cpu_threads
 
 
 def main():
@@ -21,7 +22,17 @@ def main():
                         default=None, 
                         help='Option to select starting noise type. Choose between "random" or None.')
     parser.add_argument('--guidance_scale', help='Guidance Scale', default=7.5, type=float)
+    parser.add_argument('--sam_encoder', help='SAM encoder variant', choices=['vit_b', 'vit_l', 'vit_h'], default=None)
+    parser.add_argument('--speculative_bbox', help='Predict the new bbox concurrently with LaMa inpainting', action='store_true')
+    parser.add_argument('--lama_roi', help='Inpaint only a window around the object instead of the full image', action='store_true')
+    parser.add_argument('--lama_max_tile_size', help='Inpaint larger images in overlapping tiles of this size', default=None, type=int)
+    parser.add_argument('--lama_precision', help='LaMa precision: bf16 on CPU, fp16 on GPU', choices=['fp32', 'bf16', 'fp16'], default='fp32')
+    parser.add_argument('--lama_channels_last', help='Run LaMa on channels_last (NHWC) tensors', action='store_true')
+    parser.add_argument('--lama_device', help='Device for LaMa (default: cuda when available, else cpu)', choices=['cuda', 'cpu'], default=None)
+    parser.add_argument('--cpu_threads', help='CPU threads per operator (default: every available core)', default=None, type=int)
     args = parser.parse_args()
+    if args.cpu_threads:
+        configure_cpu_threads(intra_op_threads=args.cpu_threads)
 
     action_prompt = args.action_prompt
     box_threshold = args.box_threshold
@@ -47,7 +58,14 @@ def main():
         debug_mode=args.debug_mode,
         dilution_factor=args.dilution_factor,
         starting_noise=args.starting_noise,
-        guidance_scale=args.guidance_scale
+        guidance_scale=args.guidance_scale,
+        sam_encoder_version=args.sam_encoder,
+        speculative_bbox=args.speculative_bbox,
+        lama_roi=args.lama_roi,
+        lama_max_tile_size=args.lama_max_tile_size,
+        lama_precision=args.lama_precision,
+        lama_channels_last=args.lama_channels_last,
+        lama_device=args.lama_device
     )
     result_images = gloma.run_gloma()
     
@@ -0,0 +1,234 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import threading
+import time
+import traceback
+
+import cv2
+
+from gloma import GLOMA
+from gloma_pipeline import STAGES, GLOMAPipeline
+from lama_inpaint import configure_cpu_threads
+from LLM.llm_cache import LLM_CACHE
+
+RESULTS_FILE = "results.jsonl"
+# Manifest fields that override the command-line defaults for one job.
+JOB_OVERRIDES = ("box_threshold", "text_threshold", "nms_threshold", "llm", "dilution_factor", "guidance_scale")
+
+
+def read_manifest(manifest_path):
+    """
+    Read a JSONL or CSV manifest of jobs.
+
+    Every job needs an "image_path" and an "action_prompt". A "job_id" is optional and is
+    derived from the image path, the prompt and the per-job overrides (JOB_OVERRIDES) when
+    omitted, so that resuming is stable. Empty fields (e.g. blank CSV cells) count as
+    omitted, and job ids must be unique.
+
+    Returns:
+    - list: A list of job dicts.
+    """
+    if manifest_path.endswith(".csv"):
+        with open(manifest_path, newline="") as f:
+            jobs = [dict(row) for row in csv.DictReader(f)]
+    else:
+        with open(manifest_path) as f:
+            jobs = [json.loads(line) for line in f if line.strip()]
+
+    job_ids = set()
+    for job in jobs:
+        if job_value(job, "image_path") is None or job_value(job, "action_prompt") is None:
+            raise ValueError(f"Manifest entry is missing image_path or action_prompt: {job}")
+        if job_value(job, "job_id") is None:
+            identity = f"{job['image_path']}\n{job['action_prompt']}"
+            # only the overrides that are set, so jobs without any keep their previous ids
+            for key in JOB_OVERRIDES:
+                if job_value(job, key) is not None:
+                    identity += f"\n{key}={job[key]}"
+            job["job_id"] = hashlib.sha1(identity.encode()).hexdigest()[:12]
+        if job["job_id"] in job_ids:
+            raise ValueError(f"Duplicate job_id in manifest: {job['job_id']}")
+        job_ids.add(job["job_id"])
+    return jobs
+
+
+def job_value(job, key, default=None):
+    """
+    Returns ``job[key]``, or ``default`` when the key is absent or its value is empty.
+    """
+    value = job.get(key)
+    return default if value is None or value == "" else value
+
+
+def read_completed_jobs(output_dir):
+    """
+    Returns the ids of the jobs already recorded as done in the output directory.
+    """
+    results_path = os.path.join(output_dir, RESULTS_FILE)
+    completed = set()
+    if not os.path.exists(results_path):
+        return completed
+    with open(results_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # a crash may leave a truncated last line behind
+                continue
+            if record.get("status") == "done":
+                completed.add(record["job_id"])
+    return completed
+
+
+def append_result(output_dir, record):
+    results_path = os.path.join(output_dir, RESULTS_FILE)
+    with open(results_path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def build_gloma(job, args):
+    image_path = job["image_path"]
+    if not os.path.exists(image_path):
+        raise RuntimeError(f"Error: File '{image_path}' does not exist.")
+    rgb_image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+    rgb_image = cv2.resize(rgb_image, (args.image_size, args.image_size))
+
+    gloma = GLOMA(
+        action_prompt=job["action_prompt"],
+        box_threshold=float(job_value(job, "box_threshold", args.box_threshold)),
+        text_threshold=float(job_value(job, "text_threshold", args.text_threshold)),
+        nms_threshold=float(job_value(job, "nms_threshold", args.nms_threshold)),
+        llm_choice=job_value(job, "llm", args.llm),
+        rgb_image=rgb_image,
+        debug_mode=args.debug_mode,
+        dilution_factor=int(job_value(job, "dilution_factor", args.dilution_factor)),
+        starting_noise=args.starting_noise,
+        guidance_scale=float(job_value(job, "guidance_scale", args.guidance_scale)),
+        sam_encoder_version=args.sam_encoder,
+        speculative_bbox=args.speculative_bbox,
+        lama_roi=args.lama_roi,
+        lama_max_tile_size=args.lama_max_tile_size,
+        lama_precision=args.lama_precision,
+        lama_channels_last=args.lama_channels_last,
+        lama_device=args.lama_device
+    )
+    return gloma
+
+
+def save_outputs(job, result_images, output_dir):
+    outputs = []
+    for j, result_image in enumerate(result_images):
+        output_path = os.path.join(output_dir, f"{job['job_id']}_{j}.png")
+        cv2.imwrite(output_path, result_image)
+        outputs.append(output_path)
+    return outputs
+
+
+def new_record(job):
+    return {
+        "job_id": job["job_id"],
+        "image_path": job["image_path"],
+        "action_prompt": job["action_prompt"],
+    }
+
+
+def run_sequential(jobs, args):
+    for i, job in enumerate(jobs):
+        print(f"[{i + 1}/{len(jobs)}] job {job['job_id']}: {job['action_prompt']}")
+        start = time.perf_counter()
+        record = new_record(job)
+        try:
+            result_images = build_gloma(job, args).run_gloma()
+            record.update(status="done", outputs=save_outputs(job, result_images, args.output_dir))
+        except Exception as e:
+            traceback.print_exc()
+            record.update(status="failed", error=repr(e))
+        record["seconds"] = round(time.perf_counter() - start, 3)
+        append_result(args.output_dir, record)
+
+
+def run_pipelined(jobs, args):
+    concurrency = {stage: getattr(args, f"{stage}_workers") for stage in STAGES}
+    results_lock = threading.Lock()
+
+    def on_done(job, start, future):
+        record = new_record(job)
+        try:
+            record.update(status="done", outputs=save_outputs(job, future.result(), args.output_dir))
+        except Exception as e:
+            traceback.print_exception(type(e), e, e.__traceback__)
+            record.update(status="failed", error=repr(e))
+        record["seconds"] = round(time.perf_counter() - start, 3)
+        with results_lock:
+            append_result(args.output_dir, record)
+            print(f"job {job['job_id']}: {record['status']} in {record['seconds']}s")
+
+    with GLOMAPipeline(concurrency=concurrency, queue_size=args.queue_size) as pipeline:
+        for job in jobs:
+            start = time.perf_counter()
+            try:
+                gloma = build_gloma(job, args)
+            except Exception as e:
+                record = new_record(job)
+                record.update(status="failed", error=repr(e), seconds=0.0)
+                with results_lock:
+                    append_result(args.output_dir, record)
+                continue
+            future = pipeline.submit(gloma)
+            future.add_done_callback(lambda f, job=job, start=start: on_done(job, start, f))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='GLOMA batch mode - run a manifest of (image, action_prompt) jobs in one process')
+    parser.add_argument('--manifest', help='JSONL or CSV manifest with image_path and action_prompt per job', required=True)
+    parser.add_argument('--output_dir', help='Directory for result images and results.jsonl', default='results')
+    parser.add_argument('--box_threshold', help='Box Threshold', default=0.3, type=float)
+    parser.add_argument('--text_threshold', help='Text Threshold', default=0.25, type=float)
+    parser.add_argument('--nms_threshold', help='NMS Threshold', default=0.2, type=float)
+    parser.add_argument('--llm', help='Choose either ChatGPT or Llama', choices=['chatgpt', 'llama'], default='chatgpt')
+    parser.add_argument('--debug_mode', help='Debug Mode', default=False, type=bool)
+    parser.add_argument('--image_size', help='Image Size', default=512, type=int)
+    parser.add_argument('--dilution_factor', help='Dilution Factor', default=15, type=int)
+    parser.add_argument('--starting_noise', choices=['random', None],
+                        default=None,
+                        help='Option to select starting noise type. Choose between "random" or None.')
+    parser.add_argument('--guidance_scale', help='Guidance Scale', default=7.5, type=float)
+    parser.add_argument('--sam_encoder', help='SAM encoder variant', choices=['vit_b', 'vit_l', 'vit_h'], default=None)
+    parser.add_argument('--speculative_bbox', help='Predict the new bbox concurrently with LaMa inpainting', action='store_true')
+    parser.add_argument('--lama_roi', help='Inpaint only a window around the object instead of the full image', action='store_true')
+    parser.add_argument('--lama_max_tile_size', help='Inpaint larger images in overlapping tiles of this size', default=None, type=int)
+    parser.add_argument('--lama_precision', help='LaMa precision: bf16 on CPU, fp16 on GPU', choices=['fp32', 'bf16', 'fp16'], default='fp32')
+    parser.add_argument('--lama_channels_last', help='Run LaMa on channels_last (NHWC) tensors', action='store_true')
+    parser.add_argument('--lama_device', help='Device for LaMa (default: cuda when available, else cpu)', choices=['cuda', 'cpu'], default=None)
+    parser.add_argument('--cpu_threads', help='CPU threads per operator (default: every available core)', default=None, type=int)
+    parser.add_argument('--pipelined', help='Overlap the stages of consecutive jobs', action='store_true')
+    parser.add_argument('--queue_size', help='Capacity of each pipeline stage queue', default=2, type=int)
+    parser.add_argument('--llm_parse_workers', help='Concurrent object-parsing LLM calls', default=4, type=int)
+    parser.add_argument('--detection_workers', help='Concurrent GroundedSAM jobs', default=1, type=int)
+    parser.add_argument('--removal_workers', help='Concurrent LaMa jobs', default=1, type=int)
+    parser.add_argument('--llm_bbox_workers', help='Concurrent bounding-box LLM calls', default=4, type=int)
+    parser.add_argument('--generation_workers', help='Concurrent GLIGEN jobs; jobs on the same GLIGEN model still sample one at a time', default=1, type=int)
+    args = parser.parse_args()
+    if args.cpu_threads:
+        configure_cpu_threads(intra_op_threads=args.cpu_threads)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    jobs = read_manifest(args.manifest)
+    completed = read_completed_jobs(args.output_dir)
+    pending = [job for job in jobs if job["job_id"] not in completed]
+    print(f"📦 {len(jobs)} jobs in manifest, {len(completed)} already done, {len(pending)} to run")
+
+    if args.pipelined:
+        run_pipelined(pending, args)
+    else:
+        run_sequential(pending, args)
+    print(f"LLM cache: {LLM_CACHE.stats()}")
+
+
+if __name__ == "__main__":
+    main()
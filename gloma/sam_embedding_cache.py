@@ -0,0 +1,122 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+import torch
+
+from utils import helper
+
+
+class SamEmbeddingCache:
+    """
+    Cache of SAM image-encoder outputs keyed by image content and encoder variant.
+
+    Repeated prompts against the same scene skip the ViT image encoder: the predictor is
+    primed with the cached features instead. Entries live in a bounded in-memory LRU tier
+    (kept on the predictor's device) and, optionally, as ``.npy`` files in ``cache_dir``
+    that are memory-mapped when read back.
+    """
+
+    def __init__(self, max_entries: int = 8, cache_dir: Optional[str] = None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()  # key -> features tensor
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def set_image(self, predictor, image: np.ndarray, encoder_version: str):
+        """
+        Equivalent to ``predictor.set_image(image)``, served from the cache when possible.
+
+        Args:
+        - predictor (SamPredictor): The predictor to prime.
+        - image (np.ndarray): RGB image in HWC uint8 format.
+        - encoder_version (str): SAM encoder variant of the predictor, e.g. "vit_h".
+        """
+        features = self.get(image, encoder_version, predictor.device)
+        if features is None:
+            predictor.set_image(image)
+            self.put(image, encoder_version, predictor.features)
+            return
+        self.prime(predictor, image.shape[:2], features)
+
+    @staticmethod
+    def prime(predictor, image_size, features: torch.Tensor):
+        """
+        Put ``predictor`` in the state ``set_image`` leaves it in, given the encoder features of the image.
+
+        Args:
+        - predictor (SamPredictor): The predictor to prime.
+        - image_size (tuple): (height, width) of the original image.
+        - features (torch.Tensor): Image-encoder output of shape (1, C, H', W').
+        """
+        height, width = image_size
+        predictor.reset_image()
+        predictor.original_size = (height, width)
+        predictor.input_size = tuple(
+            predictor.transform.get_preprocess_shape(height, width, predictor.transform.target_length)
+        )
+        predictor.features = features
+        predictor.is_image_set = True
+
+    @staticmethod
+    def _key(image: np.ndarray, encoder_version: str) -> str:
+        return f"{encoder_version}_{helper.hash_image(image)}"
+
+    def get(self, image: np.ndarray, encoder_version: str, device) -> Optional[torch.Tensor]:
+        return self._get(self._key(image, encoder_version), device)
+
+    def put(self, image: np.ndarray, encoder_version: str, features: torch.Tensor):
+        self._put(self._key(image, encoder_version), features)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def _get(self, key: str, device) -> Optional[torch.Tensor]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+
+            if self.cache_dir and os.path.exists(self._path(key)):
+                # copy-on-write map: pages go straight from the file to the device, and the
+                # array is writable, so torch can wrap it without a warning or an extra copy
+                features = np.load(self._path(key), mmap_mode="c")
+                features = torch.as_tensor(features, device=device)
+                self._put_in_memory(key, features)
+                self.hits += 1
+                return features
+
+            self.misses += 1
+            return None
+
+    def _put(self, key: str, features: torch.Tensor):
+        with self._lock:
+            self._put_in_memory(key, features)
+            if self.cache_dir and not os.path.exists(self._path(key)):
+                tmp_path = self._path(f"{key}.tmp")
+                np.save(tmp_path, features.detach().cpu().numpy())
+                os.replace(tmp_path, self._path(key))
+
+    def _put_in_memory(self, key: str, features: torch.Tensor):
+        self._memory[key] = features
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+
+
+# Shared by every GroundedSAM.
+SAM_EMBEDDING_CACHE = SamEmbeddingCache(
+    max_entries=int(os.getenv("GLOMA_SAM_CACHE_SIZE", "8")),
+    cache_dir=os.getenv("GLOMA_SAM_CACHE_DIR") or None
+)
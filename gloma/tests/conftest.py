@@ -0,0 +1,49 @@
+import string
+import sys
+from pathlib import Path
+
+import pytest
+
+# The modules under gloma/ import each other by their flat names (run from gloma/).
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture(scope="session")
+def char_tokenizer():
+    """
+    Character-level fast tokenizer over printable ASCII, built offline.
+
+    Every character is one token, so a prompt always tokenizes to its prefix's tokens
+    followed by the rest, like SentencePiece does for the few-shot preambles.
+    """
+    pytest.importorskip("transformers")
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+
+    special_tokens = ["<unk>", "<s>", "</s>"]
+    characters = sorted(set(string.printable) - set("\x0b\x0c"))
+    vocab = {token: i for i, token in enumerate(special_tokens + characters)}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    tokenizer.decoder = decoders.Fuse()
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, unk_token="<unk>", bos_token="<s>", eos_token="</s>",
+        model_input_names=["input_ids", "attention_mask"]
+    )
+
+
+@pytest.fixture(scope="session")
+def tiny_llama(char_tokenizer):
+    """
+    A two-layer random-weight Llama over ``char_tokenizer``'s vocabulary, small enough for CPU tests.
+    """
+    import torch
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=len(char_tokenizer), hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=2048,
+        bos_token_id=char_tokenizer.bos_token_id, eos_token_id=char_tokenizer.eos_token_id
+    )
+    return LlamaForCausalLM(config).eval()
@@ -0,0 +1,62 @@
+import copy
+import sys
+from pathlib import Path
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("kornia")
+pytest.importorskip("pytorch_lightning")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "lama"))
+from saicinpainting.training.modules.ffc import FFC_BN_ACT, FFCResNetGenerator  # noqa: E402
+from saicinpainting.training.modules.ffc_inference import PlannedFourierUnit, prepare_generator_for_inference  # noqa: E402
+
+
+def make_generator(**resnet_conv_kwargs):
+    """
+    A small FFC generator with non-trivial BatchNorm statistics, so that folding errors show.
+    """
+    torch.manual_seed(0)
+    generator = FFCResNetGenerator(
+        4, 3, ngf=16, n_downsampling=2, n_blocks=2, add_out_act="sigmoid",
+        init_conv_kwargs=dict(ratio_gin=0, ratio_gout=0, enable_lfu=False),
+        downsample_conv_kwargs=dict(ratio_gin=0, ratio_gout=0, enable_lfu=False),
+        resnet_conv_kwargs=dict(ratio_gin=0.75, ratio_gout=0.75, **resnet_conv_kwargs),
+    )
+    with torch.no_grad():
+        for module in generator.modules():
+            if isinstance(module, torch.nn.BatchNorm2d):
+                module.running_mean.uniform_(-0.5, 0.5)
+                module.running_var.uniform_(0.5, 2.0)
+                module.weight.uniform_(0.5, 1.5)
+                module.bias.uniform_(-0.5, 0.5)
+    return generator.eval()
+
+
+@pytest.mark.parametrize("gated", [False, True])
+@pytest.mark.parametrize("enable_lfu, spectral_pos_encoding", [(False, False), (True, True)])
+def test_prepared_generator_matches_eager(gated, enable_lfu, spectral_pos_encoding):
+    generator = make_generator(gated=gated, enable_lfu=enable_lfu, spectral_pos_encoding=spectral_pos_encoding)
+    prepared = prepare_generator_for_inference(copy.deepcopy(generator))
+
+    blocks = [module for module in prepared.modules() if isinstance(module, FFC_BN_ACT)]
+    assert all(not isinstance(block.bn_l, torch.nn.BatchNorm2d) for block in blocks)
+    # with gates the global BatchNorm shift moves to the spectral conv2, so it still folds
+    assert all(not isinstance(block.bn_g, torch.nn.BatchNorm2d) for block in blocks)
+    assert any(isinstance(module, PlannedFourierUnit) for module in prepared.modules())
+
+    for size in [64, 96]:
+        x = torch.rand(2, 4, size, size)
+        with torch.no_grad():
+            diff = (generator(x) - prepared(x)).abs().max().item()
+        assert diff < 1e-4, f"{size}x{size}: {diff}"
+
+
+def test_gated_shift_stays_off_the_gated_branch():
+    generator = make_generator(gated=True, enable_lfu=False)
+    prepared = prepare_generator_for_inference(copy.deepcopy(generator))
+    for block in (module for module in prepared.modules() if isinstance(module, FFC_BN_ACT)):
+        if block.ffc.gated and isinstance(block.ffc.convl2g, torch.nn.Conv2d):
+            # convl2g is multiplied by the sigmoid gate, so it must not carry the BatchNorm shift
+            assert block.ffc.convl2g.bias is None
@@ -0,0 +1,152 @@
+import json
+import random
+import string
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from LLM.json_constraint import SCHEMAS, JSONSchemaConstraint, JSONSchemaLogitsProcessor, TokenVocabulary
+from LLM.llama import JSONStoppingCriteria
+from utils.helper import extract_json_content
+
+SPECIAL_TOKENS = ["<unk>", "<s>", "</s>"]
+# SentencePiece-style pieces: single characters, "▁" for a leading space, byte fallbacks and
+# multi-character pieces that span several automaton steps
+PIECES = sorted(set(string.printable) - set("\x0b\x0c")) + [
+    "▁", "▁{", '{"', '":', '▁"', '",', '"]', '"}', "▁[", "],", "]}", "12", "345", "0,",
+    "object", "_of", "_motion", "objects", "_reference", "predicted", "_bbox", "▁cup", "▁on",
+    "<0x0A>", "<0x7B>", "<0xE2>",
+]
+
+
+class PieceTokenizer:
+    """The parts of a tokenizer that TokenVocabulary reads."""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.eos_token_id = tokens.index("</s>")
+        self.all_special_ids = [tokens.index(token) for token in SPECIAL_TOKENS]
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def convert_ids_to_tokens(self, token_id):
+        return self.tokens[token_id]
+
+
+@pytest.fixture(scope="module")
+def vocabulary():
+    return TokenVocabulary(PieceTokenizer(SPECIAL_TOKENS + PIECES))
+
+
+def check_object(reply):
+    assert set(reply) == {"object_of_motion", "objects_of_reference"}
+    assert isinstance(reply["object_of_motion"], str)
+    assert isinstance(reply["objects_of_reference"], list)
+    assert all(isinstance(name, str) for name in reply["objects_of_reference"])
+
+
+def check_bbox(reply):
+    assert set(reply) == {"predicted_bbox"}
+    bbox = reply["predicted_bbox"]
+    assert len(bbox) == 4
+    assert all(isinstance(value, int) and value >= 0 for value in bbox)
+
+
+CHECKS = {"object": check_object, "bbox": check_bbox}
+
+
+def check_reply(schema, text):
+    # LLAMA.generate hands the reply to extract_json_content before it is parsed
+    assert extract_json_content(text) == text.strip()
+    CHECKS[schema](json.loads(text))
+
+
+def test_vocabulary_surface_text(vocabulary):
+    texts = set(vocabulary.texts.values())
+    assert " " in texts and " {" in texts and "\n" in texts and "{" in texts
+    # special tokens and partial UTF-8 bytes never appear in constrained text
+    assert not texts & {"<unk>", "<s>", "</s>", "\xe2"}
+
+
+@pytest.mark.parametrize("schema", sorted(SCHEMAS))
+@pytest.mark.parametrize("seed", range(20))
+def test_random_walk_yields_valid_json(vocabulary, schema, seed):
+    constraint = JSONSchemaConstraint(SCHEMAS[schema], vocabulary)
+    vocab_size = len(SPECIAL_TOKENS) + len(PIECES)
+    rng = random.Random(seed)
+    state, text = constraint.initial_state, ""
+    for _ in range(5000):
+        allowed = constraint.allowed_mask(state, vocab_size, "cpu").nonzero().flatten().tolist()
+        assert allowed, f"no token allowed after {text!r}"
+        token_id = rng.choice(allowed)
+        if token_id == vocabulary.eos_token_id:
+            break
+        text += vocabulary.texts[token_id]
+        state = constraint.advance(state, token_id)
+        assert state is not None
+    else:
+        pytest.fail("the constrained walk did not terminate")
+    assert constraint.is_accepting(state)
+    check_reply(schema, text)
+
+
+def test_logits_processor_constrains_every_row(vocabulary):
+    """
+    Greedy decoding on random scores through the processor, as ``generate`` would run it,
+    with one unconstrained row in the batch.
+    """
+    schemas = ["object", "bbox", None]
+    constraints = [JSONSchemaConstraint(SCHEMAS[schema], vocabulary) if schema else None for schema in schemas]
+    vocab_size = len(SPECIAL_TOKENS) + len(PIECES)
+    prompt_length = 3
+    input_ids = torch.zeros(len(schemas), prompt_length, dtype=torch.long)
+    processor = JSONSchemaLogitsProcessor(constraints, prompt_length)
+    generator = torch.Generator().manual_seed(0)
+    finished = [False] * len(schemas)
+    for _ in range(5000):
+        scores = processor(input_ids, torch.randn(len(schemas), vocab_size, generator=generator))
+        next_tokens = scores.argmax(dim=-1)
+        for row, token_id in enumerate(next_tokens.tolist()):
+            if finished[row]:
+                next_tokens[row] = vocabulary.eos_token_id
+            elif token_id == vocabulary.eos_token_id:
+                finished[row] = True
+        input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=1)
+        if all(finished[:2]):
+            break
+    else:
+        pytest.fail("constrained decoding did not terminate")
+
+    for row, schema in enumerate(schemas[:2]):
+        token_ids = input_ids[row, prompt_length:].tolist()
+        text = "".join(vocabulary.texts[token_id] for token_id in token_ids[:token_ids.index(vocabulary.eos_token_id)])
+        check_reply(schema, text)
+
+
+@pytest.mark.parametrize("text, complete", [
+    ('{"predicted_bbox": [1, 2, 3, 4]}', True),
+    ('Sure: {"a": {"b": [1]}} trailing', True),
+    ('{"a": "}"', False),
+    ('{"a": "x\\"}"}', True),
+    ('{"a": {"b": 1}', False),
+    ('no json here }', False),
+])
+def test_stopping_criteria_is_complete(text, complete):
+    assert JSONStoppingCriteria.is_complete(text) is complete
+
+
+def test_stopping_criteria_waits_for_every_row(char_tokenizer):
+    prompt_ids = char_tokenizer("Q:").input_ids
+    replies = ['{"a": 1}', '{"a": ']
+    reply_ids = [char_tokenizer(reply).input_ids for reply in replies]
+    width = max(len(ids) for ids in reply_ids)
+    # finished rows are padded with EOS, which batch_decode drops as a special token
+    input_ids = torch.tensor([
+        prompt_ids + ids + [char_tokenizer.eos_token_id] * (width - len(ids)) for ids in reply_ids
+    ])
+    criteria = JSONStoppingCriteria(char_tokenizer, input_length=len(prompt_ids))
+    assert not criteria(input_ids, None)
+    assert criteria(input_ids[:1], None)
@@ -0,0 +1,85 @@
+import threading
+
+import pytest
+
+pytest.importorskip("transformers")
+
+from LLM import llama
+from LLM.llama import LLAMA
+
+PREFIX = "You plan object edits. Q: move the cup onto the table\nA: cup\n"
+TAILS = ["Q: push the ball\nA:", "Q: hang the jacket by the door\nA:", "Q: x\nA:"]
+
+
+@pytest.fixture
+def raw_replies(monkeypatch):
+    # a random-weight model does not write JSON; compare the decoded text instead
+    monkeypatch.setattr(llama, "extract_json_content", lambda text: text)
+
+
+@pytest.fixture
+def backend(char_tokenizer, tiny_llama, raw_replies):
+    llm = LLAMA(
+        tokenizer=char_tokenizer, model=tiny_llama, max_new_tokens=12,
+        batch_timeout=0.2, prompt_prefixes=[PREFIX]
+    )
+    yield llm
+    llm.close()
+
+
+def test_prefix_cache_matches_full_prefill(backend):
+    prompts = [PREFIX + tail for tail in TAILS]
+    # the cache covers the prefix minus its last token, which is prefilled with the tail
+    assert len(backend._prefix_cache[PREFIX][0]) == len(backend.tokenizer(PREFIX).input_ids) - 1
+
+    with_cache = backend.generate(prompts, prefix=PREFIX)
+    without_cache = backend.generate(prompts)
+    assert with_cache == without_cache
+    for prompt, reply in zip(prompts, with_cache):
+        assert backend.generate([prompt], prefix=PREFIX) == [reply]
+        assert backend.generate([prompt]) == [reply]
+
+
+def test_prefix_mismatch_falls_back_to_full_prefill(backend):
+    prompts = [PREFIX + TAILS[0], "Unrelated prompt\nA:"]
+    assert backend._prefix_inputs(prompts, PREFIX) is None
+    assert backend.generate(prompts, prefix=PREFIX) == backend.generate(prompts)
+
+
+def test_batched_requests_match_sequential(backend, monkeypatch):
+    prompts = [PREFIX + tail for tail in TAILS] + ["Unrelated prompt\nA:", "Another one\nA:"]
+    sequential = [backend.query_message(prompt, use_cache=False) for prompt in prompts]
+
+    batch_sizes = []
+    generate = backend.generate
+
+    def recording_generate(batch_prompts, **kwargs):
+        batch_sizes.append(len(batch_prompts))
+        return generate(batch_prompts, **kwargs)
+
+    monkeypatch.setattr(backend, "generate", recording_generate)
+    replies = [None] * len(prompts)
+    barrier = threading.Barrier(len(prompts))
+
+    def query(i):
+        barrier.wait()
+        replies[i] = backend.query_message(prompts[i], use_cache=False)
+
+    threads = [threading.Thread(target=query, args=(i,)) for i in range(len(prompts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert replies == sequential
+    # one micro-batch per prefix group: the cached-prefix prompts and the others
+    assert sorted(batch_sizes) == [2, 3]
+
+
+def test_close_stops_the_batching_thread(char_tokenizer, tiny_llama, raw_replies):
+    llm = LLAMA(tokenizer=char_tokenizer, model=tiny_llama, max_new_tokens=4, prompt_prefixes=[])
+    assert isinstance(llm.query_message("hello", use_cache=False), str)
+    llm.close()
+    assert not llm._worker.is_alive()
+    with pytest.raises(RuntimeError):
+        llm.query_message("hello", use_cache=False)
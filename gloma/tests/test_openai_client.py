@@ -0,0 +1,146 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("httpx")
+
+from LLM import openai_client
+from LLM.openai_client import OpenAIClient, OpenAIError
+
+
+class StubServer:
+    """
+    Local stand-in for the chat completions endpoint.
+
+    Each request pops the next (status, headers) from ``responses``; once they run out it
+    answers 200. ``delay`` keeps every request open for that long, to observe concurrency.
+    """
+
+    def __init__(self, responses=(), delay=0.0):
+        self.responses = list(responses)
+        self.delay = delay
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/v1"
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with stub._lock:
+                    stub.requests.append((time.monotonic(), self.path, body))
+                    status, headers = stub.responses.pop(0) if stub.responses else (200, {})
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                time.sleep(stub.delay)
+                with stub._lock:
+                    stub.in_flight -= 1
+                reply = {"choices": [{"message": {"content": "ok"}}]} if status == 200 else {"error": "stub"}
+                payload = json.dumps(reply).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def make_client():
+    clients = []
+
+    def _make(server, **kwargs):
+        kwargs.setdefault("backoff_base", 0.01)
+        client = OpenAIClient(api_key="test", base_url=server.url, **kwargs)
+        clients.append(client)
+        return client
+
+    yield _make
+    for client in clients:
+        client.close()
+
+
+def test_retries_on_429_and_5xx(make_client):
+    with StubServer(responses=[(429, {}), (503, {}), (500, {})]) as server:
+        client = make_client(server, max_retries=3)
+        assert client.chat_completion("gpt-4", [{"role": "user", "content": "hi"}]) == "ok"
+    assert len(server.requests) == 4
+    _, path, body = server.requests[-1]
+    assert path == "/v1/chat/completions"
+    assert body["model"] == "gpt-4"
+
+
+def test_gives_up_after_max_retries(make_client):
+    with StubServer(responses=[(502, {})] * 3) as server:
+        client = make_client(server, max_retries=2)
+        with pytest.raises(OpenAIError) as error:
+            client.chat_completion("gpt-4", [])
+    assert error.value.status_code == 502
+    assert len(server.requests) == 3
+
+
+def test_does_not_retry_client_errors(make_client):
+    with StubServer(responses=[(400, {})]) as server:
+        client = make_client(server)
+        with pytest.raises(OpenAIError) as error:
+            client.chat_completion("gpt-4", [])
+    assert error.value.status_code == 400
+    assert len(server.requests) == 1
+
+
+def test_honours_retry_after(make_client):
+    with StubServer(responses=[(429, {"Retry-After": "0.5"})]) as server:
+        client = make_client(server)
+        assert client.chat_completion("gpt-4", []) == "ok"
+    (first, _, _), (second, _, _) = server.requests
+    # the jittered backoff alone would wait at most backoff_base = 0.01 s
+    assert second - first >= 0.5
+
+
+def test_max_in_flight_from_environment(monkeypatch):
+    monkeypatch.setattr(openai_client, "_client", None)
+    with StubServer(delay=0.2) as server:
+        monkeypatch.setenv("OPENAI_BASE_URL", server.url)
+        monkeypatch.setenv("OPENAI_MAX_IN_FLIGHT", "2")
+        client = openai_client.get_openai_client()
+        try:
+            threads = [
+                threading.Thread(target=client.chat_completion, args=("gpt-4", [{"role": "user", "content": str(i)}]))
+                for i in range(6)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            client.close()
+    assert len(server.requests) == 6
+    assert server.max_in_flight == 2
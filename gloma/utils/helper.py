@@ -1,3 +1,4 @@
+import hashlib
 import json
 import os
 from typing import List, Tuple
@@ -7,6 +8,8 @@ import cv2
 import numpy as np
 from PIL import Image
 
+from compact_mask import CompactMask
+
 
 def save_image(image, file_name):
     """
@@ -75,11 +78,17 @@ def draw_masks(image_cpy, masks):
 
     Args:
     - image: The original image.
-    - masks: List of binary masks, one for each detection.
+    - masks: List of binary masks (dense arrays or CompactMask), one for each detection.
     """
     image = image_cpy.copy()
-    combined_mask = np.sum(masks, axis=0)
-    combined_mask[combined_mask > 1] = 1  # Ensure binary mask (values are either 0 or 1)
+    if masks and isinstance(masks[0], CompactMask):
+        # union on the packed boxes, expand once
+        combined_mask = CompactMask.union_all(masks).to_dense()
+    elif masks:
+        combined_mask = np.sum(masks, axis=0)
+        combined_mask[combined_mask > 1] = 1  # Ensure binary mask (values are either 0 or 1)
+    else:
+        combined_mask = np.zeros(image.shape[:2], dtype=np.uint8)
 
     masked_image = apply_mask(image, combined_mask)
 
@@ -189,3 +198,19 @@ def extract_json_content(return_message):
     else:
         print("No JSON content found in the message.")
         return None
+
+
+def hash_image(image: np.ndarray) -> str:
+    """
+    Content hash of an image array, used as a cache key for per-image model outputs.
+
+    Args:
+        image (np.ndarray): input image.
+
+    Returns:
+        str: hex digest covering the pixel data, shape and dtype.
+    """
+    digest = hashlib.sha1()
+    digest.update(str((image.shape, image.dtype.str)).encode())
+    digest.update(np.ascontiguousarray(image).data)
+    return digest.hexdigest()